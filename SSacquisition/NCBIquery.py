@@ -16,19 +16,18 @@
 
 import os
 import pandas as pd
-from SSutility.SSerrors import RecordDataError,NCBIQueryError, write_errors, print_errors, load_errors
+from SSutility.SSerrors import RecordDataError,NCBIQueryError, write_errors, error_registry
+from SSutility.SSjournal import atomic_write, run_journal
+from SSutility.SScompress import input_compression
 import re
-from selenium import webdriver
-from selenium.common.exceptions import TimeoutException,NoSuchElementException
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException,NoSuchElementException
 from xml.etree.ElementTree import ElementTree as ET
 import numpy as np
 
+ENTREZ_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+
 def headless_driver():
-    #Headless driver with default options
+    #Headless driver with default options. selenium is only imported for browser based ortholog mapping
+    from selenium import webdriver
     from selenium.webdriver.chrome.options import Options
     chrome_options = Options()
     chrome_options.add_argument("--headless")
@@ -38,37 +37,76 @@ def headless_driver():
     return driver
 
 
-def download_AGS_data(gene_id_df, config):
-    """Uses NCBI Rest API to acquire sequence data for NCBI gene IDs listed in gene_id_df[human_gene_id]
+def download_AGS_data(gene_id_df, config, journal=None, progress=None):
+    """Uses NCBI Rest API to acquire sequence data for NCBI gene IDs listed in gene_id_df[human_gene_id]. Ortholog
+    Gene IDs and protein records are acquired for the [NCBI] species and any [NCBISpecies] entries (see
+    SSconfig.NCBI_tax_dicts) in the same mapping pass and batched request wave; records are written to
+    [run_dir]/input/NCBI/<taxid>.
 
     :param gene_id_df: DataFrame object with required columns gene_symbol and human_gene_id
     :param config: configparser object created from config/config.txt
-    :param errors_tsv_fpath: filepath to errors table (see SSerrors.write_errors for details)
+    :param journal: SSjournal.AcquisitionJournal for the run (defaults to the run directory journal); pass a shared
+    journal when other stages record to the same run concurrently (see SSorchestrator.run_acquisition)
+    :param progress: Optional SSorchestrator.AcquisitionProgress; 'NCBI' reports the current step and, once records
+    are downloaded, the number of gene symbols with protein IDs for the [NCBI] species
     :return: ags_geneID_df: DataFrame containing all columns originally in gene_id_df as well as columns
     specified in the config file by NCBIGeneIDField and NCBIProteinIDField with values populated by map_AGS_geneIDs
-    and download_NCBI_records respectively.
+    and download_NCBI_records respectively (and gene/ protein ID columns for additional species).
     """
     from SSutility.SSdirectory import create_directory
+    from SSutility.SSconfig import NCBI_tax_dicts
     run_config, ncbi_config = config['RUN'],config['NCBI']
     run_name, errors_fname = config['RUN']['RunName'], config['RUN']['ErrorsFileName']
     errors_fpath = "{0}/{1}".format(run_name, errors_fname)
-    NCBI_taxid,NCBI_spec_name = ncbi_config["NCBITaxID"], ncbi_config['NCBITaxName']
-    gene_field_name, protein_field_name = ncbi_config['NCBIGeneIDField'],ncbi_config['NCBIProteinIDField']
     NCBI_API_key = ncbi_config.get("NCBIAPIKey","")
-    NCBI_input_dir = "{0}/input/NCBI/{1}".format(run_name,NCBI_taxid)
-    create_directory(NCBI_input_dir)
+    tax_dicts = NCBI_tax_dicts(config)
+    tax_dict, extra_tax_dicts = tax_dicts[0], tax_dicts[1:]
+    species_dirs = []
+    for species_tax_dict in tax_dicts:
+        NCBI_input_dir = "{0}/input/NCBI/{1}".format(run_name,species_tax_dict['taxid'])
+        create_directory(NCBI_input_dir)
+        species_dirs.append((species_tax_dict, NCBI_input_dir))
 
     filled_outpath = "{0}/summary/cDNAscreen_geneIDs_complete.tsv".format(run_name)
 
-    tax_dict = {'gid_column':gene_field_name,'pid_column':protein_field_name,
-                'spec_name':NCBI_spec_name,'taxid':NCBI_taxid}
-    mapped_id_df = map_AGS_geneIDs(gene_id_df, filled_outpath, errors_fpath,tax_dict)
-    ags_mapped_id_df = download_NCBI_records(mapped_id_df, NCBI_input_dir,tax_dict,NCBI_API_key,
-                                             pid_outpath=filled_outpath)
+    #Per gene progress is appended to the run journal; filled_outpath is compacted from it once per step
+    if journal is None:
+        journal = run_journal(run_name)
+    if progress is not None:
+        progress.start("NCBI", len(gene_id_df))
+        progress.phase("NCBI", "mapping gene IDs")
+    compression, compresslevel = input_compression(config)
+    orthologs_fpath = ncbi_config.get("NCBIOrthologsFilePath", "")
+    if orthologs_fpath:
+        mapped_id_df = map_AGS_geneIDs_offline(gene_id_df, filled_outpath, errors_fpath, tax_dict, orthologs_fpath,
+                                               extra_tax_dicts=extra_tax_dicts)
+    else:
+        mapped_id_df = map_AGS_geneIDs(gene_id_df, filled_outpath, errors_fpath,tax_dict,journal=journal,
+                                       extra_tax_dicts=extra_tax_dicts)
+    from SSacquisition.SSdownload import configured_engine
+    entrez_engine = configured_engine(config, entrez_batch_params(NCBI_API_key)['requests_per_second'], 1)
+    if progress is not None:
+        progress.phase("NCBI", "downloading records")
+    if ncbi_config.getboolean("NCBIBatchedDownload", fallback=True):
+        ags_mapped_id_df = download_NCBI_species_batched(mapped_id_df, species_dirs, NCBI_API_key,
+                                                         pid_outpath=filled_outpath, engine=entrez_engine,
+                                                         journal=journal, compression=compression,
+                                                         compresslevel=compresslevel)
+    else:
+        ags_mapped_id_df = mapped_id_df
+        for species_tax_dict, NCBI_input_dir in species_dirs:
+            ags_mapped_id_df = download_NCBI_records(ags_mapped_id_df, NCBI_input_dir,species_tax_dict,NCBI_API_key,
+                                                     pid_outpath=filled_outpath,journal=journal,
+                                                     compression=compression,compresslevel=compresslevel,
+                                                     engine=entrez_engine)
+    entrez_engine.close()
+    journal.compact()
+    if progress is not None and tax_dict['pid_column'] in ags_mapped_id_df.columns:
+        progress.advance("NCBI", int(ags_mapped_id_df[tax_dict['pid_column']].notnull().sum()))
     return ags_mapped_id_df
 
 def single_NCBI_gid_query(driver,id_df,idx,hgid,tax_dict,
-                       id_out_fpath="",initial_timeout=1):
+                       id_out_fpath="",initial_timeout=1,extra_tax_dicts=[]):
     """For a human NCBI gene id, searches for ortholog gene ids corresponding to all taxids in taxid_columns.
     NOTE: Edited from spec_subs version of function to support multiple taxids per gene_id query
 
@@ -80,10 +118,16 @@ def single_NCBI_gid_query(driver,id_df,idx,hgid,tax_dict,
     species name for which NCBI ortholog GID is being queried
     :param (str) id_out_fpath: if provided, will write updated id_df as tsv to provided path.
     :param (int) initial_timeout: Initial timeout length for loading NCBI Gene orthologs page. Default 1
+    :param extra_tax_dicts: tax_dicts for additional species, read from the same orthologs page once it has loaded
+    (no errors are raised for missing additional species orthologs; their gid_column is left empty)
 
     :return: None. Edits id_df directly, or raises NCBIQueryError to log entries with no ortholog data for any species
     """
 
+    from selenium.common.exceptions import TimeoutException, NoSuchElementException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
     #Mammalian taxonomy level: 40674 - ensure this is a valid taxonomy identifier and encompasses all NCBI species
     # in analysis or all requests will fail to produce ortholog data
     taxonomy_level = '40674'
@@ -92,14 +136,16 @@ def single_NCBI_gid_query(driver,id_df,idx,hgid,tax_dict,
     driver_timeout = initial_timeout
     out_col = tax_dict['gid_column']
     spec_name = tax_dict['spec_name']
-    gene_xpath = "//tr/td/label/*[contains(text(), '{0}')]".format(spec_name) + \
-                 "/parent::label/parent::td/parent::tr/td[@class=' fld-gene']/a"
+    gene_xpath_format = "//tr/td/label/*[contains(text(), '{0}')]" + \
+                        "/parent::label/parent::td/parent::tr/td[@class=' fld-gene']/a"
+    gene_xpath = gene_xpath_format.format(spec_name)
     try:
         spec_elem = WebDriverWait(driver,driver_timeout).until(
             EC.presence_of_element_located((By.XPATH,gene_xpath))
         )
     except TimeoutException:
         id_df.loc[idx, out_col] = np.nan
+        extra_spec_gids(driver, id_df, idx, gene_xpath_format, extra_tax_dicts)
         #Check for generic ortholog table row elements (ie presence of any orthologs at all)
         generic_tr_xpath = "//tr/td/label"
         try:
@@ -115,11 +161,22 @@ def single_NCBI_gid_query(driver,id_df,idx,hgid,tax_dict,
         spec_href = spec_elem.get_attribute('href')
         spec_gid = re.search("/gene/(\d*)", spec_href).groups()[0]
         id_df.loc[idx,out_col] = spec_gid
+        extra_spec_gids(driver, id_df, idx, gene_xpath_format, extra_tax_dicts)
     if id_out_fpath:
         id_df.to_csv(id_out_fpath,sep='\t')
 
+def extra_spec_gids(driver, id_df, idx, gene_xpath_format, extra_tax_dicts):
+    #Reads additional species ortholog gene IDs from an already loaded NCBI Gene orthologs page
+    for extra_tax_dict in extra_tax_dicts:
+        elems = driver.find_elements_by_xpath(gene_xpath_format.format(extra_tax_dict['spec_name']))
+        if elems:
+            spec_gid = re.search("/gene/(\d*)", elems[0].get_attribute('href')).groups()[0]
+            id_df.loc[idx, extra_tax_dict['gid_column']] = spec_gid
+        else:
+            id_df.loc[idx, extra_tax_dict['gid_column']] = np.nan
+
 def map_AGS_geneIDs(id_df, results_outpath, errors_fpath, tax_dict,
-                    overwrite_gid=[]):
+                    overwrite_gid=[], journal=None, extra_tax_dicts=[]):
     """Reads a csv file at specified path, generates a new DataFrame containing AGS Gene IDs when available.
 
     :param id_df: DataFrame with gene symbol and NCBI Gene ID information.
@@ -133,6 +190,12 @@ def map_AGS_geneIDs(id_df, results_outpath, errors_fpath, tax_dict,
     :param errors_fpath:
     :param tax_dict:
     :param overwrite_gid:
+    :param journal: Optional SSjournal.AcquisitionJournal. If provided, each mapped gene ID is journaled (and gene IDs
+    journaled by interrupted runs are restored) and results_outpath is written once after all queries instead of
+    after every query.
+    :param extra_tax_dicts: tax_dicts for additional species (see SSconfig.NCBI_tax_dicts), mapped from the same
+    orthologs page load. Genes mapped before an additional species was configured are queried again once; with a
+    journal, their results (including species without orthologs) are journaled so they are not re-queried.
     :return:
     """
     driver = headless_driver()
@@ -144,12 +207,29 @@ def map_AGS_geneIDs(id_df, results_outpath, errors_fpath, tax_dict,
     else:
         out_id_df = id_df.copy()
         out_id_df.insert(loc=len(out_id_df.columns),column=gene_field_name)
-    check_error_file, NCBI_errors_df = load_errors(errors_fpath, error_type="NCBIQueryError")
+    for extra_tax_dict in extra_tax_dicts:
+        if extra_tax_dict['gid_column'] not in out_id_df.columns:
+            out_id_df.insert(loc=len(out_id_df.columns), column=extra_tax_dict['gid_column'], value=np.nan)
+    #Symbols needing a query for additional species only
+    missing_extra = pd.Series(False, index=out_id_df.index)
+    if journal is not None:
+        for species_tax_dict in [tax_dict] + extra_tax_dicts:
+            species_col = species_tax_dict['gid_column']
+            journaled_gids = journal.values(species_tax_dict['gid_source'])
+            restore = out_id_df[species_col].isnull() & out_id_df["gene_symbol"].isin(journaled_gids)
+            out_id_df.loc[restore, species_col] = out_id_df.loc[restore, "gene_symbol"].map(journaled_gids)
+            out_id_df.loc[out_id_df[species_col] == "", species_col] = np.nan
+            if species_tax_dict is not tax_dict:
+                missing_extra |= ~out_id_df["gene_symbol"].isin(journaled_gids)
+    else:
+        for extra_tax_dict in extra_tax_dicts:
+            missing_extra |= out_id_df[extra_tax_dict['gid_column']].isnull()
+    errors = error_registry(errors_fpath)
     #Determine rows missing gene_field_name and rows missing human_gene_id
     # if gene_field_name not in out_id_df.columns:
     #     missing_spec_gid = out_id_df
     # else:
-    missing_spec_gid = out_id_df.loc[out_id_df[gene_field_name].isnull(), :]
+    missing_spec_gid = out_id_df.loc[out_id_df[gene_field_name].isnull() | missing_extra, :]
     missing_hgid = missing_spec_gid.loc[missing_spec_gid["human_gene_id"].isnull(), :]
     #Iterate over id DataFrame, query NCBI Gene Orthologs if overwrite_gid or if missing
     for idx, row in out_id_df.iterrows():
@@ -157,22 +237,147 @@ def map_AGS_geneIDs(id_df, results_outpath, errors_fpath, tax_dict,
         hgid = row["human_gene_id"]
         #Query if force overwrite of data using overwrite_gid or if missing
         if symbol in overwrite_gid or idx in missing_spec_gid.index:
-            if check_error_file and symbol in NCBI_errors_df["gene_symbol"].unique():
-                print_errors(NCBI_errors_df,symbol)
+            if errors.has(symbol, error_type="NCBIQueryError"):
+                errors.print_gene(symbol, error_type="NCBIQueryError")
             elif idx in missing_hgid.index:
                 rd_error = RecordDataError(1,"No Human GeneID present in data")
                 write_errors(errors_fpath,symbol,rd_error)
                 continue
             else:
+                id_out_fpath = results_outpath if journal is None else ""
                 try:
-                    single_NCBI_gid_query(driver,out_id_df,idx,hgid,tax_dict,id_out_fpath=results_outpath)
+                    single_NCBI_gid_query(driver,out_id_df,idx,hgid,tax_dict,id_out_fpath=id_out_fpath,
+                                          extra_tax_dicts=extra_tax_dicts)
                 except NCBIQueryError as ncbi_error:
                     write_errors(errors_fpath,symbol,ncbi_error)
+                else:
+                    if journal is not None:
+                        journal.record("NCBI_gid", symbol, value=out_id_df.loc[idx, gene_field_name])
+                if journal is not None:
+                    #Additional species without orthologs are journaled with empty values so they aren't re-queried
+                    for extra_tax_dict in extra_tax_dicts:
+                        extra_gid = out_id_df.loc[idx, extra_tax_dict['gid_column']]
+                        journal.record(extra_tax_dict['gid_source'], symbol,
+                                       value="" if pd.isnull(extra_gid) else extra_gid)
+    if journal is not None:
+        out_id_df.to_csv(results_outpath, sep='\t')
+    return out_id_df
+
+def orthologs_index_path(orthologs_fpath, human_taxid="9606"):
+    #Default on-disk index location, stored next to the gene_orthologs file it was built from
+    return "{0}.{1}.index.pkl".format(orthologs_fpath, human_taxid)
+
+def build_orthologs_index(orthologs_fpath, index_fpath="", human_taxid="9606", chunksize=10**6):
+    """Ingests NCBI's tab-separated gene_orthologs bulk file (https://ftp.ncbi.nlm.nih.gov/gene/DATA/gene_orthologs.gz,
+    plain or gzipped) into a DataFrame of all ortholog pairs involving a human gene, indexed on human_gene_id, and
+    stores it at index_fpath. Pairs are read in both directions since gene_orthologs lists each pair once.
+
+    gene_orthologs columns: #tax_id, GeneID, relationship, Other_tax_id, Other_GeneID
+
+    :param orthologs_fpath: local path to gene_orthologs file
+    :param index_fpath: path for pickled index. Defaults to orthologs_index_path(orthologs_fpath)
+    :param human_taxid: NCBI taxonomy ID used as the index key species
+    :param chunksize: number of lines parsed at a time (the full file has ~20M lines)
+    :return: orthologs_index: DataFrame (index human_gene_id; columns other_tax_id, other_gene_id), all values str
+    """
+    if not index_fpath:
+        index_fpath = orthologs_index_path(orthologs_fpath, human_taxid)
+    col_names = ['tax_id', 'gene_id', 'relationship', 'other_tax_id', 'other_gene_id']
+    chunks = pd.read_csv(orthologs_fpath, sep='\t', comment='#', header=None, names=col_names, dtype=str,
+                         chunksize=chunksize)
+    pair_dfs = []
+    for chunk in chunks:
+        forward = chunk.loc[chunk['tax_id'] == human_taxid, ['gene_id', 'other_tax_id', 'other_gene_id']]
+        reverse = chunk.loc[chunk['other_tax_id'] == human_taxid, ['other_gene_id', 'tax_id', 'gene_id']]
+        reverse.columns = forward.columns
+        pair_dfs.extend([forward, reverse])
+    orthologs_index = pd.concat(pair_dfs, ignore_index=True).drop_duplicates()
+    orthologs_index = orthologs_index.rename(columns={'gene_id':'human_gene_id'}).set_index('human_gene_id')
+    orthologs_index = orthologs_index.sort_index()
+    orthologs_index.to_pickle(index_fpath)
+    return orthologs_index
+
+def load_orthologs_index(orthologs_fpath, index_fpath="", human_taxid="9606"):
+    """Loads the human gene ortholog index for orthologs_fpath, (re)building it with build_orthologs_index if the
+    index is missing or older than orthologs_fpath."""
+    if not index_fpath:
+        index_fpath = orthologs_index_path(orthologs_fpath, human_taxid)
+    if os.path.exists(index_fpath) and os.path.getmtime(index_fpath) >= os.path.getmtime(orthologs_fpath):
+        return pd.read_pickle(index_fpath)
+    return build_orthologs_index(orthologs_fpath, index_fpath, human_taxid)
+
+def map_AGS_geneIDs_offline(id_df, results_outpath, errors_fpath, tax_dict, orthologs_fpath,
+                            overwrite_gid=[], extra_tax_dicts=[]):
+    """Browserless version of map_AGS_geneIDs. Resolves ortholog gene IDs for tax_dict['taxid'] for every pending row
+    of id_df with one join against the gene_orthologs index (see load_orthologs_index). Fills the same
+    tax_dict['gid_column'] column and logs the same NCBIQueryError codes as single_NCBI_gid_query:
+    0 - no orthologs for the human gene ID at all, 1 - orthologs exist but none for tax_dict['taxid'].
+
+    :param id_df: DataFrame with gene_symbol and human_gene_id columns
+    :param results_outpath: file path to DataFrame where mapped ortholog Gene IDs will be stored
+    :param errors_fpath: errors table path (see SSerrors.write_errors)
+    :param tax_dict: maps 'gid_column' to output column label and 'taxid' to the NCBI taxonomy ID to map to
+    :param orthologs_fpath: local path to NCBI gene_orthologs file
+    :param overwrite_gid: gene symbols to re-map even if a gene ID is already present
+    :param extra_tax_dicts: tax_dicts for additional species, mapped in the same pass. Missing orthologs for additional
+    species leave their gid_column empty without logging errors.
+    :return: out_id_df: DataFrame with tax_dict['gid_column'] populated where orthologs are available
+    """
+    gene_field_name, taxid = tax_dict['gid_column'], str(tax_dict['taxid'])
+    if os.path.exists(results_outpath):
+        out_id_df = pd.read_csv(results_outpath, dtype=str, index_col="overall_index", sep='\t')
+    else:
+        out_id_df = id_df.copy()
+    if gene_field_name not in out_id_df.columns:
+        out_id_df.insert(loc=len(out_id_df.columns), column=gene_field_name, value=np.nan)
+    errors = error_registry(errors_fpath)
+    pending = out_id_df[gene_field_name].isnull() | out_id_df["gene_symbol"].isin(overwrite_gid)
+    logged = out_id_df["gene_symbol"].map(lambda symbol: errors.has(symbol, error_type="NCBIQueryError"))
+    for symbol in out_id_df.loc[pending & logged, "gene_symbol"]:
+        errors.print_gene(symbol, error_type="NCBIQueryError")
+    pending &= ~logged
+    missing_hgid = pending & out_id_df["human_gene_id"].isnull()
+    with errors.batch():
+        for symbol in out_id_df.loc[missing_hgid, "gene_symbol"]:
+            write_errors(errors_fpath, symbol, RecordDataError(1, "No Human GeneID present in data"))
+    pending &= ~missing_hgid
+
+    orthologs_index = load_orthologs_index(orthologs_fpath)
+
+    def spec_orthologs(spec_taxid):
+        spec_srs = orthologs_index.loc[orthologs_index['other_tax_id'] == spec_taxid, 'other_gene_id']
+        #Keep one ortholog gene ID per human gene ID (numerically lowest ID if several are listed for the species)
+        numeric_ids = lambda gene_ids: pd.to_numeric(gene_ids, errors='coerce')
+        return spec_srs.sort_values(key=numeric_ids).groupby(level=0).first()
+    for extra_tax_dict in extra_tax_dicts:
+        extra_col = extra_tax_dict['gid_column']
+        if extra_col not in out_id_df.columns:
+            out_id_df.insert(loc=len(out_id_df.columns), column=extra_col, value=np.nan)
+        extra_pending = (out_id_df[extra_col].isnull() | out_id_df["gene_symbol"].isin(overwrite_gid)) & \
+                        out_id_df["human_gene_id"].notnull()
+        extra_hgids = out_id_df.loc[extra_pending, "human_gene_id"].astype(str)
+        out_id_df.loc[extra_hgids.index, extra_col] = extra_hgids.map(spec_orthologs(str(extra_tax_dict['taxid'])))
+    pending_hgids = out_id_df.loc[pending, "human_gene_id"].astype(str)
+    mapped = pending_hgids.map(spec_orthologs(taxid))
+    out_id_df.loc[mapped.index, gene_field_name] = mapped
+    unmapped = mapped.index[mapped.isnull()]
+    any_orthologs = pending_hgids[unmapped].isin(orthologs_index.index)
+    with errors.batch():
+        for idx in unmapped:
+            symbol, hgid = out_id_df.loc[idx, "gene_symbol"], pending_hgids[idx]
+            if any_orthologs[idx]:
+                error_msg = "No AGS ortholog present for provided Human Gene ID: {0}".format(hgid)
+                write_errors(errors_fpath, symbol, NCBIQueryError(1, error_msg))
+            else:
+                error_msg = "No orthologs available for NCBI hgid {0}".format(hgid)
+                write_errors(errors_fpath, symbol, NCBIQueryError(0, error_msg))
+    out_id_df.to_csv(results_outpath, sep='\t')
     return out_id_df
 
 
 def download_NCBI_records(id_df, NCBI_records_dirpath,tax_dict, NCBI_API_key,
-                          overwrite_fasta=[],pid_outpath=''):
+                          overwrite_fasta=[],pid_outpath='',journal=None,compression=None,compresslevel=None,
+                          engine=None):
     """Downloads NCBI protein records for each NCBI Gene ID listed in ags_mapped_id_df.
 
     :param: id_df: DataFrame object with required columns 'Gene Symbol' and 'AGS Gene ID.' Gene symbol
@@ -183,47 +388,261 @@ def download_NCBI_records(id_df, NCBI_records_dirpath,tax_dict, NCBI_API_key,
     :param gene_field_name: column name in ags_mapped_id_df where ortholog IDs are stored
     :param protein_field_name: column name in ags_mapped_id_df where linked Protein ID(s) will be stored as comma separated list
     :param NCBI_API_key: Must be valid API key or empty string
+    :param journal: Optional SSjournal.AcquisitionJournal. If provided, symbols journaled as complete with intact
+    fastas are skipped (their protein IDs restored from the journal) and each download is journaled.
+    :param compression: Optional 'gzip' or 'zstd' compression for downloaded fastas (see SSutility.SScompress)
+    :param engine: Optional SSdownload.DownloadEngine for Entrez requests; defaults to an engine at the Entrez request
+    rate which retries transient failures. Symbols whose requests still fail are skipped until the next run.
 
     :return: modified ags_mapped_id_df containing a populated protein_field_name column with linked Protein IDs. Will download
     corresponding Protein Sequences to files named by gene symbol into directory specified by NCBI_records_dirpath
     """
-    import subprocess
     import requests
     import xml.etree.ElementTree as ET
+    from SSacquisition.SSdownload import DownloadEngine, RetryPolicy
 
-    ENTREZ_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
-    api_key_ext = ""
-    if NCBI_API_key:
-        #Default value will be empty string if NCBIAPIKey field is empty or absent in config file, defaults
-        #to making API requests without API key
-        api_key_ext = "&api_key={0}".format(NCBI_API_key)
+    close_engine = engine is None
+    if engine is None:
+        engine = DownloadEngine(requests_per_second=entrez_batch_params(NCBI_API_key)['requests_per_second'],
+                                max_workers=1, retry=RetryPolicy())
+    key_params = {'api_key':NCBI_API_key} if NCBI_API_key else {}
     gene_field_name, protein_field_name = tax_dict['gid_column'],tax_dict['pid_column']
+    records_source = tax_dict.get('records_source', "NCBI_records")
     ags_mapped_df = id_df.loc[~id_df[gene_field_name].isnull(), :]
     # Convert Gene ID to list of Protein IDs corresponding to transcript variant sequences
     for idx, row in ags_mapped_df.iterrows():
         symbol = row["gene_symbol"]
         fasta_fpath = "{0}/{1}.fasta".format(NCBI_records_dirpath, symbol)
-        if not os.path.exists(fasta_fpath) or symbol in overwrite_fasta:
+        if not fasta_downloaded(journal, symbol, fasta_fpath, id_df, idx, protein_field_name, records_source) \
+                or symbol in overwrite_fasta:
             AGS_gid = row[gene_field_name]
-            # print("==={0}===".format(symbol))
-            # print("AGS Gene ID: {0}".format(AGS_gid))
-            elink_req = "elink.fcgi?dbfrom=gene&db=protein&id={0}{1}".format(AGS_gid, api_key_ext)
-            gp_elink_url = ENTREZ_BASE_URL + elink_req
-
-            elink_response = requests.get(gp_elink_url)
-            xml_data = elink_response.content
-            root = ET.fromstring(xml_data)
-            # Check XML formatting of elink pages - update xpath accordingly if functionality breaks
-            # Pulls Record IDs for Protein specifically; use gene_protein_refseq for Protein RefSeqs
-            protein_IDs = [link.text for link in root.findall(".//LinkSetDb[LinkName='gene_protein']/Link/Id")]
-            id_str = ','.join(protein_IDs)
-            id_df.loc[idx, protein_field_name] = id_str
-
-            efetch_req = "efetch.fcgi?db=protein&id={0}&rettype=fasta&retmode=text{1}".format(id_str,api_key_ext)
-            efetch_url = ENTREZ_BASE_URL + efetch_req
-            subprocess.run(args=['wget', efetch_url, '-O', fasta_fpath])
-            if pid_outpath:
-                id_df.to_csv(pid_outpath, sep='\t')
+            try:
+                elink_params = dict(key_params, dbfrom='gene', db='protein', id=AGS_gid)
+                elink_response = engine.get(ENTREZ_BASE_URL + "elink.fcgi", params=elink_params)
+                elink_response.raise_for_status()
+                root = ET.fromstring(elink_response.content)
+                # Check XML formatting of elink pages - update xpath accordingly if functionality breaks
+                # Pulls Record IDs for Protein specifically; use gene_protein_refseq for Protein RefSeqs
+                protein_IDs = [link.text for link in root.findall(".//LinkSetDb[LinkName='gene_protein']/Link/Id")]
+                id_str = ','.join(protein_IDs)
+                id_df.loc[idx, protein_field_name] = id_str
+                if not protein_IDs:
+                    continue
+                efetch_params = dict(key_params, db='protein', id=id_str, rettype='fasta', retmode='text')
+                engine.download(ENTREZ_BASE_URL + "efetch.fcgi", fasta_fpath, params=efetch_params,
+                                compression=compression, compresslevel=compresslevel)
+            except requests.RequestException as e:
+                #Not journaled, so the symbol is downloaded again next run
+                print("{0}\tNCBI request failed: {1}".format(symbol, e))
+                continue
+            if journal is not None:
+                journal.record(records_source, symbol, fpath=fasta_fpath, value=id_str)
+    if close_engine:
+        engine.close()
+    if pid_outpath:
+        id_df.to_csv(pid_outpath, sep='\t')
     return id_df
 
+def fasta_downloaded(journal, symbol, fasta_fpath, id_df, idx, protein_field_name, source="NCBI_records"):
+    """Returns True if NCBI records for symbol were already downloaded to fasta_fpath. With a journal, the fasta must
+    be journaled (under source, see SSconfig.NCBI_tax_dicts) as complete and intact, and protein IDs missing from id_df
+    are restored from the journal; without one, an existing fasta_fpath is trusted."""
+    if journal is None:
+        return os.path.exists(fasta_fpath)
+    if not journal.is_complete(source, symbol, fasta_fpath):
+        return False
+    entry = journal.entry(source, symbol)
+    if entry['value'] and (protein_field_name not in id_df.columns or pd.isnull(id_df.loc[idx, protein_field_name])):
+        id_df.loc[idx, protein_field_name] = entry['value']
+    return True
+
+def entrez_batch_params(NCBI_API_key):
+    """Request rate and batch sizes for Entrez E-utilities. NCBI allows 10 requests/second with an API key and 3
+    without; batch sizes scale with the allowed rate so keyed runs use fewer, larger requests.
 
+    :param NCBI_API_key: NCBIAPIKey value from config (empty string if not provided)
+    :return: (dict) with keys 'requests_per_second', 'elink_batch' (gene IDs per elink request) and 'efetch_batch'
+    (records per efetch request)
+    """
+    if NCBI_API_key:
+        return {'requests_per_second':10, 'elink_batch':500, 'efetch_batch':500}
+    else:
+        return {'requests_per_second':3, 'elink_batch':200, 'efetch_batch':200}
+
+def parse_elink_linksets(xml_data, link_name="gene_protein"):
+    """Parses an elink response for a request with one id parameter per gene ID (one LinkSet per gene ID).
+
+    :param xml_data: elink XML response content
+    :param link_name: LinkName of LinkSetDb to read linked IDs from. gene_protein for all Protein records, use
+    gene_protein_refseq for Protein RefSeqs only
+    :return: (dict) mapping each queried gene ID to its (ordered) list of linked protein UIDs
+    """
+    import xml.etree.ElementTree as ET
+    root = ET.fromstring(xml_data)
+    linked = {}
+    for linkset in root.findall("LinkSet"):
+        gid = linkset.find("IdList/Id").text
+        linked[gid] = [link.text for link in linkset.findall("LinkSetDb[LinkName='{0}']/Link/Id".format(link_name))]
+    return linked
+
+def parse_tseq_records(xml_data):
+    """Parses an efetch rettype=fasta retmode=xml (TSeqSet) response.
+
+    :return: (dict) mapping protein UID (TSeq_gi) to a FASTA formatted record string, with the same header format
+    (">accession.version defline") and 70 character line wrapping as efetch text FASTA output.
+    """
+    import xml.etree.ElementTree as ET
+    root = ET.fromstring(xml_data)
+    records = {}
+    for tseq in root.findall("TSeq"):
+        uid, accver = tseq.findtext("TSeq_gi"), tseq.findtext("TSeq_accver")
+        defline, seq = tseq.findtext("TSeq_defline"), tseq.findtext("TSeq_sequence")
+        seq_lines = [seq[i:i+70] for i in range(0, len(seq), 70)]
+        records[uid] = ">{0} {1}\n{2}\n".format(accver, defline, "\n".join(seq_lines))
+    return records
+
+def download_NCBI_records_batched(id_df, NCBI_records_dirpath, tax_dict, NCBI_API_key,
+                                  overwrite_fasta=[], pid_outpath='', engine=None, journal=None,
+                                  compression=None, compresslevel=None):
+    """Batched version of download_NCBI_records. Gene IDs are linked to Protein UIDs with one elink request per
+    batch of gene IDs, the linked UIDs are posted to the Entrez history server (epost) and fetched in large efetch
+    batches (WebEnv/query_key). The combined records are split back into one fasta per gene symbol in
+    NCBI_records_dirpath. pid_outpath (if provided) is written once after all downloads.
+
+    :param id_df: DataFrame with columns gene_symbol and tax_dict['gid_column']
+    :param NCBI_records_dirpath: directory path where NCBI input data will be downloaded
+    :param tax_dict: maps 'gid_column' and 'pid_column' to id_df column labels
+    :param NCBI_API_key: Must be valid API key or empty string; determines request rate and batch sizes
+    :param engine: Optional SSdownload.DownloadEngine. Defaults to an engine with the Entrez request rate.
+    :param journal: Optional SSjournal.AcquisitionJournal, see download_NCBI_records
+    :param compression: Optional 'gzip' or 'zstd' compression for written fastas (see SSutility.SScompress)
+    :return: id_df with tax_dict['pid_column'] populated for downloaded gene symbols
+    """
+    return download_NCBI_species_batched(id_df, [(tax_dict, NCBI_records_dirpath)], NCBI_API_key,
+                                         overwrite_fasta=overwrite_fasta, pid_outpath=pid_outpath, engine=engine,
+                                         journal=journal, compression=compression, compresslevel=compresslevel)
+
+def download_NCBI_species_batched(id_df, species_dirs, NCBI_API_key, overwrite_fasta=[], pid_outpath='',
+                                  engine=None, journal=None, compression=None, compresslevel=None):
+    """download_NCBI_records_batched for several NCBI species at once: gene IDs of all species share the same elink
+    batches and linked protein UIDs the same epost/ efetch requests, so additional species add records to each
+    request rather than another pass over the gene list.
+
+    :param species_dirs: list of (tax_dict, NCBI_records_dirpath) pairs, one per species (see
+    SSconfig.NCBI_tax_dicts); records are journaled under tax_dict['records_source'] (default NCBI_records)
+    :return: id_df with each tax_dict['pid_column'] populated for downloaded gene symbols
+    """
+    from SSacquisition.SSdownload import DownloadEngine
+    batch_params = entrez_batch_params(NCBI_API_key)
+    close_engine = engine is None
+    if engine is None:
+        engine = DownloadEngine(requests_per_second=batch_params['requests_per_second'],max_workers=1)
+    key_params = {'api_key':NCBI_API_key} if NCBI_API_key else {}
+    #Gene ID -> (species, row index) pairs still needing downloads (one gene ID can be shared by multiple symbols)
+    gid_rows = {}
+    for species_i, (tax_dict, NCBI_records_dirpath) in enumerate(species_dirs):
+        gene_field_name, protein_field_name = tax_dict['gid_column'], tax_dict['pid_column']
+        records_source = tax_dict.get('records_source', "NCBI_records")
+        if gene_field_name not in id_df.columns:
+            continue
+        ags_mapped_df = id_df.loc[~id_df[gene_field_name].isnull(), :]
+        for idx, row in ags_mapped_df.iterrows():
+            fasta_fpath = "{0}/{1}.fasta".format(NCBI_records_dirpath, row["gene_symbol"])
+            if not fasta_downloaded(journal, row["gene_symbol"], fasta_fpath, id_df, idx, protein_field_name,
+                                    records_source) or row["gene_symbol"] in overwrite_fasta:
+                gid_rows.setdefault(str(row[gene_field_name]), []).append((species_i, idx))
+    if not gid_rows:
+        if pid_outpath:
+            id_df.to_csv(pid_outpath, sep='\t')
+        return id_df
+    #Requests failing after the engine's retries (or returning unparseable bodies, ie Entrez error pages sent with
+    #HTTP 200) only skip the gene IDs/ records they cover; those symbols are not journaled and are downloaded again
+    #next run
+    import requests
+    from xml.etree.ElementTree import ParseError
+    failed_gids, failed_uids = set(), set()
+    #1) elink: many gene IDs per request (POST, separate id parameters keep one LinkSet per gene ID)
+    gene_ids = list(gid_rows.keys())
+    linked = {}
+    for i in range(0, len(gene_ids), batch_params['elink_batch']):
+        batch_ids = gene_ids[i:i+batch_params['elink_batch']]
+        elink_data = dict(key_params, dbfrom='gene', db='protein', id=batch_ids)
+        try:
+            response = engine.post(ENTREZ_BASE_URL+"elink.fcgi", data=elink_data)
+            response.raise_for_status()
+            linked.update(parse_elink_linksets(response.content))
+        except (requests.RequestException, ParseError) as e:
+            print("Entrez elink request failed for {0} gene IDs: {1}".format(len(batch_ids), e))
+            failed_gids.update(batch_ids)
+    all_uids = list(dict.fromkeys(uid for gid in gene_ids for uid in linked.get(gid, [])))
+    #2) epost linked protein UIDs to history server, 3) efetch in retmax sized batches from WebEnv
+    #With an HTTP cache, efetch is requested by explicit UID batches instead: WebEnv keys change every session so
+    #history server responses could never be served from the cache.
+    records = {}
+    if all_uids and engine.cache is not None:
+        for i in range(0, len(all_uids), batch_params['efetch_batch']):
+            batch_uids = all_uids[i:i+batch_params['efetch_batch']]
+            efetch_data = dict(key_params, db='protein', id=",".join(batch_uids), rettype='fasta', retmode='xml')
+            try:
+                response = engine.post(ENTREZ_BASE_URL+"efetch.fcgi", data=efetch_data)
+                response.raise_for_status()
+                records.update(parse_tseq_records(response.content))
+            except (requests.RequestException, ParseError) as e:
+                print("Entrez efetch request failed for {0} records: {1}".format(len(batch_uids), e))
+                failed_uids.update(batch_uids)
+    elif all_uids:
+        import xml.etree.ElementTree as ET
+        epost_data = dict(key_params, db='protein', id=",".join(all_uids))
+        try:
+            response = engine.post(ENTREZ_BASE_URL+"epost.fcgi", data=epost_data, cache=False)
+            response.raise_for_status()
+            epost_root = ET.fromstring(response.content)
+        except (requests.RequestException, ParseError) as e:
+            print("Entrez epost request failed for {0} records: {1}".format(len(all_uids), e))
+            failed_uids.update(all_uids)
+        else:
+            web_env, query_key = epost_root.findtext("WebEnv"), epost_root.findtext("QueryKey")
+            #The history server doesn't guarantee epost order, so a failed retstart batch can't be mapped to UIDs;
+            #records are matched by the TSeq_gi values returned and genes with missing records are retried (below)
+            for retstart in range(0, len(all_uids), batch_params['efetch_batch']):
+                efetch_params = dict(key_params, db='protein', WebEnv=web_env, query_key=query_key,
+                                     rettype='fasta', retmode='xml', retstart=retstart,
+                                     retmax=batch_params['efetch_batch'])
+                try:
+                    response = engine.get(ENTREZ_BASE_URL+"efetch.fcgi", params=efetch_params)
+                    response.raise_for_status()
+                    records.update(parse_tseq_records(response.content))
+                except (requests.RequestException, ParseError) as e:
+                    print("Entrez efetch request failed for history records {0}-{1}: {2}".format(
+                        retstart, min(retstart+batch_params['efetch_batch'], len(all_uids)) - 1, e))
+    #Split combined records back into per-symbol fastas (record order follows elink order)
+    for gid, row_idxs in gid_rows.items():
+        protein_IDs = linked.get(gid, [])
+        if gid in failed_gids or failed_uids.intersection(protein_IDs):
+            continue
+        #Records efetch didn't return (ie withdrawn or suppressed UIDs, truncated responses): a partial fasta would be
+        #journaled as complete and never downloaded again, so the gene is retried next run instead
+        missing_uids = [uid for uid in protein_IDs if uid not in records]
+        if missing_uids:
+            print("Entrez efetch returned no records for protein UIDs {0} (gene ID {1})".format(
+                ",".join(missing_uids), gid))
+            continue
+        id_str = ','.join(protein_IDs)
+        for species_i, idx in row_idxs:
+            tax_dict, NCBI_records_dirpath = species_dirs[species_i]
+            records_source = tax_dict.get('records_source', "NCBI_records")
+            id_df.loc[idx, tax_dict['pid_column']] = id_str
+            if not protein_IDs:
+                continue
+            symbol = id_df.loc[idx, "gene_symbol"]
+            fasta_fpath = "{0}/{1}.fasta".format(NCBI_records_dirpath, symbol)
+            with atomic_write(fasta_fpath, compression=compression, compresslevel=compresslevel) as fasta_f:
+                for uid in protein_IDs:
+                    fasta_f.write(records[uid])
+            if journal is not None:
+                journal.record(records_source, symbol, fpath=fasta_fpath, value=id_str)
+    if pid_outpath:
+        id_df.to_csv(pid_outpath, sep='\t')
+    if close_engine:
+        engine.close()
+    return id_df
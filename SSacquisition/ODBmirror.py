@@ -0,0 +1,288 @@
+#ODBmirror.py - Local OrthoDB mirror built from OrthoDB bulk data dumps, answers ODB_query without the OrthoDB API
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import gzip
+import json
+import sqlite3
+from urllib.parse import parse_qs
+import pandas as pd
+from SSutility.SSerrors import OrthoDBQueryError
+from SSutility.SSjournal import atomic_write
+
+#Columns of the OrthoDB API tab output, written in the same order for mirror queries
+ODB_TSV_COLUMNS = ['pub_og_id', 'og_name', 'level_taxid', 'organism_taxid', 'organism_name', 'int_prot_id',
+                   'pub_gene_id', 'description']
+#gene_xrefs external databases which aren't gene names/ identifiers; not indexed as query keys
+UNKEYED_XREF_DBS = ['GOterm', 'InterPro', 'EC']
+#Default maximum number of OGs a query may match before raising OrthoDBQueryError(1), analogous to the API refusing
+#queries which yield too many clusters
+DEFAULT_MAX_CLUSTERS = 20
+
+MIRROR_SCHEMA = """
+CREATE TABLE species (organism_taxid TEXT PRIMARY KEY, tax_id INTEGER, organism_name TEXT);
+CREATE TABLE ogs (pub_og_id TEXT PRIMARY KEY, level_taxid INTEGER, og_name TEXT);
+CREATE TABLE og2genes (pub_og_id TEXT, int_prot_id TEXT);
+CREATE TABLE genes (int_prot_id TEXT PRIMARY KEY, organism_taxid TEXT, pub_gene_id TEXT, description TEXT);
+CREATE TABLE gene_keys (key TEXT, int_prot_id TEXT);
+CREATE TABLE seqs (int_prot_id TEXT PRIMARY KEY, seq TEXT);
+"""
+MIRROR_INDICES = """
+CREATE INDEX og2genes_og ON og2genes (pub_og_id);
+CREATE INDEX og2genes_gene ON og2genes (int_prot_id);
+CREATE INDEX gene_keys_key ON gene_keys (key);
+CREATE INDEX species_tax_id ON species (tax_id);
+"""
+
+
+def open_dump(fpath):
+    #Opens OrthoDB dump files as text, transparently decompressing .gz dumps as downloaded from OrthoDB
+    if fpath.endswith(".gz"):
+        return gzip.open(fpath, 'rt')
+    return open(fpath, 'rt')
+
+
+def read_dump_rows(fpath):
+    #Yields tab split fields for each non-empty line of an OrthoDB tab dump
+    with open_dump(fpath) as dump_f:
+        for line in dump_f:
+            line = line.rstrip('\n')
+            if line:
+                yield line.split('\t')
+
+
+def parse_gene_row(fields):
+    """Parses one line of an OrthoDB genes dump into (int_prot_id, organism_taxid, pub_gene_id, description, keys).
+
+    odb10v1_genes.tab (9 columns):
+    1. Ortho DB unique gene id; 2. organism tax id; 3. protein original sequence id; 4. pub gene id;
+    5. synonyms; 6. UniProt id; 7. semicolon separated Ensembl ids; 8. NCBI gid or gene name; 9. description
+    odb10v0_genes.tab (8 columns) lacks the pub gene id column; NCBI gid or gene name is used as pub_gene_id.
+    keys contains lower-cased gene names/ ids under which the gene can be queried.
+    """
+    if len(fields) >= 9:
+        int_prot_id, organism_taxid, orig_id, pub_gene_id, synonyms, uniprot_id, ensembl_ids, ncbi_id, description = \
+            fields[:9]
+    else:
+        fields = fields + [''] * (8 - len(fields))
+        int_prot_id, organism_taxid, orig_id, synonyms, uniprot_id, ensembl_ids, ncbi_id, description = fields[:8]
+        pub_gene_id = ncbi_id
+    keys = set()
+    for key_field in [pub_gene_id, synonyms, ensembl_ids]:
+        keys.update(key for key in key_field.split(';'))
+    keys.update([orig_id, uniprot_id, ncbi_id])
+    keys = set(key.strip().lower() for key in keys if key.strip())
+    return int_prot_id, organism_taxid, pub_gene_id, description, keys
+
+
+def build_ODB_mirror(db_fpath, species_fpath, OGs_fpath, OG2genes_fpath, genes_fpath, fasta_fpath,
+                     xrefs_fpath=None, levels=None, batch_size=100000):
+    """Builds a SQLite OrthoDB mirror at db_fpath from OrthoDB bulk data dumps (plain or .gz). The mirror is built in
+    a temporary file and moved into place once complete.
+
+    :param species_fpath: odbN_species.tab (NCBI tax id, OrthoDB organism id, scientific name, ...)
+    :param OGs_fpath: odbN_OGs.tab (OG id, level tax id on which the group was built, OG name)
+    :param OG2genes_fpath: odbN_OG2genes.tab (OG id, OrthoDB gene id)
+    :param genes_fpath: odbN_genes.tab, see parse_gene_row
+    :param fasta_fpath: odbN_aa_fasta, protein sequences with OrthoDB gene ids as the first header token
+    :param xrefs_fpath: Optional odbN_gene_xrefs.tab (OrthoDB gene id, external id, external DB); external ids become
+    additional query keys for their gene.
+    :param (array-like) levels: If provided, only OGs built on these level tax ids (and their genes/ sequences) are
+    stored, which keeps mirrors of single clades (ie 40674, Mammalia) small.
+    :return: N/A. Mirror written to db_fpath.
+    """
+    tmp_fpath = "{0}.tmp".format(db_fpath)
+    if os.path.exists(tmp_fpath):
+        os.remove(tmp_fpath)
+    db_dir = os.path.dirname(db_fpath)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    levels = set(int(level) for level in levels) if levels is not None else None
+    conn = sqlite3.connect(tmp_fpath)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.executescript(MIRROR_SCHEMA)
+
+    def insert_batched(sql, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                conn.executemany(sql, batch)
+                batch = []
+        if batch:
+            conn.executemany(sql, batch)
+
+    species_rows = ((fields[1], int(fields[0]), fields[2]) for fields in read_dump_rows(species_fpath))
+    insert_batched("INSERT OR REPLACE INTO species VALUES (?,?,?)", species_rows)
+    og_ids = set()
+
+    def og_rows():
+        for fields in read_dump_rows(OGs_fpath):
+            if levels is None or int(fields[1]) in levels:
+                og_ids.add(fields[0])
+                yield fields[0], int(fields[1]), fields[2] if len(fields) > 2 else ''
+    insert_batched("INSERT OR REPLACE INTO ogs VALUES (?,?,?)", og_rows())
+    #Genes/ sequences are only stored if they belong to a stored OG
+    gene_ids = set()
+
+    def og2gene_rows():
+        for fields in read_dump_rows(OG2genes_fpath):
+            if fields[0] in og_ids:
+                gene_ids.add(fields[1])
+                yield fields[0], fields[1]
+    insert_batched("INSERT INTO og2genes VALUES (?,?)", og2gene_rows())
+    gene_batch, key_batch = [], []
+    for fields in read_dump_rows(genes_fpath):
+        int_prot_id, organism_taxid, pub_gene_id, description, keys = parse_gene_row(fields)
+        if int_prot_id not in gene_ids:
+            continue
+        gene_batch.append((int_prot_id, organism_taxid, pub_gene_id, description))
+        key_batch.extend((key, int_prot_id) for key in keys)
+        if len(gene_batch) >= batch_size:
+            conn.executemany("INSERT OR REPLACE INTO genes VALUES (?,?,?,?)", gene_batch)
+            conn.executemany("INSERT INTO gene_keys VALUES (?,?)", key_batch)
+            gene_batch, key_batch = [], []
+    conn.executemany("INSERT OR REPLACE INTO genes VALUES (?,?,?,?)", gene_batch)
+    conn.executemany("INSERT INTO gene_keys VALUES (?,?)", key_batch)
+    if xrefs_fpath:
+        xref_rows = ((fields[1].strip().lower(), fields[0]) for fields in read_dump_rows(xrefs_fpath)
+                     if fields[0] in gene_ids and len(fields) > 2 and fields[2] not in UNKEYED_XREF_DBS)
+        insert_batched("INSERT INTO gene_keys VALUES (?,?)", xref_rows)
+    insert_batched("INSERT OR REPLACE INTO seqs VALUES (?,?)",
+                   ((prot_id, seq) for prot_id, seq in read_fasta_dump(fasta_fpath) if prot_id in gene_ids))
+    #Indices are created after bulk inserts, which is much faster than maintaining them during the inserts
+    conn.executescript(MIRROR_INDICES)
+    conn.commit()
+    conn.close()
+    os.replace(tmp_fpath, db_fpath)
+
+
+def read_fasta_dump(fasta_fpath):
+    #Yields (OrthoDB gene id, sequence) from the aa_fasta dump
+    prot_id, seq_lines = None, []
+    with open_dump(fasta_fpath) as fasta_f:
+        for line in fasta_f:
+            line = line.strip()
+            if line.startswith('>'):
+                if prot_id is not None:
+                    yield prot_id, "".join(seq_lines)
+                prot_id, seq_lines = line[1:].split()[0], []
+            elif line:
+                seq_lines.append(line)
+    if prot_id is not None:
+        yield prot_id, "".join(seq_lines)
+
+
+def parse_query_strs(level_str, spec_str):
+    """Parses ODB_query API level/ species strings (ie "level=40674", "species=9606,10090") into (int level tax id,
+    list of int species tax ids). An empty species list means no species filter."""
+    level = parse_qs(level_str).get('level', [''])[0]
+    species = parse_qs(spec_str).get('species', [''])[0]
+    tax_ids = [int(tax_id.split('_')[0]) for tax_id in species.split(',') if tax_id]
+    return int(level), tax_ids
+
+
+class ODBMirror:
+    """Read access to a mirror built by build_ODB_mirror. Queries mirror the OrthoDB API fasta/ tab endpoints: all
+    records (optionally limited to species tax_ids) from the OGs built on level which contain a gene matching the
+    query symbol (case-insensitive match on gene names, synonyms and xref ids).
+
+    :param db_fpath: Path to mirror database
+    :param (int) max_clusters: Queries matching more OGs than this raise OrthoDBQueryError(1)
+    """
+
+    def __init__(self, db_fpath, max_clusters=DEFAULT_MAX_CLUSTERS):
+        if not os.path.exists(db_fpath):
+            raise FileNotFoundError("No OrthoDB mirror at {0}; build one with build_ODB_mirror".format(db_fpath))
+        self.db_fpath = db_fpath
+        self.max_clusters = max_clusters
+        self.conn = sqlite3.connect("file:{0}?mode=ro".format(db_fpath), uri=True, check_same_thread=False)
+
+    def query_records(self, gene_name, level, tax_ids=[]):
+        """Returns DataFrame of records (ODB_TSV_COLUMNS) matching gene_name on level, and a dict of int_prot_id to
+        sequence for those records. Raises OrthoDBQueryError(0) if there are no matching records and
+        OrthoDBQueryError(1) if more than max_clusters OGs match."""
+        og_sql = """SELECT DISTINCT og2genes.pub_og_id FROM gene_keys
+                    JOIN og2genes ON og2genes.int_prot_id = gene_keys.int_prot_id
+                    JOIN ogs ON ogs.pub_og_id = og2genes.pub_og_id
+                    WHERE gene_keys.key = ? AND ogs.level_taxid = ?"""
+        og_ids = [row[0] for row in self.conn.execute(og_sql, (gene_name.lower(), int(level)))]
+        if len(og_ids) == 0:
+            raise OrthoDBQueryError(0, "No OrthoDB results for query")
+        if len(og_ids) > self.max_clusters:
+            raise OrthoDBQueryError(1, "OrthoDB search yielded too many clusters")
+        record_sql = """SELECT ogs.pub_og_id, ogs.og_name, ogs.level_taxid, genes.organism_taxid,
+                        species.organism_name, genes.int_prot_id, genes.pub_gene_id, genes.description, seqs.seq
+                        FROM ogs JOIN og2genes ON og2genes.pub_og_id = ogs.pub_og_id
+                        JOIN genes ON genes.int_prot_id = og2genes.int_prot_id
+                        JOIN species ON species.organism_taxid = genes.organism_taxid
+                        LEFT JOIN seqs ON seqs.int_prot_id = genes.int_prot_id
+                        WHERE ogs.pub_og_id IN ({0})""".format(",".join("?" * len(og_ids)))
+        params = list(og_ids)
+        if len(tax_ids) > 0:
+            record_sql += " AND species.tax_id IN ({0})".format(",".join("?" * len(tax_ids)))
+            params.extend(int(tax_id) for tax_id in tax_ids)
+        record_sql += " ORDER BY ogs.pub_og_id, genes.organism_taxid, genes.int_prot_id"
+        rows = self.conn.execute(record_sql, params).fetchall()
+        if len(rows) == 0:
+            raise OrthoDBQueryError(0, "No OrthoDB results for query")
+        records_df = pd.DataFrame([row[:-1] for row in rows], columns=ODB_TSV_COLUMNS)
+        seqs = dict((row[5], row[-1]) for row in rows if row[-1])
+        return records_df, seqs
+
+    def write_query(self, gene_name, level, tax_ids, fasta_path, tsv_path, compression=None, compresslevel=None):
+        """Writes query results for gene_name to fasta_path and tsv_path in the OrthoDB API fasta/ tab formats,
+        optionally compressed (see SScompress)."""
+        records_df, seqs = self.query_records(gene_name, level, tax_ids)
+        with atomic_write(fasta_path, compression=compression, compresslevel=compresslevel) as fasta_f:
+            for idx, row in records_df.iterrows():
+                if row['int_prot_id'] not in seqs:
+                    continue
+                header = '{{"pub_gene_id":{0}, "pub_og_id":{1}, "og_name":{2},"level":{3}, "description":{4}}}'.format(
+                    json.dumps(row['pub_gene_id']), json.dumps(row['pub_og_id']), json.dumps(row['og_name']),
+                    row['level_taxid'], json.dumps(row['description']))
+                fasta_f.write(">{0} {1}\n{2}\n".format(row['int_prot_id'], header, seqs[row['int_prot_id']]))
+        with atomic_write(tsv_path, compression=compression, compresslevel=compresslevel) as tsv_f:
+            records_df.to_csv(tsv_f, sep='\t', index=False)
+
+    def close(self):
+        self.conn.close()
+
+
+def ODB_mirror(config):
+    """Returns an ODBMirror for the [ODB] ODBMirrorPath config setting."""
+    odb_config = config['ODB']
+    return ODBMirror(odb_config['ODBMirrorPath'],
+                     max_clusters=odb_config.getint('ODBMirrorMaxClusters', fallback=DEFAULT_MAX_CLUSTERS))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build a local OrthoDB mirror from OrthoDB bulk data dumps "
+                                                 "(https://www.orthodb.org/?page=filelist)")
+    parser.add_argument("db_fpath", help="Output mirror path (ie odb_mirror/odb10v1_40674.sqlite)")
+    parser.add_argument("--species", required=True, help="odbN_species.tab[.gz]")
+    parser.add_argument("--OGs", required=True, help="odbN_OGs.tab[.gz]")
+    parser.add_argument("--OG2genes", required=True, help="odbN_OG2genes.tab[.gz]")
+    parser.add_argument("--genes", required=True, help="odbN_genes.tab[.gz]")
+    parser.add_argument("--fasta", required=True, help="odbN_aa_fasta[.gz]")
+    parser.add_argument("--xrefs", default=None, help="odbN_gene_xrefs.tab[.gz]")
+    parser.add_argument("--levels", default=None, help="Comma separated level tax ids to keep (ie 40674)")
+    args = parser.parse_args()
+    levels = args.levels.split(',') if args.levels else None
+    build_ODB_mirror(args.db_fpath, args.species, args.OGs, args.OG2genes, args.genes, args.fasta,
+                     xrefs_fpath=args.xrefs, levels=levels)
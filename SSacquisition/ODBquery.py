@@ -16,57 +16,210 @@
 
 import os
 import pandas as pd
-from SSutility.SSerrors import write_errors, print_errors, load_errors, OrthoDBQueryError
+import requests
+from SSutility.SSerrors import write_errors, error_registry, OrthoDBQueryError
+from SSacquisition.SSdownload import DownloadEngine, configured_engine, is_transient
+from SSacquisition.ODBmirror import ODB_mirror, parse_query_strs
+from SSutility.SSjournal import run_journal, TRANSIENT
+from SSutility.SScompress import open_text, input_compression, detect_compression
+from SSutility.SSjournal import atomic_write
+
+ODB_BASE_URL = "https://v101.orthodb.org"
+#OrthoDB API policy is one request per second; engine shared by ODB_query calls made without an explicit engine
+_default_engine = None
+
+def ODB_engine(config=None):
+    """Returns a DownloadEngine obeying the OrthoDB request policy. Rate and worker count are read from the [ODB]
+    section of config (ODBRequestsPerSecond, ODBMaxWorkers) if provided, along with the shared HTTP cache ([CACHE]),
+    otherwise a shared uncached default engine (1 request per second) is returned. All engines returned for the same
+    rate draw from one OrthoDB token bucket (see SSdownload.host_bucket)."""
+    global _default_engine
+    if config is not None:
+        odb_config = config['ODB']
+        rps = odb_config.getfloat("ODBRequestsPerSecond", fallback=1)
+        max_workers = odb_config.getint("ODBMaxWorkers", fallback=4)
+        return configured_engine(config, rps, max_workers)
+    if _default_engine is None:
+        _default_engine = DownloadEngine(requests_per_second=1, max_workers=4)
+    return _default_engine
+
 # Acquire input data via OrthoDB API
-def ODB_query(run_name, gene_name, level_str, spec_str):
+def ODB_query(run_name, gene_name, level_str, spec_str, engine=None, mirror=None, compression=None,
+              compresslevel=None, fasta_path=None, tsv_path=None):
     """Queries OrthoDB via the fasta and tab API for gene_name.
     More info: https://www.orthodb.org/orthodb_userguide.html#api
     level_str corresponds to the API variable for phylogenetic clade
     spec_str corresponds to the taxonomy ids for the list of species from the config folder
+    engine: DownloadEngine used for both requests. Its token bucket spaces requests on wall-clock time, so no sleeps
+    are needed here; defaults to the shared OrthoDB engine.
+    mirror: Optional ODBmirror.ODBMirror. If provided, the fasta and tsv files are written from the local mirror
+    (level and species filters applied locally) instead of the API, raising the same OrthoDBQueryErrors.
+    compression: Optional 'gzip' or 'zstd' compression for the written files (see SSutility.SScompress)
+    fasta_path, tsv_path: Output paths; default to [run_name]/input/ODB/[gene_name].fasta/ .tsv
     """
-    import time, json
-    from json import JSONDecodeError
-    from bs4 import BeautifulSoup
-    import subprocess
-    # File paths and OrthoDB urls for downloads. NOTE BASE_URL might need updating depending on ODB conventions
-    BASE_URL = "https://v101.orthodb.org"
+    if fasta_path is None:
+        fasta_path = "{0}/input/ODB/{1}.fasta".format(run_name, gene_name)
+    if tsv_path is None:
+        tsv_path = "{0}/input/ODB/{1}.tsv".format(run_name, gene_name)
+    if mirror is not None:
+        level, tax_ids = parse_query_strs(level_str, spec_str)
+        mirror.write_query(gene_name, level, tax_ids, fasta_path, tsv_path, compression, compresslevel)
+        return
+    if engine is None:
+        engine = ODB_engine()
+    # File paths and OrthoDB urls for downloads. NOTE ODB_BASE_URL might need updating depending on ODB conventions
     query_str = "query={0}".format(gene_name)
-    fasta_url = "{0}/fasta?{1}&{2}&{3}".format(BASE_URL, query_str, level_str, spec_str)
+    fasta_url = "{0}/fasta?{1}&{2}&{3}".format(ODB_BASE_URL, query_str, level_str, spec_str)
+    tsv_url = "{0}/tab?{1}&{2}&{3}".format(ODB_BASE_URL, query_str, level_str, spec_str)
+    try:
+        # Error responses (see check_ODB_response) are detected from the start of each body and never written
+        engine.download(fasta_url, fasta_path, compression=compression, compresslevel=compresslevel,
+                        validate=check_ODB_response)
+        engine.download(tsv_url, tsv_path, compression=compression, compresslevel=compresslevel,
+                        validate=check_ODB_response)
+    except (requests.RequestException, OrthoDBQueryError):
+        # Don't leave the fasta behind if the tsv request fails; download_ODB_input treats an existing fasta as complete
+        for partial_path in [fasta_path, tsv_path]:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        raise
+
+
+def classify_ODB_response(head):
+    """Classifies an OrthoDB fasta/ tab API response body from its first bytes: 'json' (returned for queries without
+    results), 'html' (returned if the query yields too many clusters to download) or 'data' (fasta/ tsv records).
+
+    :param (bytes) head: Start of the response body, including its first non-whitespace byte
+    """
+    signature = head.lstrip()[:1]
+    if signature in (b'{', b'['):
+        return 'json'
+    if signature == b'<':
+        return 'html'
+    return 'data'
+
+
+def check_ODB_response(head):
+    """Raises OrthoDBQueryError for OrthoDB error responses (see classify_ODB_response). Used as the
+    DownloadEngine.download validate callback for both API endpoints."""
+    response_type = classify_ODB_response(head)
+    if response_type == 'json':
+        raise OrthoDBQueryError(0, "No OrthoDB results for query")
+    if response_type == 'html':
+        raise OrthoDBQueryError(1, "OrthoDB search yielded too many clusters")
+
+
+def coverage_value(level_str, tax_ids):
+    """Journal value recording the taxonomy level and species an OrthoDB input file was queried for (ie
+    level=40674;species=9606,10090)."""
+    return "{0};species={1}".format(level_str, ",".join(sorted(tax_ids, key=int)))
+
+
+def input_coverage(journal, gene_name, tsv_path):
+    """Returns (level_str, set of tax_id strings) covered by the OrthoDB input files for gene_name, from the journaled
+    coverage value. Files journaled without coverage (ie downloaded before coverage was recorded) are assumed to be
+    from the current level and to cover the species present in tsv_path; species without records are then re-queried
+    once, after which their coverage is journaled."""
+    entry = journal.entry("ODB", gene_name)
+    if entry is not None and entry['value'].startswith("level="):
+        level_str, spec_str = entry['value'].split(';')
+        return level_str, set(tax_id for tax_id in spec_str[len("species="):].split(',') if tax_id)
+    with open_text(tsv_path) as tsv_f:
+        tsv_df = pd.read_csv(tsv_f, sep='\t', dtype=str, keep_default_na=False)
+    return None, set(tsv_df['organism_taxid'].str.split('_').str[0])
+
+
+def fasta_blocks(fasta_fpath):
+    #(record id, record text) for each record in fasta_fpath, record text preserved exactly as downloaded
+    with open_text(fasta_fpath) as fasta_f:
+        record_id, lines = None, []
+        for line in fasta_f:
+            if line.startswith('>'):
+                if record_id is not None:
+                    yield record_id, "".join(lines)
+                record_id, lines = line[1:].split(None, 1)[0], []
+            if not line.endswith('\n'):
+                line += '\n'
+            if record_id is not None:
+                lines.append(line)
+        if record_id is not None:
+            yield record_id, "".join(lines)
+
+
+def merge_ODB_input(fasta_path, tsv_path, removed_tax_ids, delta_fasta_path=None, delta_tsv_path=None,
+                    compression=None, compresslevel=None):
+    """Rewrites OrthoDB input files fasta_path and tsv_path without records from removed_tax_ids and with the records
+    from delta_fasta_path/ delta_tsv_path (a query for added species) appended. Records already present in the input
+    files (by int_prot_id) are not duplicated.
+
+    :param removed_tax_ids: set of tax_id strings (ie '9606') whose records are dropped
+    :param delta_fasta_path, delta_tsv_path: Optional files from a query limited to added species
+    :param compression: compression for the rewritten files; defaults to the compression of the existing files
+    """
+    if compression is None:
+        compression = detect_compression(tsv_path)
+    keep_taxid = lambda organism_taxid: organism_taxid.split('_')[0] not in removed_tax_ids
+    with open_text(tsv_path) as tsv_f:
+        tsv_df = pd.read_csv(tsv_f, sep='\t', dtype=str, keep_default_na=False)
+    tsv_df = tsv_df.loc[tsv_df['organism_taxid'].map(keep_taxid)]
+    if delta_tsv_path is not None:
+        with open_text(delta_tsv_path) as delta_f:
+            delta_df = pd.read_csv(delta_f, sep='\t', dtype=str, keep_default_na=False)
+        delta_df = delta_df.loc[~delta_df['int_prot_id'].isin(tsv_df['int_prot_id'])]
+        tsv_df = pd.concat([tsv_df, delta_df.loc[delta_df['organism_taxid'].map(keep_taxid)]])
+    fasta_sources = [fasta_path] if delta_fasta_path is None else [fasta_path, delta_fasta_path]
+    written_ids = set()
+    #fasta_path is fully read before atomic_write replaces it
+    with atomic_write(fasta_path, compression=compression, compresslevel=compresslevel) as fasta_f:
+        for source_path in fasta_sources:
+            for record_id, record_text in fasta_blocks(source_path):
+                if record_id not in written_ids and keep_taxid(record_id):
+                    written_ids.add(record_id)
+                    fasta_f.write(record_text)
+    with atomic_write(tsv_path, compression=compression, compresslevel=compresslevel) as tsv_f:
+        tsv_df.to_csv(tsv_f, sep='\t', index=False)
+
+
+def ODB_delta_query(run_name, gene_name, level_str, added_tax_ids, removed_tax_ids, engine=None, mirror=None,
+                    compression=None, compresslevel=None):
+    """Updates existing OrthoDB input files for gene_name to a changed species list: records for added_tax_ids are
+    queried (species=<added tax ids>) and merged into the input files, and records for removed_tax_ids are dropped
+    locally. No query is made if no species were added. A delta query without results only drops removed species;
+    removed species are also dropped before any other OrthoDBQueryError (ie too many clusters) is re-raised, since
+    those are permanent outcomes for the added species."""
     fasta_path = "{0}/input/ODB/{1}.fasta".format(run_name, gene_name)
-    tsv_url = "{0}/tab?{1}&{2}&{3}".format(BASE_URL, query_str, level_str, spec_str)
     tsv_path = "{0}/input/ODB/{1}.tsv".format(run_name, gene_name)
-    # Obey OrthoDB download restrictions (one request per second) bc you're a good noodle
-    t1 = time.process_time()
-    fasta_proc = subprocess.run(args=['wget', fasta_url, '-O', fasta_path])
-    # if (time.process_time() - t1) < 1:
-    #     time.sleep(0.5)
-    time.sleep(1-(time.process_time()-t1))
-    t1 = time.process_time()
-    tsv_proc = subprocess.run(args=['wget', tsv_url, '-O', tsv_path])
-    time.sleep(1 - (time.process_time() - t1))
+    if len(added_tax_ids) == 0:
+        merge_ODB_input(fasta_path, tsv_path, removed_tax_ids, compression=compression, compresslevel=compresslevel)
+        return
+    delta_fasta_path = "{0}/input/ODB/.{1}.delta.fasta".format(run_name, gene_name)
+    delta_tsv_path = "{0}/input/ODB/.{1}.delta.tsv".format(run_name, gene_name)
+    spec_str = "species=" + ",".join(sorted(added_tax_ids, key=int))
     try:
-        # JSON format returned if no results for query string - try opening downloaded data as JSON, if
-        # successful, raise an OrthoDBQueryError
-        with open(tsv_path) as tsv_f:
-            tsv_json = json.load(tsv_f)
-            os.remove(fasta_path)
-            os.remove(tsv_path)
-        raise OrthoDBQueryError(0, "No OrthoDB results for query")
-    except JSONDecodeError:
-        # Check if html syntax present in file (result of too many clusters returned to be downloaded);
-        # if not, query was successful and run_name/input should now have ODB formatted .fasta and .tsv files
-        file_txt = ""
-        with open(fasta_path, "rt") as fasta_f:
-            for i in range(4):
-                file_txt = file_txt + fasta_f.readline()
-            if bool(BeautifulSoup(file_txt, "html.parser").find()):
-                os.remove(fasta_path)
-                os.remove(tsv_path)
-                raise OrthoDBQueryError(1, "OrthoDB search yielded too many clusters")
-                # If no OrthoDBQueryError is raised, download was successful (no further action needed)
-
-
-def download_ODB_input(gene_list, tax_table, config):
+        ODB_query(run_name, gene_name, level_str, spec_str, engine=engine, mirror=mirror,
+                  fasta_path=delta_fasta_path, tsv_path=delta_tsv_path)
+        merge_ODB_input(fasta_path, tsv_path, removed_tax_ids, delta_fasta_path, delta_tsv_path,
+                        compression=compression, compresslevel=compresslevel)
+    except OrthoDBQueryError as odb_error:
+        merge_ODB_input(fasta_path, tsv_path, removed_tax_ids, compression=compression, compresslevel=compresslevel)
+        #No records for the added species
+        if odb_error.code != 0:
+            raise
+    finally:
+        for delta_path in [delta_fasta_path, delta_tsv_path]:
+            if os.path.exists(delta_path):
+                os.remove(delta_path)
+
+
+def _call_query(query_func, *args, **kwargs):
+    #(result, exception) for one query, matching the DownloadEngine.map convention
+    try:
+        return query_func(*args, **kwargs), None
+    except Exception as e:
+        return None, e
+
+
+def download_ODB_input(gene_list, tax_table, config, journal=None, progress=None):
     """Queries OrthoDB for all entries in gene list (logs failed searches into errors_fpath), using species
     list from tax_table and taxonomy level provided in config directory. This function will attempt to
     query OrthoDB for each gene symbol in gene_list according to the species list in the config directory.
@@ -79,6 +232,15 @@ def download_ODB_input(gene_list, tax_table, config):
     :param tax_table: Table constructed from OrthoDB raw species table, contains species name, OrthoDB ID, and
     assembly information.
     :param config: configparser object constructed from config/config.txt, contains run parameters
+    :param journal: SSjournal.AcquisitionJournal for the run (defaults to the run directory journal). Genes are
+    queried unless journaled as complete with intact files, and each successful query is journaled along with the
+    species it covers. If the species list changed since a gene was downloaded (and [ODB] ODBDeltaSpecies is set),
+    only added species are queried and merged into its input files and removed species are dropped locally (see
+    ODB_delta_query); OverwriteInput re-downloads everything. Queries failing with transient errors (after the
+    engine's retries, see [RETRY] config section) are journaled as transient instead of being logged to errors_fpath,
+    so only permanent outcomes (no results/ too many clusters) block later runs. Species updates failing with a
+    permanent outcome keep the existing records (less removed species) and are journaled with the current coverage.
+    :param progress: Optional SSorchestrator.AcquisitionProgress, advanced under 'OrthoDB' per completed query
 
     Returns the list of gene symbols from gene_list for which OrthoDB data was successfully downloaded
     and the list of gene symbols for which the OrthoDB queries failed"""
@@ -90,19 +252,107 @@ def download_ODB_input(gene_list, tax_table, config):
     run_name,errors_fname = run_config["RunName"],run_config["ErrorsFileName"]
     errors_fpath = "{0}/{1}".format(run_name,errors_fname)
 
-    check_error_file, ODB_errors_df = load_errors(errors_fpath,error_type="OrthoDBQueryError")
+    errors = error_registry(errors_fpath)
+    if journal is None:
+        journal = run_journal(run_name)
+    compression, compresslevel = input_compression(config)
+    current_tax_ids = set(tax_ids)
+    delta_species = odb_config.getboolean("ODBDeltaSpecies", fallback=True)
+    query_genes, delta_genes = [], {}
     for gene_name in gene_list:
         fasta_path = "{0}/input/ODB/{1}.fasta".format(run_name, gene_name)
-        if run_config.getboolean("OverwriteInput") or not os.path.exists(fasta_path):
-            if check_error_file and gene_name in ODB_errors_df["gene_symbol"].unique():
-                print_errors(ODB_errors_df,gene_name)
+        tsv_path = "{0}/input/ODB/{1}.tsv".format(run_name, gene_name)
+        if run_config.getboolean("OverwriteInput") or not journal.is_complete("ODB", gene_name, fasta_path) \
+                or not os.path.exists(tsv_path):
+            if errors.has(gene_name, error_type="OrthoDBQueryError"):
+                errors.print_gene(gene_name, error_type="OrthoDBQueryError")
                 failed_queries.append(gene_name)
             else:
-                try:
-                    ODB_query(run_name, gene_name, level_str, spec_str)
-                except OrthoDBQueryError as odb_error:
-                    failed_queries.append(gene_name)
-                    write_errors(errors_fpath, gene_name, odb_error)
+                query_genes.append(gene_name)
+        elif delta_species:
+            covered_level, covered_tax_ids = input_coverage(journal, gene_name, tsv_path)
+            if covered_level is not None and covered_level != level_str:
+                query_genes.append(gene_name)
+            elif covered_tax_ids != current_tax_ids or covered_level is None:
+                delta_genes[gene_name] = (current_tax_ids - covered_tax_ids, covered_tax_ids - current_tax_ids)
+    #Species removed from the species list only: dropped locally without queries
+    for gene_name in [gene_name for gene_name, (added, removed) in delta_genes.items() if len(added) == 0]:
+        added, removed = delta_genes.pop(gene_name)
+        if len(removed) > 0:
+            ODB_delta_query(run_name, gene_name, level_str, added, removed, compression=compression,
+                            compresslevel=compresslevel)
+        journal.record("ODB", gene_name, fpath="{0}/input/ODB/{1}.fasta".format(run_name, gene_name),
+                       value=coverage_value(level_str, current_tax_ids))
+    if len(delta_genes) > 0:
+        print("Fetching records for added species for {0} previously downloaded genes".format(len(delta_genes)))
+    if progress is not None:
+        progress.start("OrthoDB", len(query_genes) + len(delta_genes))
+    if odb_config.get("ODBBackend", fallback="api") == "mirror":
+        #Local mirror queries take milliseconds; run serially on one SQLite connection
+        mirror = ODB_mirror(config)
+        query_func = lambda gene_name: ODB_query(run_name, gene_name, level_str, spec_str, mirror=mirror,
+                                                 compression=compression, compresslevel=compresslevel)
+        delta_func = lambda gene_name: ODB_delta_query(run_name, gene_name, level_str, *delta_genes[gene_name],
+                                                       mirror=mirror, compression=compression,
+                                                       compresslevel=compresslevel)
+        query_results = ((gene_name,) + _call_query(query_func if gene_name not in delta_genes else delta_func,
+                                                    gene_name) for gene_name in query_genes + list(delta_genes))
+    else:
+        #Queries run concurrently up to ODBMaxWorkers; the engine's token bucket enforces ODBRequestsPerSecond across
+        #all workers. Errors are logged from this thread and written to errors_fpath in one batch.
+        mirror = None
+        engine = ODB_engine(config)
+
+        def query_func(gene_name):
+            if gene_name in delta_genes:
+                return ODB_delta_query(run_name, gene_name, level_str, *delta_genes[gene_name], engine=engine,
+                                       compression=compression, compresslevel=compresslevel)
+            return ODB_query(run_name, gene_name, level_str, spec_str, engine=engine, compression=compression,
+                             compresslevel=compresslevel)
+        #Genes without any input data are queried before species updates of downloaded genes
+        query_results = engine.map(query_func, query_genes + list(delta_genes),
+                                   priority=lambda gene_name: gene_name in delta_genes)
+    transient_genes = []
+    with errors.batch():
+        for gene_name, result, error in query_results:
+            if progress is not None:
+                progress.advance("OrthoDB", failed=error is not None)
+            if error is None:
+                journal.record("ODB", gene_name, fpath="{0}/input/ODB/{1}.fasta".format(run_name, gene_name),
+                               value=coverage_value(level_str, current_tax_ids))
+                continue
+            if gene_name in delta_genes:
+                print("{0}\tOrthoDB query for added species failed: {1}".format(gene_name, error))
+                if isinstance(error, OrthoDBQueryError):
+                    #Permanent outcome: removed species were dropped and existing records are kept; the coverage is
+                    #journaled so the added species aren't queried again
+                    journal.record("ODB", gene_name, fpath="{0}/input/ODB/{1}.fasta".format(run_name, gene_name),
+                                   value=coverage_value(level_str, current_tax_ids))
+                elif isinstance(error, requests.RequestException):
+                    #Existing input files are left unchanged; the species update is retried next run
+                    if is_transient(error):
+                        transient_genes.append(gene_name)
+                else:
+                    raise error
+                continue
+            failed_queries.append(gene_name)
+            if isinstance(error, OrthoDBQueryError):
+                write_errors(errors_fpath, gene_name, error)
+            elif isinstance(error, requests.RequestException):
+                #Network/ HTTP failures are not logged to errors_fpath so the gene is retried on the next run
+                print("{0}\tOrthoDB request failed: {1}".format(gene_name, error))
+                if is_transient(error):
+                    transient_genes.append(gene_name)
+                    journal.record("ODB", gene_name, status=TRANSIENT, value=error)
+            else:
+                raise error
+    if mirror is not None:
+        mirror.close()
+    else:
+        engine.close()
+    if transient_genes:
+        print("{0} OrthoDB queries failed with transient errors and will be retried next run".format(
+            len(transient_genes)))
 
     print("Input queries downloaded.")
     valid_queries = [gene for gene in gene_list if gene not in failed_queries]
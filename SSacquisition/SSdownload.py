@@ -0,0 +1,490 @@
+#SSdownload.py - Shared in-process HTTP download engine (wall-clock rate limiting, pooled keep-alive connections,
+#concurrent requests, retries and per-host circuit breakers) used by the acquisition modules in place of per-file wget
+#subprocesses.
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+import json
+import heapq
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from SSutility.SScache import ContentCache, content_key
+from SSutility.SSjournal import atomic_write
+
+#Request parameters which don't change response content and are dropped from HTTP cache keys
+UNKEYED_PARAMS = ['api_key']
+#Responses with these statuses are transient (rate limited/ service unavailable) and retried
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter. Tokens refill continuously at rate tokens per second of wall-clock
+    (monotonic) time up to capacity; acquire blocks until a token is available. One bucket should be shared by every
+    thread making requests against the same host so the host's requests-per-second policy holds for the whole run.
+    """
+
+    def __init__(self, rate, capacity=1):
+        if rate <= 0:
+            raise ValueError("TokenBucket rate must be positive, got {0}".format(rate))
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Blocks until one token is available and consumes it."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def pooled_session(max_connections=4):
+    """Returns a requests.Session whose connection pool keeps up to max_connections keep-alive connections per host,
+    so concurrent workers reuse connections instead of opening one per request."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class CacheMissError(requests.ConnectionError):
+    """Raised by engines in cache-only (offline) mode for requests without a cached response. Subclasses
+    requests.ConnectionError so callers handle it like any other network failure (not logged as a query error)."""
+    pass
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of making a request while the circuit breaker for its host is open. retry_at is the monotonic
+    time at which the host accepts a probe request again."""
+
+    def __init__(self, host, retry_at):
+        super().__init__("Circuit breaker open for {0}; retry in {1:.1f}s".format(host, retry_at - time.monotonic()))
+        self.host = host
+        self.retry_at = retry_at
+
+
+class RetryPolicy:
+    """Retry and circuit breaker settings for a DownloadEngine.
+
+    :param (int) max_retries: Retries per request after a connection error, timeout or RETRY_STATUSES response; also
+    the number of times DownloadEngine.map requeues a task whose host circuit breaker is open
+    :param (float) backoff: Base delay in seconds; retry n waits a random delay in [0, backoff * 2**n] (full jitter)
+    :param (float) max_backoff: Upper bound for retry delays, including server Retry-After values
+    :param (int) breaker_failures: Consecutive transient failures after which a host's circuit breaker opens (0 to
+    disable circuit breakers)
+    :param (float) breaker_reset: Seconds an open circuit breaker rejects requests before allowing a probe request
+    """
+
+    def __init__(self, max_retries=4, backoff=1.0, max_backoff=60.0, breaker_failures=5, breaker_reset=60.0):
+        self.max_retries = max(int(max_retries), 0)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry attempt (0 for the first retry); at least retry_after if provided."""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker. After failure_threshold consecutive transient failures the breaker opens and requests
+    to the host fail immediately with CircuitOpenError for reset_timeout seconds. The first request after that is let
+    through as a probe: success closes the breaker, failure opens it for another reset_timeout. Meanwhile requests to
+    other hosts are unaffected.
+    """
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=60.0):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._open_until = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._open_until is not None
+
+    def before_request(self):
+        """Raises CircuitOpenError if the breaker is open; otherwise returns and the request may be made."""
+        with self._lock:
+            if self._open_until is None:
+                return
+            now = time.monotonic()
+            if now < self._open_until:
+                raise CircuitOpenError(self.host, self._open_until)
+            #Half open: this request is the probe, other requests wait for its outcome
+            self._open_until = now + self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.reset_timeout
+
+
+#Breakers are shared by every engine making requests to the same host
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def host_breaker(url, failure_threshold=5, reset_timeout=60.0):
+    """Returns the CircuitBreaker for the host of url, creating it with the given settings if needed."""
+    host = urlsplit(url).netloc.lower()
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host, failure_threshold, reset_timeout)
+        return _breakers[host]
+
+
+#Token buckets are shared by every engine making requests to the same host with the same rate policy
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def host_bucket(url, requests_per_second, burst=1):
+    """Returns the TokenBucket for the host of url and the given rate/ burst, creating it if needed."""
+    key = (urlsplit(url).netloc.lower(), float(requests_per_second), burst)
+    with _buckets_lock:
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(requests_per_second, burst)
+        return _buckets[key]
+
+
+def retry_after_seconds(response):
+    #Retry-After header in seconds (HTTP date values are ignored)
+    try:
+        return float(getattr(response, 'headers', {}).get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(error):
+    """True if error is a network failure worth retrying on a later run (connection errors, timeouts, open circuit
+    breakers and RETRY_STATUSES responses) rather than a permanent outcome. Cache misses in cache-only mode are not
+    transient."""
+    if isinstance(error, CacheMissError):
+        return False
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        return getattr(error.response, 'status_code', None) in RETRY_STATUSES
+    return False
+
+
+def raise_for_transient(response):
+    """Raises requests.HTTPError if response has a RETRY_STATUSES status (ie still rate limited/ unavailable after
+    retries), so callers treating non-2xx responses as empty results don't record a transient failure as one."""
+    if not response.ok and response.status_code in RETRY_STATUSES:
+        raise requests.HTTPError("{0} Error for url: {1}".format(response.status_code, response.url),
+                                 response=response)
+
+
+class CachedResponse:
+    """Minimal stand-in for requests.Response for responses served from an HTTP cache."""
+
+    def __init__(self, url, status_code, content):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.from_cache = True
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError("{0} Error for url: {1}".format(self.status_code, self.url), response=self)
+
+    def iter_content(self, chunk_size=65536):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def http_cache_key(method, url, params=None):
+    """Cache key for a request: method, lower-cased scheme/host, path and the sorted union of url query and params
+    (list values expanded, UNKEYED_PARAMS dropped), so equivalent requests share one cache entry."""
+    split = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(split.query, keep_blank_values=True)]
+    if params:
+        items = params.items() if isinstance(params, dict) else params
+        for k, v in items:
+            values = v if isinstance(v, (list, tuple)) else [v]
+            query.extend((k, str(value)) for value in values)
+    query = sorted((k, v) for k, v in query if k not in UNKEYED_PARAMS)
+    base = "{0}://{1}{2}".format(split.scheme.lower(), split.netloc.lower(), split.path)
+    return content_key(method.upper(), base, urlencode(query))
+
+
+def http_cache(config):
+    """Builds the shared HTTP response cache from the [CACHE] config section, or returns None if UseCache is no.
+    CacheDir is global (not per RunName) so identical requests from different runs are only made once."""
+    if not config.getboolean('CACHE', 'UseCache', fallback=False):
+        return None
+    cache_dir = config.get('CACHE', 'CacheDir', fallback='http_cache')
+    ttl_days = config.getfloat('CACHE', 'CacheTTLDays', fallback=0)
+    max_mb = config.getfloat('CACHE', 'CacheMaxMB', fallback=0)
+    ttl = ttl_days * 86400 if ttl_days > 0 else None
+    max_bytes = int(max_mb * 2**20) if max_mb > 0 else None
+    return ContentCache(cache_dir, ttl=ttl, max_bytes=max_bytes)
+
+
+def retry_policy(config):
+    """RetryPolicy from the [RETRY] config section (defaults for missing settings)."""
+    retry_config = config['RETRY'] if config.has_section('RETRY') else {}
+    get_float = lambda key, fallback: float(retry_config.get(key, "") or fallback)
+    return RetryPolicy(max_retries=int(get_float('MaxRetries', 4)), backoff=get_float('RetryBackoff', 1.0),
+                       max_backoff=get_float('RetryMaxBackoff', 60.0),
+                       breaker_failures=int(get_float('BreakerFailures', 5)),
+                       breaker_reset=get_float('BreakerResetSeconds', 60.0))
+
+
+def _passes(validate, body):
+    #False if validate (see DownloadEngine.download) raises for body
+    try:
+        validate(body)
+    except Exception:
+        return False
+    return True
+
+
+def configured_engine(config, requests_per_second, max_workers):
+    #DownloadEngine with the shared HTTP cache, cache-only (offline) setting and retry policy from config
+    cache_only = config.getboolean('CACHE', 'CacheOnly', fallback=False)
+    return DownloadEngine(requests_per_second=requests_per_second, max_workers=max_workers,
+                          cache=http_cache(config), cache_only=cache_only, retry=retry_policy(config))
+
+
+class DownloadEngine:
+    """Rate-limited, pooled HTTP client for one host (or one host policy). Requests wait for a token from the
+    TokenBucket of their host (see host_bucket), which is shared with every other engine using the same host and rate,
+    so separately created engines don't add up to more than requests_per_second; up to max_workers requests are in
+    flight at once when used through map.
+
+    :param (float) requests_per_second: Host request policy enforced on wall-clock time
+    :param (int) max_workers: Maximum number of concurrent requests (and pooled connections)
+    :param (int) burst: Token bucket capacity, ie number of requests that may be issued back to back after idling
+    :param (int) timeout: Per-request timeout in seconds
+    :param cache: Optional SScache.ContentCache. Successful responses are stored under http_cache_key and later
+    identical requests are answered from it without using a token.
+    :param (boolean) cache_only: If True, never touch the network; uncached requests raise CacheMissError
+    :param retry: Optional RetryPolicy. Connection errors, timeouts and RETRY_STATUSES responses are retried with
+    jittered exponential backoff (honouring Retry-After), and requests go through per-host circuit breakers. Without
+    one, every request is made exactly once.
+    """
+
+    def __init__(self, requests_per_second=1, max_workers=4, burst=1, timeout=60, session=None,
+                 cache=None, cache_only=False, retry=None):
+        if requests_per_second <= 0:
+            raise ValueError("TokenBucket rate must be positive, got {0}".format(requests_per_second))
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_workers = max(int(max_workers), 1)
+        self.timeout = timeout
+        self.session = session if session is not None else pooled_session(self.max_workers)
+        self.cache = cache
+        self.cache_only = cache_only
+        self.retry = retry
+        if cache_only and cache is None:
+            raise ValueError("cache_only requires a cache")
+
+    def _cached_request(self, method, url, params, send, cacheable=None):
+        #cacheable: Optional callable receiving a body; bodies it returns False for are neither stored nor served
+        key = http_cache_key(method, url, params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            header, body = cached.split(b'\n', 1)
+            header = json.loads(header.decode('utf-8'))
+            if cacheable is None or cacheable(body):
+                return CachedResponse(header['url'], header['status'], body)
+        if self.cache_only:
+            raise CacheMissError("No cached response (cache-only mode) for {0} {1}".format(method, url))
+        response = self._send(url, send)
+        if response.ok and (cacheable is None or cacheable(response.content)):
+            header = json.dumps({'url':response.url, 'status':response.status_code}).encode('utf-8')
+            self.cache.put(key, header + b'\n' + response.content)
+        return response
+
+    def _send(self, url, send):
+        """Calls send() for a request to url once a token is available, retrying transient failures according to
+        self.retry. Returns the last response (which may have a RETRY_STATUSES status once retries are exhausted) or
+        raises the last connection error/ timeout, or CircuitOpenError without waiting if the host's breaker is open.
+        """
+        if self.retry is None:
+            host_bucket(url, self.requests_per_second, self.burst).acquire()
+            return send()
+        breaker = None
+        if self.retry.breaker_failures > 0:
+            breaker = host_breaker(url, self.retry.breaker_failures, self.retry.breaker_reset)
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.before_request()
+            host_bucket(url, self.requests_per_second, self.burst).acquire()
+            error, response, retry_after = None, None, None
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    if breaker is not None:
+                        breaker.record_success()
+                    return response
+                retry_after = retry_after_seconds(response)
+            if breaker is not None:
+                breaker.record_failure()
+            if attempt >= self.retry.max_retries:
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                response.close()
+            time.sleep(self.retry.delay(attempt, retry_after))
+            attempt += 1
+
+    def get(self, url, params=None, stream=False, cacheable=None):
+        """Issues a rate-limited GET request; returns the requests.Response object (or a CachedResponse). Responses
+        are never streamed when a cache is used. cacheable is an optional callable receiving the response body which
+        returns False for bodies that must not be cached (ie error responses served with status 200)."""
+        if self.cache is not None:
+            send = lambda: self.session.get(url, params=params, timeout=self.timeout)
+            return self._cached_request('GET', url, params, send, cacheable)
+        return self._send(url, lambda: self.session.get(url, params=params, stream=stream, timeout=self.timeout))
+
+    def post(self, url, data=None, cache=True):
+        """Issues a rate-limited POST request (ie for long Entrez id lists); returns the requests.Response object.
+        cache=False bypasses the cache for requests whose responses are session specific (ie Entrez epost)."""
+        if self.cache is not None and cache:
+            send = lambda: self.session.post(url, data=data, timeout=self.timeout)
+            return self._cached_request('POST', url, data, send)
+        if self.cache_only:
+            raise CacheMissError("Uncacheable request in cache-only mode: POST {0}".format(url))
+        return self._send(url, lambda: self.session.post(url, data=data, timeout=self.timeout))
+
+    def download(self, url, outpath, params=None, chunk_size=65536, compression=None, compresslevel=None,
+                 validate=None):
+        """Streams the body of url to outpath. Raises requests.HTTPError for non-2xx responses (nothing is written).
+        The body is written to a temporary file which replaces outpath once complete, so failed or interrupted
+        downloads never leave a partial file at outpath. compression ('gzip'/ 'zstd') compresses the body as it is
+        streamed (see SScompress).
+
+        :param validate: Optional callable receiving the start of the body (chunks up to and including the first one
+        with non-whitespace content) before anything is written. Exceptions it raises abort the download: the rest of
+        the body is not read and nothing is written. Bodies it raises for are not cached.
+        :return: (int) number of bytes written
+        """
+        n_bytes = 0
+        cacheable = None
+        if validate is not None:
+            cacheable = lambda body: _passes(validate, body)
+        #Cached engines return fully read responses; iter_content then walks the in-memory body
+        with self.get(url, params=params, stream=True, cacheable=cacheable) as response:
+            response.raise_for_status()
+            chunks = response.iter_content(chunk_size=chunk_size)
+            head = b''
+            if validate is not None:
+                for chunk in chunks:
+                    head += chunk
+                    if head.strip():
+                        break
+                validate(head)
+            with atomic_write(outpath, 'wb', compression=compression, compresslevel=compresslevel) as out_f:
+                out_f.write(head)
+                n_bytes += len(head)
+                for chunk in chunks:
+                    out_f.write(chunk)
+                    n_bytes += len(chunk)
+        return n_bytes
+
+    def map(self, func, items, priority=None):
+        """Calls func(item) for every item using up to max_workers threads. Yields (item, result, exception) tuples in
+        completion order; exception is None if func returned normally, otherwise result is None. Callers should do
+        any non thread-safe bookkeeping (ie writing errors.tsv) on the yielded values rather than inside func.
+
+        Items are started from a priority queue (lowest priority(item) first, then input order). With a retry policy,
+        items failing with CircuitOpenError are requeued (up to retry.max_retries times) until their host's breaker
+        allows a probe, without holding a worker, so items for other hosts keep running in the meantime.
+        """
+        queue = [(0, priority(item) if priority is not None else 0, seq, item, 0) for seq, item in enumerate(items)]
+        heapq.heapify(queue)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            running = {}
+            while queue or running:
+                now = time.monotonic()
+                while queue and len(running) < self.max_workers and queue[0][0] <= now:
+                    ready_at, item_priority, seq, item, attempt = heapq.heappop(queue)
+                    running[pool.submit(func, item)] = (item_priority, seq, item, attempt)
+                timeout = max(queue[0][0] - now, 0) if queue and len(running) < self.max_workers else None
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, pending = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item_priority, seq, item, attempt = running.pop(future)
+                    try:
+                        result = future.result()
+                    except CircuitOpenError as e:
+                        if self.retry is not None and attempt < self.retry.max_retries:
+                            heapq.heappush(queue, (e.retry_at, item_priority, seq, item, attempt + 1))
+                        else:
+                            yield item, None, e
+                    except Exception as e:
+                        yield item, None, e
+                    else:
+                        yield item, result, None
+
+    def close(self):
+        self.session.close()
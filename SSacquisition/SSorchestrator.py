@@ -0,0 +1,121 @@
+#SSorchestrator.py - Runs OrthoDB, NCBI and GeneCards acquisition concurrently with a combined progress view
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from SSutility.SSjournal import run_journal
+
+#Each source downloads through its own DownloadEngine, so running the stages side by side keeps every host policy
+#while wall time drops to roughly that of the slowest source.
+
+SOURCES = ['OrthoDB', 'NCBI', 'GeneCards']
+
+
+class AcquisitionProgress:
+    """Thread-safe progress counters for concurrently running acquisition stages, rendered as one combined line (ie
+    "OrthoDB 120/380 (2 failed) | NCBI downloading records | GeneCards done 40/40").
+
+    :param sources: source names in display order
+    """
+
+    def __init__(self, sources=SOURCES):
+        self._lock = threading.Lock()
+        self.state = dict((source, {'total': None, 'done': 0, 'failed': 0, 'phase': "waiting"}) for source in sources)
+
+    def start(self, source, total):
+        """Sets the number of queries source will make."""
+        with self._lock:
+            self.state[source].update(total=total, phase="")
+
+    def advance(self, source, n=1, failed=False):
+        with self._lock:
+            self.state[source]['done'] += n
+            if failed:
+                self.state[source]['failed'] += n
+
+    def phase(self, source, text):
+        """Sets a short status for source (ie current step for multi-step stages)."""
+        with self._lock:
+            self.state[source]['phase'] = text
+
+    def finish(self, source, error=None):
+        with self._lock:
+            self.state[source]['phase'] = "done" if error is None else "error: {0}".format(error)
+
+    def render(self):
+        with self._lock:
+            parts = []
+            for source, state in self.state.items():
+                part = source
+                if state['phase']:
+                    part += " " + state['phase']
+                if state['total'] is not None:
+                    part += " {0}/{1}".format(state['done'], state['total'])
+                if state['failed']:
+                    part += " ({0} failed)".format(state['failed'])
+                parts.append(part)
+        return " | ".join(parts)
+
+
+def _report(progress, stop_event, interval):
+    while not stop_event.wait(interval):
+        print("[acquisition] " + progress.render())
+
+
+def run_acquisition(config, gene_id_df, tax_table, sources=SOURCES, progress_interval=10):
+    """Runs OrthoDB (ODBquery.download_ODB_input), NCBI (NCBIquery.download_AGS_data) and GeneCards
+    (aliasQuery.download_alias_data) acquisition for gene_id_df concurrently, printing combined progress every
+    progress_interval seconds. The run journal is compacted once all stages finish. If a stage raises, the remaining
+    stages still run to completion and the first exception (in sources order) is raised afterwards.
+
+    :param config: configparser object with run params. See SSutility.SSconfig
+    :param gene_id_df: DataFrame containing Gene ID and symbol information. See SSutility.SSconfig
+    :param tax_table: OrthoDB taxonomy table filtered down to the input species list
+    :param sources: subset of SOURCES to acquire
+    :return: dict of source to stage return value
+    """
+    from SSacquisition import ODBquery, NCBIquery, aliasQuery
+    journal = run_journal(config['RUN']['RunName'])
+    progress = AcquisitionProgress(sources)
+    gene_symbols = gene_id_df['gene_symbol']
+    stages = {'OrthoDB': lambda: ODBquery.download_ODB_input(gene_symbols, tax_table, config, journal=journal,
+                                                             progress=progress),
+              'NCBI': lambda: NCBIquery.download_AGS_data(gene_id_df, config, journal=journal, progress=progress),
+              'GeneCards': lambda: aliasQuery.download_alias_data(gene_symbols, config, progress=progress)}
+
+    def run_stage(source):
+        try:
+            result = stages[source]()
+        except Exception as e:
+            progress.finish(source, error=e)
+            raise
+        progress.finish(source)
+        return result
+
+    stop_event = threading.Event()
+    reporter = threading.Thread(target=_report, args=(progress, stop_event, progress_interval), daemon=True)
+    start = time.time()
+    reporter.start()
+    try:
+        with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            futures = dict((source, executor.submit(run_stage, source)) for source in sources)
+    finally:
+        stop_event.set()
+        reporter.join()
+        journal.compact()
+    print("[acquisition] {0} ({1:.1f}s)".format(progress.render(), time.time() - start))
+    return dict((source, futures[source].result()) for source in sources)
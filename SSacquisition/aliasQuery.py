@@ -1,4 +1,4 @@
-#aliasQuery.py - Handles selenium queries to GeneCards for alias information
+#aliasQuery.py - Handles GeneCards queries (plain HTTP or selenium) for alias information
 # Copyright (C) 2020  Evan Lee
 #
 # This program is free software: you can redistribute it and/or modify
@@ -15,19 +15,25 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import numpy as np
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
 from bs4 import BeautifulSoup
 import re
 import os
-from SSutility.SSerrors import GeneCardsError, write_errors, load_errors, print_errors
+import requests
+from urllib.parse import urljoin
+from SSutility.SSerrors import GeneCardsError, write_errors, error_registry
+from SSutility.SSjournal import atomic_write
+
+GC_CARD_URL = "https://www.genecards.org/cgi-bin/carddisp.pl"
+GC_SEARCH_URL = "https://www.genecards.org/Search/Keyword"
+#GeneCards serves its pages to browser user agents only
+GC_HEADERS = {"User-Agent":"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                           "Chrome/80.0.3987.149 Safari/537.36"}
 
 def write_aliases_f(aliases, aliases_fpath):
     """Write aliases data from GeneCards to a txt file list at aliases_fpath"""
-    aliases_f = open(aliases_fpath, 'wt')
-    for a in aliases:
-        aliases_f.write(a.strip() + '\n')
-    aliases_f.close()
+    with atomic_write(aliases_fpath) as aliases_f:
+        for a in aliases:
+            aliases_f.write(a.strip() + '\n')
 
 
 def alias_GC_query(driver,gene_name):
@@ -97,7 +103,142 @@ def alias_GC_query(driver,gene_name):
         # If either no link_elems (empty search results page), or none correspond to gene_name:
         raise GeneCardsError(0, "Could not automatically fetch alias data from GeneCards - consider searching manually")
 
-def download_alias_data(gene_list, config):
+def html_parser():
+    #Fastest available BeautifulSoup tree builder (lxml if installed)
+    try:
+        import lxml
+        return "lxml"
+    except ImportError:
+        return "html.parser"
+
+def parse_GC_aliases(html):
+    """Parses a GeneCards gene card page once and returns the list of alias strings (first text of every
+    <li> in the aliases list, ie ul.list-unstyled.list-spacious). Empty list if the page is not a gene card."""
+    soup = BeautifulSoup(html, html_parser())
+    aliases = []
+    for li in soup.select("ul.list-unstyled.list-spacious > li"):
+        li_text = li.find(text=True)
+        if li_text and li_text.strip():
+            aliases.append(li_text.strip())
+    return aliases
+
+def parse_GC_search_links(html, page_url):
+    """Returns absolute URLs of gene card links in a GeneCards keyword search results page, in page order."""
+    soup = BeautifulSoup(html, html_parser())
+    links = soup.select("td.gc-gene-symbol.gc-highlight.symbol-col > a")
+    return [urljoin(page_url, link.get("href")) for link in links if link.get("href")]
+
+def gc_name_from_url(url, default=None):
+    #GeneCards primary symbol from gene card url (gene= parameter), default if url has none
+    match = re.search("gene=([A-Za-z0-9\-]+)", url)
+    if match is None:
+        return default
+    return match.groups()[0].strip().upper()
+
+def alias_GC_http_query(engine, gene_name, aliases_dir="alias_data"):
+    """Browserless equivalent of alias_GC_query. Fetches the GeneCards card page for gene_name over plain HTTP; if
+    GeneCards does not resolve gene_name to a single card, every gene card linked from the keyword search results is
+    fetched in results order until one lists gene_name as its symbol or an alias. Cards are fetched sequentially since
+    this runs inside download_alias_data's engine.map workers, which already bound concurrency.
+    Aliases (GeneCards primary symbol first) are written to <aliases_dir>/<gene_name>_aliases.txt if aliases_dir is
+    provided.
+
+    :param engine: SSdownload.DownloadEngine for GeneCards requests
+    :param gene_name: gene symbol which will be queried via GeneCards website for alias names
+    :param aliases_dir: directory for alias txt files; None to only return aliases (ie for the alias store)
+    :return: aliases: list of GeneCards alias names for gene_name, primary symbol first
+    :raises: GeneCardsError only if every page was fetched; transient request failures (see SSdownload.is_transient)
+    are raised as requests exceptions instead so that the symbol is not logged as lacking alias data
+    """
+    from SSacquisition.SSdownload import raise_for_transient, is_transient
+    aliases_fpath = "{0}/{1}_aliases.txt".format(aliases_dir, gene_name)
+    response = engine.get(GC_CARD_URL, params={'gene':gene_name.upper()})
+    raise_for_transient(response)
+    aliases = parse_GC_aliases(response.text) if response.ok else []
+    if len(aliases) > 0:
+        gc_name = gc_name_from_url(response.url, default=gene_name.upper())
+        if gc_name not in aliases:
+            aliases.insert(0, gc_name)
+        if aliases_dir:
+            write_aliases_f(aliases, aliases_fpath)
+        return aliases
+    response = engine.get(GC_SEARCH_URL, params={'queryString':gene_name})
+    raise_for_transient(response)
+    link_hrefs = parse_GC_search_links(response.text, response.url) if response.ok else []
+
+    fetch_errors = []
+    for href in link_hrefs:
+        try:
+            card_response = engine.get(href)
+            card_response.raise_for_status()
+        except requests.RequestException as error:
+            if is_transient(error):
+                fetch_errors.append(error)
+            continue
+        elem_aliases = parse_GC_aliases(card_response.text)
+        elem_gc_name = gc_name_from_url(card_response.url)
+        if gene_name in elem_aliases or gene_name == elem_gc_name:
+            if elem_gc_name is not None and elem_gc_name not in elem_aliases:
+                elem_aliases.insert(0, elem_gc_name)
+            if aliases_dir:
+                write_aliases_f(elem_aliases, aliases_fpath)
+            return elem_aliases
+    if fetch_errors:
+        #Unfetched cards may have listed gene_name
+        raise fetch_errors[0]
+    raise GeneCardsError(0, "Could not automatically fetch alias data from GeneCards - consider searching manually")
+
+def download_alias_data(gene_list, config, progress=None):
+    """Fetches GeneCards alias data into the alias store ([ALIASES] AliasDBPath, see SSutility.SSaliases) for every
+    symbol in gene_list without stored or HGNC imported aliases or logged GeneCardsErrors. By default pages are fetched
+    over plain HTTP by a pool of GeneCardsMaxWorkers workers sharing a GeneCardsRequestsPerSecond rate limit
+    ([GeneCards] config section); GeneCardsUseBrowser = yes uses the selenium Chrome WebDriver instead.
+
+    :param progress: Optional SSorchestrator.AcquisitionProgress, advanced under 'GeneCards' per completed query
+    """
+    from SSacquisition.SSdownload import configured_engine
+    from SSutility.SSaliases import alias_store
+    if config.getboolean('GeneCards', 'GeneCardsUseBrowser', fallback=False):
+        download_alias_data_browser(gene_list, config)
+        return
+    run_name,errors_fname = config['RUN']['RunName'],config['RUN']['ErrorsFileName']
+    errors_fpath = "{0}/{1}".format(run_name,errors_fname)
+    errors = error_registry(errors_fpath)
+    store = alias_store(config)
+    store.import_alias_files("alias_data", gene_list)
+    stored_aliases = store.batch_aliases(gene_list)
+    query_genes = []
+    for gene_name in gene_list:
+        if gene_name not in stored_aliases:
+            if errors.has(gene_name, error_type="GeneCardsError"):
+                errors.print_gene(gene_name, error_type="GeneCardsError")
+            else:
+                query_genes.append(gene_name)
+    if progress is not None:
+        progress.start("GeneCards", len(query_genes))
+    rps = config.getfloat('GeneCards', 'GeneCardsRequestsPerSecond', fallback=2)
+    max_workers = config.getint('GeneCards', 'GeneCardsMaxWorkers', fallback=4)
+    engine = configured_engine(config, rps, max_workers)
+    engine.session.headers.update(GC_HEADERS)
+    query_func = lambda gene_name: alias_GC_http_query(engine, gene_name, aliases_dir=None)
+    #Results are stored from this thread as they complete; the store connection is not shared with workers
+    for gene_name, aliases, error in engine.map(query_func, query_genes):
+        if progress is not None:
+            progress.advance("GeneCards", failed=error is not None)
+        if isinstance(error, GeneCardsError):
+            write_errors(errors_fpath, gene_name, error)
+        elif error is not None:
+            #Network failures are not logged so that the symbol is retried next run
+            print("{0}\tGeneCards request failed: {1}".format(gene_name, error))
+        else:
+            store.put_aliases(gene_name, aliases, source="GeneCards")
+    engine.close()
+    store.close()
+
+def download_alias_data_browser(gene_list, config):
+    from SSutility.SSaliases import alias_store
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
     chrome_options = Options()
     chrome_options.add_argument("--headless")
     window_size = "1920,1080"
@@ -106,18 +247,23 @@ def download_alias_data(gene_list, config):
     # driver.implicitly_wait(5)
     run_name,errors_fname = config['RUN']['RunName'],config['RUN']['ErrorsFileName']
     errors_fpath = "{0}/{1}".format(run_name,errors_fname)
-    check_error_file, gc_errors_df = load_errors(errors_fpath,"GeneCardsError")
+    errors = error_registry(errors_fpath)
+    store = alias_store(config)
+    stored_aliases = store.batch_aliases(gene_list)
     for gene_name in gene_list:
         aliases_fpath = "alias_data/{0}_aliases.txt".format(gene_name)
-        if not os.path.exists(aliases_fpath):
-            if check_error_file and gene_name in gc_errors_df["gene_symbol"].unique():
-                print_errors(gc_errors_df, gene_name)
+        if gene_name not in stored_aliases and not os.path.exists(aliases_fpath):
+            if errors.has(gene_name, error_type="GeneCardsError"):
+                errors.print_gene(gene_name, error_type="GeneCardsError")
             else:
                 try:
                     alias_GC_query(driver, gene_name)
                 except GeneCardsError as gc_error:
                     write_errors(errors_fpath,gene_name,gc_error)
     driver.quit()
+    #alias_GC_query writes alias_data text files; move the new results into the store
+    store.import_alias_files("alias_data", gene_list)
+    store.close()
 
 def __clean_alias_data_dir(src_dir_path, target_dir_path, gene_symbols):
     """Creates a new directory at target_dir_path, copies any _alias.txt files from src_dir_path to target_dir_path
@@ -16,7 +16,6 @@
 
 import pandas as pd
 import numpy as np
-from IPython.display import display
 
 def calculate_sequence_weights(msa):
     """Calculate the sequence weights using the Henikoff '94 method for the given multiple sequence alignment. Briefly,
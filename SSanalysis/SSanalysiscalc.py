@@ -18,12 +18,12 @@
 import pandas as pd
 import numpy as np
 import os
+import functools
 
-from IPython.display import display
 from collections import OrderedDict
 from SSanalysis import JSDcalc
 from SSutility.SSerrors import SequenceAnalysisError
-from SSutility.SSfasta import align_fasta_to_df
+from SSutility.SSalignment import Alignment, GAP, codes
 
 def gen_blos_df():
     from Bio.SubsMat.MatrixInfo import blosum62
@@ -39,35 +39,53 @@ def gen_blos_df():
     bg_probs = [0.078, 0.051, 0.041, 0.052, 0.024, 0.034, 0.059, 0.083, 0.025, 0.062, 0.092, 0.056, \
                 0.024, 0.044, 0.043, 0.059, 0.055, 0.014, 0.034, 0.072]
     blosum62_bg = bg_probs
-    blos_df = pd.DataFrame(index=aas[:-1],columns=aas[:-1])
-    for pair in blosum62:
-        val = blosum62[pair]
-        first, second = pair[0],pair[1]
-        if first in aas and second in aas:
-            blos_df.loc[first,second] = val
-            blos_df.loc[second,first] = val
+    aa_pos = dict((aa, i) for i, aa in enumerate(aas[:-1]))
+    blos_values = np.full((len(aa_pos), len(aa_pos)), np.nan, dtype=object)
+    for (first, second), val in blosum62.items():
+        if first in aa_pos and second in aa_pos:
+            blos_values[aa_pos[first], aa_pos[second]] = val
+            blos_values[aa_pos[second], aa_pos[first]] = val
+    blos_df = pd.DataFrame(blos_values, index=aas[:-1], columns=aas[:-1])
     sim_matrix = blos_df.values
     return aas, blosum62_bg, blos_df, sim_matrix
 
+@functools.lru_cache(maxsize=None)
+def blosum_data():
+    """(aas, blosum62_bg, blos_df, sim_matrix) from gen_blos_df, built on first use."""
+    return gen_blos_df()
+
+BLOSUM_GLOBALS = ['aas', 'blosum62_bg', 'blos_df', 'sim_matrix']
+
+def __getattr__(name):
+    #Module level BLOSUM globals (aas, blosum62_bg, blos_df, sim_matrix) are built on first access
+    if name in BLOSUM_GLOBALS:
+        return blosum_data()[BLOSUM_GLOBALS.index(name)]
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+def as_alignment(align_df):
+    #Analysis functions accept SSalignment.Alignment objects or (legacy) object DataFrames of alignment characters
+    if isinstance(align_df, Alignment):
+        return align_df
+    return Alignment.from_df(align_df)
+
 def find_uniques(align_df, sub_freq_threshold, test_species_idx,display_uniques=False):
     """Identifies unnique positions from align_df with frequency <= sub_fre_threshold
 
-    :param align_df: DataFrame of alignment characters. Columns: 1-indexed alignment positions, Index: record ids
+    :param align_df: SSalignment.Alignment or DataFrame of alignment characters. Columns: 1-indexed alignment
+    positions, Index: record ids
     :param (int) sub_freq_threshold: max allowed number of instances of a substitution for it to be considered unique
     :param test_species_idx: record_id for test_species record in align_df for which uniques will be identified
     :param (boolean) display_uniques: If true, displays table of unique residues identified
-    :return:
+    :return: uniques: DataFrame of alignment characters at unique positions
     """
-    uniques = pd.DataFrame(index=align_df.index)
-    for pos in align_df:
-        col = align_df[pos]
-        sub_counts = col.value_counts()
-        test_var = col[test_species_idx][0]
-        test_vc = sub_counts[test_var]
-        if test_vc <= sub_freq_threshold and test_var!='X':
-            uniques.loc[:,pos] = col
+    alignment = as_alignment(align_df)
+    test_codes = alignment.rows(test_species_idx).data[0]
+    test_counts = (alignment.data == test_codes).sum(axis=0)
+    unique_mask = (test_counts <= sub_freq_threshold) & (test_codes != ord('X'))
+    uniques = alignment.positions(alignment.columns[unique_mask]).to_df()
     if display_uniques:
         print("Threshold Number of Sequences: "+str(int(sub_freq_threshold)))#/len(ordered)))
+        from IPython.display import display
         display(uniques)
     return uniques
 
@@ -82,17 +100,14 @@ def sub_fraction(col, sub):
 def align_pos_to_native_pos(align_df, idx, align_pos):
     """Converts alignment position to native sequence position (ie ignores gaps).
 
-    :param align_df: DataFrame of msa characters
+    :param align_df: SSalignment.Alignment or DataFrame of msa characters
     :param idx: Index (row) of align_df to use for native position
     :param align_pos: alignment column position to convert to native position
     :return: native_pos: converted alignment position
     """
-    pre_pos = align_df.loc[idx.values[0],:align_pos-1]
-    pre_pos_vc = pre_pos.value_counts()
-    native_pos = align_pos
-    if '-' in pre_pos_vc:
-        native_pos -= pre_pos_vc['-']
-    return native_pos
+    alignment = as_alignment(align_df)
+    row = alignment.row(idx.values[0])
+    return align_pos - int((row[:alignment.columns.get_loc(align_pos)] == GAP).sum())
 
 
 def calc_z_scores(scores):
@@ -118,17 +133,18 @@ def generate_jsd_series(test_idx,align_df,
     https://compbio.cs.princeton.edu/conservation/
     :param test_species: index value in align_df corresponding to test_species. Row will be removed from calculation
     unless keep_test_spec set to True.
-    :param align_df: DataFrame containing multiple sequence alignment (1-indexed positions as columns, record ids as index
+    :param align_df: SSalignment.Alignment or DataFrame containing multiple sequence alignment (1-indexed positions as
+    columns, record ids as index)
     :param (boolean) keep_test_spec: Determines whether JSD calculation is done on outgroup or all records in align_df
     :return jsd_srs: pandas Series containing JSD values at each position (1-indexed)
     :return jsd_zscores: pandas Series containing JSD z-score (calculated using mean and std of this alignment only)
     """
-    jsd_srs = pd.Series(index=align_df.columns)
-    if keep_test_spec:
-        jsd_df = align_df.copy()
-    else:
-        jsd_df = align_df.drop(test_idx,axis=0)
-    jsd_nd = jsd_df.values
+    alignment = as_alignment(align_df)
+    jsd_srs = pd.Series(index=alignment.columns, dtype=float)
+    if not keep_test_spec:
+        alignment = alignment.drop(test_idx)
+    jsd_nd = alignment.chars()
+    aas, blosum62_bg = blosum_data()[:2]
     weights = JSDcalc.calculate_sequence_weights(jsd_nd)
     for i,col in enumerate(jsd_nd.T):
         jsd = JSDcalc.JSD(col,blosum62_bg,weights,aas,use_gap_penalty=use_gap_penalty)
@@ -194,21 +210,32 @@ def test_outgroup_blosum(col,test_spec_idx,blos_df):
         blos_mean = np.nan
     return blos_mean
 
+def blosum_table(blos_df):
+    """256 x 256 float array of blos_df scores indexed by residue codes (NaN for characters not in blos_df)."""
+    table = np.full((256, 256), np.nan)
+    table[np.ix_(codes(blos_df.index), codes(blos_df.columns))] = blos_df.values.astype(float)
+    return table
+
 def test_outgroup_blosum_series(align_df,test_spec_idx,blos_df):
-    """Returns series of scores/z-scores for test vs outgroup blosum values for entire align_df.
+    """Returns series of scores/z-scores for test vs outgroup blosum values for entire align_df (see
+    test_outgroup_blosum), computed for all positions at once.
 
-    :param align_df: MSA DataFrame
+    :param align_df: SSalignment.Alignment or MSA DataFrame
     :param test_spec_idx: Index object corresponding to test_species. Remaining species in align_df considered outgroup
     :param blos_df: Blosum62 DataFrame
     :return: blos_srs: Series of test vs outgroup BLOSUM62 scores
     :return: blos_z: Z-scores calculated for above series
     """
-    blos_srs = pd.Series(index=align_df.columns)
-    for pos in align_df.columns:
-        aln_col = align_df.loc[:,pos]
-        blos_mean = test_outgroup_blosum(aln_col,test_spec_idx,blos_df)
-        blos_srs[pos] = blos_mean
-    blos_srs.name = "Test-Outgroup BLOSUM62"
+    alignment = as_alignment(align_df)
+    skip_codes = codes(['X','-','U'])
+    test_codes = alignment.rows(test_spec_idx).data[0]
+    outgroup = alignment.drop(test_spec_idx).data
+    scores = blosum_table(blos_df)[test_codes, outgroup]
+    valid = ~np.isin(outgroup, skip_codes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        blos_means = np.where(valid, scores, 0).sum(axis=0) / valid.sum(axis=0)
+    blos_means[np.isin(test_codes, skip_codes)] = np.nan
+    blos_srs = pd.Series(data=blos_means, index=alignment.columns, name="Test-Outgroup BLOSUM62")
     blos_z = calc_z_scores(blos_srs)
     return blos_srs, blos_z
 
@@ -241,7 +268,8 @@ def gene_summary_table(align_df, ncbi_idx, test_idx,blos_df, display_summary=Fal
     """Given an align_df representing OrthoDB and NCBI record multiple sequence alignment, calculates JSD, BLOSUM,
     gap and variant metrics for the OrthoDB records only.
 
-    :param align_df: OrthoDB and NCBI MSA DataFrame. Columns are 1-indexed alignment positions and index is record ids.
+    :param align_df: OrthoDB and NCBI MSA (SSalignment.Alignment or DataFrame). Columns are 1-indexed alignment
+    positions and index is record ids.
     :param ncbi_idx: Record id of NCBI record. Excluded from analysis calculations if drop_NCBI=True. Stored in
     AGS Variant column in summary table
     :param test_idx: Record id of test_species (all other ODB records will be used as the outgroup for JSD and BLOSUM)
@@ -251,20 +279,21 @@ def gene_summary_table(align_df, ncbi_idx, test_idx,blos_df, display_summary=Fal
     analysis calculations
     :return:
     """
+    alignment = as_alignment(align_df)
     if drop_NCBI:
-        analysis_df = align_df.drop(index=ncbi_idx)
+        analysis_aln = alignment.drop(ncbi_idx)
     else:
-        analysis_df = align_df
-    unique_thresh = max(int(len(analysis_df)*0.1), 1)
-    uniques = find_uniques(analysis_df,unique_thresh,test_idx)
+        analysis_aln = alignment
+    unique_thresh = max(int(len(analysis_aln)*0.1), 1)
+    uniques = find_uniques(analysis_aln,unique_thresh,test_idx)
     unique_pos = uniques.columns
     if len(unique_pos) == 0:
         raise SequenceAnalysisError(0,"No species unique substitutions under occurence " 
                                       "threshold {0} instances".format(unique_thresh))
-    n_seq = len(analysis_df)
+    n_seq = len(analysis_aln)
     #Calculate JSD and BLOSUM + z-scores for entire alignment
-    jsd, jsd_z = generate_jsd_series(test_idx,analysis_df,keep_test_spec=False,use_gap_penalty=use_jsd_gap_penalty)
-    test_og_blos_srs, test_og_blos_z_srs = test_outgroup_blosum_series(analysis_df,test_idx,blos_df)
+    jsd, jsd_z = generate_jsd_series(test_idx,analysis_aln,keep_test_spec=False,use_gap_penalty=use_jsd_gap_penalty)
+    test_og_blos_srs, test_og_blos_z_srs = test_outgroup_blosum_series(analysis_aln,test_idx,blos_df)
     summary_col_labels = ['Test Species Position','Test Variant','AGS Variant','Test Variant Count',
                           'Outgroup Variant', 'Outgroup Variant Count', 'Analysis Sequences', 'Gap Fraction',
                           'JSD','JSD Z-Score','Test-Outgroup BLOSUM62', 'Test-Outgroup BLOSUM Z-Score',
@@ -280,13 +309,14 @@ def gene_summary_table(align_df, ncbi_idx, test_idx,blos_df, display_summary=Fal
         test_og_blos,test_og_blos_z = test_og_blos_srs[pos],test_og_blos_z_srs[pos]
         #Calculate outgroup pairwise BLOSUM, native sequence position of substitution in test-species
         og_pw_blos = pairwise_outgroup_blosum(aln_col,test_idx,blos_df)
-        native_pos = align_pos_to_native_pos(analysis_df,test_idx,pos)
-        ags_var = align_df.loc[ncbi_idx,pos][0]
+        native_pos = align_pos_to_native_pos(analysis_aln,test_idx,pos)
+        ags_var = chr(alignment.rows(ncbi_idx).column(pos)[0])
         row_dict = dict(zip(summary_col_labels,[native_pos,tv,ags_var,tvc,ov,ovc,n_seq,gf,jsd[pos],
                                                 jsd_z[pos],test_og_blos,test_og_blos_z,og_pw_blos]))
         summary_df.loc[pos,:] = row_dict
     if display_summary:
         print("Test Species Index: {0}".format(test_idx))
+        from IPython.display import display
         display(summary_df)
     if summary_table_outpath:
         summary_df.to_csv(summary_table_outpath,sep='\t',float_format='%.5f')
@@ -296,7 +326,7 @@ def load_summary_table(summary_fpath):
     summary_df = pd.read_csv(summary_fpath,sep='\t',index_col=0)
     return summary_df
 
-def overall_summary_table(config, gene_symbols,use_jsd_gap_penalty=True,force_recalc=False):
+def overall_summary_table(config, gene_symbols,use_jsd_gap_penalty=True,force_recalc=False,ledger=None):
     """Calculates summary analysis statistics for every gene symbol in gene_symbols.
 
     :param config: configparser object from config/config.txt
@@ -305,12 +335,15 @@ def overall_summary_table(config, gene_symbols,use_jsd_gap_penalty=True,force_re
     this, it is recommended to set force_recalc to True to avoid any inconsistencies between files calculated before
     the change and after.
     :param force_recalc: If True, recalculates and rewrites all summary statistic data.
+    :param ledger: Optional SSutility.SSbuild.BuildLedger. If provided, gene summaries are recalculated when their MSA,
+    records table or analysis settings changed since they were written (see SSbuild.analysis_inputs) instead of only
+    when missing.
     :return: None. Writes individual gene summary tables to appropriate output subdirectories and overall summary table
     to [run_name]/summary/overall_summary.tsv Overall_summary table contains new columns corresponding to 1) gene symbol,
     2) gene-specific MSA position, 3, 4) Unique Substitution Wide Z-scores for JSD and Test-Outgroup BLOSUM
     MSA position,
     """
-    from SSutility.SSerrors import load_errors, write_errors, print_errors
+    from SSutility.SSerrors import error_registry, write_errors
     run_name,errors_fname = config['RUN']['RunName'],config['RUN']['ErrorsFileName']
     ODB_test_id, NCBI_taxid = config['ODB']['ODBTestTaxID'], config['NCBI']['NCBITaxID']
     errors_fpath = "{0}/{1}".format(run_name,errors_fname)
@@ -324,16 +357,22 @@ def overall_summary_table(config, gene_symbols,use_jsd_gap_penalty=True,force_re
                                   'Test-Outgroup BLOSUM US Z-Score','Outgroup Pairwise BLOSUM62']
     overall_df = pd.DataFrame(columns=overall_summary_col_labels)
     overall_summary_fpath = "{0}/summary/overall_summary.tsv".format(run_name)
-    check_errors, errors_df = load_errors(errors_fpath)
+    blos_df = blosum_data()[2]
+    errors = error_registry(errors_fpath)
     for symbol in gene_symbols:
         summary_outpath = "{0}/output/{1}/{1}_summary.tsv".format(run_name,symbol)
-        if not os.path.exists(summary_outpath) or force_recalc:
+        if ledger is not None:
+            from SSutility.SSbuild import analysis_inputs
+            build_inputs = analysis_inputs(config,symbol,use_jsd_gap_penalty)
+            stale = not ledger.is_fresh('analysis',symbol,build_inputs,[summary_outpath])
+        else:
+            stale = not os.path.exists(summary_outpath)
+        if stale or force_recalc:
             #Check logged errors before attempting analysis. All logged errors will cause analysis to be skipped.
             #Logged SequenceAnalysisErrors are printed to stdout (others are passed over silently)
-            if check_errors and symbol in errors_df['gene_symbol'].unique():
-                sae_df = errors_df.loc[errors_df['error_type']=="SequenceAnalysisError",:]
-                if symbol in sae_df['gene_symbol'].unique():
-                    print_errors(sae_df,symbol)
+            if errors.has(symbol):
+                if errors.has(symbol,error_type="SequenceAnalysisError"):
+                    errors.print_gene(symbol,error_type="SequenceAnalysisError")
                 continue
             try:
                 msa_fpath =  "{0}/output/{1}/{1}_msa.fasta".format(run_name,symbol)
@@ -342,11 +381,13 @@ def overall_summary_table(config, gene_symbols,use_jsd_gap_penalty=True,force_re
                 records_df.index.name = "record_id"
                 ncbi_idx = records_df.loc[records_df['db_source']=="NCBI",:].index
                 test_idx = records_df.loc[records_df['organism_taxid']==ODB_test_id,:].index
-                align_df = align_fasta_to_df(msa_fpath)
+                align_df = Alignment.from_fasta(msa_fpath)
 
                 summary_df = gene_summary_table(align_df,ncbi_idx,test_idx,blos_df,
                                display_summary=False,drop_NCBI=True,summary_table_outpath=summary_outpath,
                                 use_jsd_gap_penalty=use_jsd_gap_penalty)
+                if ledger is not None:
+                    ledger.record('analysis',symbol,build_inputs,[summary_outpath])
             except SequenceAnalysisError as sae:
                 write_errors(errors_fpath,symbol,sae)
                 continue
@@ -361,6 +402,7 @@ def overall_summary_table(config, gene_symbols,use_jsd_gap_penalty=True,force_re
     display_overall=False
     if display_overall:
         with pd.option_context('display.max_columns',None):
+            from IPython.display import display
             display(overall_df)
     #Unique Substitution Set-wide Z scores for JSD and BLOSUM
     us_jsd, us_blos = calc_z_scores(overall_df['JSD']), calc_z_scores(overall_df['Test-Outgroup BLOSUM62'])
@@ -369,6 +411,3 @@ def overall_summary_table(config, gene_symbols,use_jsd_gap_penalty=True,force_re
     overall_df.to_csv(overall_summary_fpath,sep='\t',float_format='%.5f')
     return overall_df
 
-
-#Global variables for module
-aas, blosum62_bg, blos_df, sim_matrix = gen_blos_df()
\ No newline at end of file
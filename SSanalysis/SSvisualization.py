@@ -20,7 +20,6 @@ import os
 import numpy as np
 import matplotlib as mpl
 
-from IPython.display import display
 
 mpl.rcParams['figure.dpi'] = 200
 mpl.rcParams['savefig.dpi'] = 200
@@ -1,3 +1,9 @@
-from SSanalysis.SSanalysiscalc import gen_blos_df
+#BLOSUM data (aas, blosum62_bg, blos_df, sim_matrix) is built by SSanalysiscalc.blosum_data on first access
+BLOSUM_GLOBALS = ['aas', 'blosum62_bg', 'blos_df', 'sim_matrix']
 
-aas, blosum62_bg, blos_df, sim_matrix = gen_blos_df()
\ No newline at end of file
+
+def __getattr__(name):
+    if name in BLOSUM_GLOBALS:
+        from SSanalysis.SSanalysiscalc import blosum_data
+        return blosum_data()[BLOSUM_GLOBALS.index(name)]
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
@@ -20,35 +20,53 @@ import pandas as pd
 import os
 import re
 from SSutility import SSfasta, SSdirectory
-from IPython.display import display
+from SSutility.SSfastareader import fasta_records, seq_str
 import warnings
+import itertools
 from Bio import SeqIO,Seq
 from SSfilter.ODBfilter import min_dist_spec_record, process_ODB_input
+from SSutility.SSconfig import NCBI_tax_dicts
+from SSutility.SStaxonomy import taxonomy_catalog
 
 def load_NCBI_fasta_df(NCBI_fasta_fpath,taxid_dict):
     """Reads NCBI fasta into DataFrame, extracting available fields into appropritate columns
 
     :param NCBI_fasta_fpath: File path to NCBI fasta
-    :param taxid_dict: maps species names to NCBI_taxids
+    :param taxid_dict: maps species names to NCBI_taxids; other species names are looked up in the OrthoDB
+    taxonomy catalog (SSutility.SStaxonomy)
     :return: DataFrame populated with record information from NCBI fasta 
     """
-    ncbi_fastas = SeqIO.parse(NCBI_fasta_fpath, 'fasta')
     ncbi_df = pd.DataFrame(columns=["organism_taxid", "organism_name", "description", "length", "seq"])
-    for fasta in ncbi_fastas:
+    for fasta_id, fasta_description, fasta_seq in fasta_records(NCBI_fasta_fpath):
         row_dict = {}
-        desc_remaining = re.search("{0}(.*)".format(fasta.id), fasta.description).groups()[0]
+        desc_remaining = re.search("{0}(.*)".format(fasta_id), fasta_description).groups()[0]
         if desc_remaining:
             #If standard format description string, will extract species name and description.
             desc_remaining = desc_remaining.strip()
             organism_name = re.search(r"\[(\w+\s\w+(\s\w+)?)\]$", desc_remaining).groups()[0].strip()
-            organism_taxid = taxid_dict[organism_name]
+            if organism_name in taxid_dict:
+                organism_taxid = taxid_dict[organism_name]
+            else:
+                organism_taxid = str(taxonomy_catalog().tax_id(organism_name))
             row_dict['organism_name'],row_dict['organism_taxid'] = organism_name,organism_taxid
             row_dict['description']  = desc_remaining
-        row_dict['seq'],row_dict['length']= str(fasta.seq),len(str(fasta.seq))
-        f_row = pd.Series(data=row_dict,name=fasta.id)
+        row_dict['seq'],row_dict['length']= seq_str(fasta_seq),len(fasta_seq)
+        f_row = pd.Series(data=row_dict,name=fasta_id)
         ncbi_df = ncbi_df.append(f_row)
     return ncbi_df
 
+def NCBI_fasta_paths(config, symbol):
+    """Returns list of (tax_dict, NCBI fasta path) for symbol for each configured NCBI species (see
+    SSconfig.NCBI_tax_dicts). The [NCBI] species is always included; additional species only if records were
+    downloaded for symbol."""
+    run_name = config['RUN']['RunName']
+    species_fpaths = []
+    for tax_dict in NCBI_tax_dicts(config):
+        ncbi_fpath = "{0}/input/NCBI/{1}/{2}.fasta".format(run_name, tax_dict['taxid'], symbol)
+        if tax_dict['primary'] or os.path.exists(ncbi_fpath):
+            species_fpaths.append((tax_dict, ncbi_fpath))
+    return species_fpaths
+
 def select_NCBI_record(ODB_fasta_fpath,NCBI_fasta_fpath,taxid_dict,ODB_final_input_df,compare_taxids):
     """Selects best NCBI record from NCBI fasta fpath by max identity to the OrthoDB records represented by compare_taxids.
 
@@ -64,13 +82,11 @@ def select_NCBI_record(ODB_fasta_fpath,NCBI_fasta_fpath,taxid_dict,ODB_final_inp
     """
     ncbi_df = load_NCBI_fasta_df(NCBI_fasta_fpath,taxid_dict)
     if len(ncbi_df) > 1:
-        #Align all unfiltered NCBI records against ODB_final_input records
-        combined_unaln_fpath,combined_aln_fpath = "tmp/ODB_NCBI_unaln.fasta","tmp/ODB_NCBI_aln.fasta"
+        #Align all unfiltered NCBI records against ODB_final_input records (see SSutility.SSaligner)
         unaln_generator = SSfasta.ODB_NCBI_generator(ODB_fasta_fpath,NCBI_fasta_fpath,odb_subset=ODB_final_input_df.index)
-        SeqIO.write(unaln_generator, combined_unaln_fpath, "fasta")
         combined_df = ODB_final_input_df.append(ncbi_df,sort=False)
         # display(combined_df)
-        id_dm, align_srs = SSfasta.construct_id_dm(combined_df,combined_unaln_fpath,align_outpath=combined_aln_fpath)
+        id_dm, align_srs = SSfasta.records_id_dm(unaln_generator)
         spec_record_ids= ncbi_df.index
         compare_record_ids = ODB_final_input_df.loc[ODB_final_input_df['organism_taxid'].isin(compare_taxids)].index
         md_row,min_dist = min_dist_spec_record(id_dm,align_srs.index,spec_record_ids,compare_record_ids,combined_df)
@@ -106,13 +122,17 @@ def annotate_source_and_filter(config,symbol,combined_df,am_df,em_df,
     combined_df.loc[odb_records_idx, 'db_source'] = "OrthoDB"
     combined_df.loc[ncbi_records_idx, 'db_source'] = "NCBI"
 
-    unfiltered_NCBI_fasta = "{0}/input/NCBI/{1}/{2}.fasta".format(run_name, ncbi_taxid, symbol)
-    unf_ncbi_srs = SSfasta.fasta_to_srs(unfiltered_NCBI_fasta)
-    if len(unf_ncbi_srs) > 1:
-        ncbi_filt = "NCBI min dist"
-    else:
-        ncbi_filt = "NCBI single record"
-    combined_df.loc[ncbi_records_idx, selection_col] = ncbi_filt
+    #NCBI records from additional species (see SSconfig.NCBI_tax_dicts) are labeled from their own species' fasta
+    for ncbi_record_id in ncbi_records_idx:
+        record_taxid = combined_df.loc[ncbi_record_id, 'organism_taxid']
+        record_taxid = ncbi_taxid if pd.isnull(record_taxid) else record_taxid
+        unfiltered_NCBI_fasta = "{0}/input/NCBI/{1}/{2}.fasta".format(run_name, record_taxid, symbol)
+        unf_ncbi_srs = SSfasta.fasta_to_srs(unfiltered_NCBI_fasta)
+        if len(unf_ncbi_srs) > 1:
+            ncbi_filt = "NCBI min dist"
+        else:
+            ncbi_filt = "NCBI single record"
+        combined_df.loc[ncbi_record_id, selection_col] = ncbi_filt
 
     for record_id,row in combined_df.loc[odb_records_idx,:].iterrows():
         taxid = row['organism_taxid']
@@ -161,7 +181,8 @@ def combined_records_processing(config,am_df,em_df,combined_df,
     :param combined_df: ODB and NCBI combined record DataFrame as returned by select_NCBI_record
     :param symbol: Gene symbol
     :param odb_fasta,ncbi_fasta: If provided, will use as sources for records to write final dataset sequences from. If
-    not provided, defaults to unfiltered OrthoDB and NCBI fasta paths given run_name and symbol
+    not provided, defaults to unfiltered OrthoDB and NCBI fasta paths given run_name and symbol. ncbi_fasta can be a
+    list of fasta paths (one per NCBI species, in combined_df record order).
     :param out_unaln_fasta,out_aln_fasta: If provided, will write unaligned/aligned final record Sequence set to
     these paths. If not provided, uses default output directory path for symbol.
     :return: processed_df: DataFrame modified to include record distance, db_source, and filter_type
@@ -170,7 +191,9 @@ def combined_records_processing(config,am_df,em_df,combined_df,
     if not odb_fasta:
         odb_fasta = "{0}/input/ODB/{1}.fasta".format(run_name,symbol)
     if not ncbi_fasta:
-        ncbi_fasta = "{0}/input/NCBI/{1}/{2}.fasta".format(run_name,ncbi_taxid,symbol)
+        ncbi_fasta = [ncbi_fpath for tax_dict, ncbi_fpath in NCBI_fasta_paths(config, symbol)]
+    elif isinstance(ncbi_fasta, str):
+        ncbi_fasta = [ncbi_fasta]
     if not out_unaln_fasta:
         out_unaln_fasta = "{0}/output/{1}/{1}.fasta".format(run_name,symbol)
     if not out_aln_fasta:
@@ -184,9 +207,10 @@ def combined_records_processing(config,am_df,em_df,combined_df,
     #Final unaligned and aligned Fasta writing
     odb_records_idx = combined_df.index[combined_df.index.isin(am_df.index)]
     ncbi_records_idx = combined_df.index[~combined_df.index.isin(am_df.index)]
-    combined_records = SSfasta.ODB_NCBI_generator(odb_fasta,ncbi_fasta,odb_subset=odb_records_idx,
+    combined_records = SSfasta.ODB_NCBI_generator(odb_fasta,ncbi_fasta[0],odb_subset=odb_records_idx,
                                           ncbi_subset=ncbi_records_idx,ordered=True)
-    SeqIO.write(combined_records, out_unaln_fasta, 'fasta')
+    extra_records = [SSfasta.ordered_record_generator(extra_fasta, ncbi_records_idx) for extra_fasta in ncbi_fasta[1:]]
+    SeqIO.write(itertools.chain(combined_records, *extra_records), out_unaln_fasta, 'fasta')
     #Internal distance calculation
     id_dm, aln_srs = SSfasta.construct_id_dm(combined_df,out_unaln_fasta,align_outpath=out_aln_fasta)
     dist_srs = SSfasta.avg_dist_srs(combined_df.index,id_dm)
@@ -198,23 +222,31 @@ def combined_records_processing(config,am_df,em_df,combined_df,
     combined_processed.to_csv(out_tsv_fpath,sep='\t')
     return combined_processed
 
-def final_combined_input(config,symbol,tax_subset):
+def final_combined_input(config,symbol,tax_subset,aliases=None):
     """Processes raw OrthoDB and NCBI record data into final input set, written to [run_name]/output/symbol.
 
     :param config: configparser object from config/config.txt
     :param symbol: gene symbol string used for file paths
     :param tax_subset: subset of taxonomy IDs which will be used to filter raw OrthoDB input
+    :param aliases: Alias list for symbol from ODBfilter.load_alias_dict; if None, read from alias_data per gene
     :return: N/A. Writes output files to [run_name]/output subdirectories or raises SequenceDataError (handled in
     spec_subs_main.py)
     """
-    run_name,ncbi_taxid,ncbi_name = config['RUN']['RunName'],config['NCBI']['NCBITaxID'],config['NCBI']['NCBITaxName']
+    run_name = config['RUN']['RunName']
     odb_test_taxid = config['ODB']['ODBTestTaxID']
-    taxid_dict = {ncbi_name: ncbi_taxid}
+    species_fpaths = NCBI_fasta_paths(config, symbol)
+    taxid_dict = dict((tax_dict['spec_name'], tax_dict['taxid']) for tax_dict, ncbi_fpath in species_fpaths)
 
     odb_fpath = "{0}/input/ODB/{1}.fasta".format(run_name, symbol)
-    ncbi_fpath = "{0}/input/NCBI/{1}/{2}.fasta".format(run_name, ncbi_taxid, symbol)
-    results = process_ODB_input(symbol, config, tax_subset)
+    results = process_ODB_input(symbol, config, tax_subset, aliases=aliases)
     final_odb, em_df, am_df = results['final_df'], results['em_df'], results['am_df']
-    final_combined = select_NCBI_record(odb_fpath, ncbi_fpath, taxid_dict,
-                                                   final_odb, [odb_test_taxid])
-    combined_records_processing(config, am_df, em_df, final_combined, symbol)
\ No newline at end of file
+    #Closest record per NCBI species, selected independently against the OrthoDB records; the [NCBI] species record
+    #is first
+    ncbi_dfs = []
+    for tax_dict, ncbi_fpath in species_fpaths:
+        species_combined = select_NCBI_record(odb_fpath, ncbi_fpath, taxid_dict, final_odb, [odb_test_taxid])
+        ncbi_dfs.append(species_combined.loc[~species_combined.index.isin(final_odb.index)])
+    final_combined = pd.concat([final_odb] + ncbi_dfs, sort=False)
+    final_combined.index.name = "record_id"
+    combined_records_processing(config, am_df, em_df, final_combined, symbol,
+                                ncbi_fasta=[ncbi_fpath for tax_dict, ncbi_fpath in species_fpaths])
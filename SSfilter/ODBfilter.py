@@ -14,13 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from SSutility.SSerrors import load_errors, SequenceDataError, write_errors
+from SSutility.SSerrors import error_registry, SequenceDataError, write_errors, QC_COLUMNS
 import numpy as np
 import pandas as pd
 import os
 import re
 from SSutility import SSfasta
-from IPython.display import display
 import warnings
 
 def format_odb_field(field):
@@ -43,35 +42,59 @@ def odb_field_to_re(field):
     return field_re
 
 
-def find_alias_matches(symbol, tsv_df, errors_fpath):
+def load_alias_file(symbol, errors_fpath, aliases_dir="alias_data"):
+    """Per gene alias lookup from a legacy alias_data/<symbol>_aliases.txt file. Returns an empty list if the GeneCards
+    query for symbol failed or there is no alias file."""
+    aliases_fpath = "{0}/{1}_aliases.txt".format(aliases_dir,symbol)
+    if error_registry(errors_fpath).has(symbol,error_type="GeneCardsError") or not os.path.exists(aliases_fpath):
+        return []
+    with open(aliases_fpath, 'r') as aliases_f:
+        return [alias.strip() for alias in aliases_f.readlines()]
+
+
+def load_alias_dict(config, gene_symbols):
+    """Batch loads alias lists for all gene_symbols from the alias store ([ALIASES] AliasDBPath) in one query per
+    chunk of symbols, after importing any legacy alias_data text files for gene_symbols not yet in the store.
+
+    :param config: configparser object
+    :param gene_symbols: iterable of gene symbols
+    :return (dict): gene symbol to alias list (primary symbol first); symbols without alias data map to empty lists
+    """
+    from SSutility.SSaliases import alias_store
+    gene_symbols = list(gene_symbols)
+    store = alias_store(config)
+    store.import_alias_files("alias_data", gene_symbols)
+    stored_aliases = store.batch_aliases(gene_symbols)
+    store.close()
+    return dict((symbol, stored_aliases.get(symbol, [])) for symbol in gene_symbols)
+
+
+def find_alias_matches(symbol, tsv_df, errors_fpath, aliases=None):
     """Returns a list of the orthodb ids of the reference sequences from an OrthoDB tsv_df and a set containing
     symbol and the GeneCards primary alias for symbol (if it differs from symbol)
     These reference sequences are defined as records with pub_gene_id, og_, or description having a
     text match to either symbol or one of the GeneCards listed aliases for symbol.
-    Alias data is fetched from GeneCards automatically and stored in the aliases directory as text file lists.
+    Alias data is fetched from GeneCards (or imported from HGNC) into the alias store (see SSutility.SSaliases).
     :param symbol: Gene symbol from IDFilePath in config
     :param tsv_df: Unfiltered DataFrame of records from OrthoDB Query tsv for symbol (because function will only be
     called with a valid tsv_df, this function does not do error handling for failed OrthoDB queries)
     :param errors_fpath: File path for error log for run (used to check for failed alias downloads)
+    :param aliases: Alias list for symbol (primary alias first) as returned by load_alias_dict; empty if there is no
+    alias data for symbol. If None, aliases are read from the legacy alias_data text file for symbol.
     :return am_ids: list of index values from tsv_df for which one of the GeneCards aliases matched the field value
     in tsv_df for pub_gene_id, og_, or description.
     :return exact_matches: list containing accepted gene symbol exact matches for symbol. Contains symbol and optionally
     GeneCards primary alias if different from symbol
     """
-    aliases_dir = "alias_data"
     am_ids = []
-    aliases_fpath = "{0}/{1}_aliases.txt".format(aliases_dir,symbol)
-    check_errors_file, gc_errors_df = load_errors(errors_fpath,"GeneCardsError")
-    if (check_errors_file and symbol in gc_errors_df["gene_symbol"].unique()) or not os.path.exists(aliases_fpath):
+    if aliases is None:
+        aliases = load_alias_file(symbol, errors_fpath)
+    if len(aliases) == 0:
         #No supplementary GeneCards alias informationl; matches only against symbol
         aliases = [symbol]
         exact_matches = [symbol]
     else:
-        # Read previously downloaded alias data from specified dir
-        aliases_f = open(aliases_fpath, 'r')
-        aliases = [alias.strip() for alias in aliases_f.readlines()]
         gc_name = aliases[0]
-        aliases_f.close()
         if gc_name != symbol:
             exact_matches = [symbol,gc_name.upper()]
         else:
@@ -129,6 +152,7 @@ def exact_match_df(unfiltered_df,exact_matches):
     return final_df
 
 def __parse_manual_selection_input(gene_symbol,selection_df,display_df,manual_selections_fpath):
+    from IPython.display import display
     print("Matched records, choose representative input sequence from below.")
     display(display_df)
 
@@ -258,10 +282,8 @@ def select_known_species_records(gene_symbol,em_df, am_df, ks_taxids, ks_refseqs
     if single_avail_ksr.empty:
         #If no species have single record, take manual input (or read from cached selections if previously entered),
         #use selected record as seed input for determining best records from other species.
-        selection_fapath = 'tmp/filtered_selection_intput.fasta'
-        SSfasta.filter_fasta_infile(selection_df.index,ks_refseqs_fpath,selection_fapath)
         display_df = selection_df.copy().drop(columns=['pub_og_id','og_name','level_taxid'])
-        display_df.loc[:,'seq'] = SSfasta.fasta_to_srs(selection_fapath)
+        display_df.loc[:,'seq'] = SSfasta.filter_fasta_infile(selection_df.index,ks_refseqs_fpath)
         selection_row = __parse_manual_selection_input(gene_symbol,selection_df,display_df,manual_selections_fpath)
         single_avail_ksr = single_avail_ksr.append(selection_row)
     sa_record_ids = single_avail_ksr.index
@@ -313,8 +335,7 @@ def select_outgrup_records(em_df, am_df, ks_taxids,final_ksr_df, seqs_fpath,prov
 
     # Distance calculations for final set of known species records - check internal identity values
     # Set identity threshold - other species sequences above this value will not be included
-    am_dm_fpath = "tmp/am_dm_ka.fasta"
-    am_id_dm,am_align_srs = SSfasta.construct_id_dm(am_df,seqs_fpath,am_dm_fpath)
+    am_id_dm,am_align_srs = SSfasta.construct_id_dm(am_df,seqs_fpath)
     am_record_idx = am_align_srs.index
     ksr_record_idx = final_ksr_df.index
     ksr_pos = [am_record_idx.get_loc(record_id) for record_id in ksr_record_idx]
@@ -400,29 +421,18 @@ def write_ref_seq_QC(seq_qc_fpath,gene_symbol,message):
     :param message:
     :return:
     """
-    if not os.path.exists(seq_qc_fpath):
-        seq_qc_df = pd.DataFrame(columns=['gene_symbol','message'])
-    else:
-        seq_qc_df = pd.read_csv(seq_qc_fpath,sep='\t',index_col=0)
-        if gene_symbol in seq_qc_df['gene_symbol'].unique():
-            symbol_df = seq_qc_df[seq_qc_df['gene_symbol']==gene_symbol]
-            for idx,row in symbol_df.iterrows():
-                row_symb, row_msg = row.values
-                if row_msg == message:
-                    print("{0}\t{1}".format(row_symb,row_msg))
-                    return
-    seq_qc_df = seq_qc_df.append(pd.Series({'gene_symbol':gene_symbol,'message':message}),ignore_index=True)
-    seq_qc_df.to_csv(seq_qc_fpath,sep='\t')
+    error_registry(seq_qc_fpath,QC_COLUMNS).add([gene_symbol,message])
     print("{0}\t{1}".format(gene_symbol, message))
 
 
-def process_ODB_input(symbol,config,tax_subset):
+def process_ODB_input(symbol,config,tax_subset,aliases=None):
     """Return final ODB input record dataframe.
 
     :param symbol: Gene symbol. Used to find appropriate ODB input files (fasta/ tsv)
     :param config: Contains run info (specifically run_name and ODB test species tax id)
     :param tax_subset: Subset of IDs from species list file, used to limit analyzed sequences to only taxids present in
     tax_subset
+    :param aliases: Alias list for symbol from load_alias_dict (see find_alias_matches)
     :return (dictionary) results: Contains final_df, em_df, am_df. final_df: Final ODB input record dataframe.
     Contains columns from tsv_files (indexed on int_prot_id OrthoDB internal record IDs), as well as record length
     and sequence information. em_df, am_df as returned by find_alias_matches and exact_match_df
@@ -441,7 +451,7 @@ def process_ODB_input(symbol,config,tax_subset):
     #Filter by alias matches, exact pub_gene_id matches
     try:
         results = {}
-        am_ids, exact_matches = find_alias_matches(symbol, unfiltered_tsv, errors_fpath)
+        am_ids, exact_matches = find_alias_matches(symbol, unfiltered_tsv, errors_fpath, aliases=aliases)
         am_df = unfiltered_tsv.loc[am_ids]
         em_df = exact_match_df(unfiltered_tsv, exact_matches)
         final_ksr_df = select_known_species_records(symbol, em_df, am_df, ks_taxids, raw_fa_fpath,
@@ -458,6 +468,7 @@ def process_ODB_input(symbol,config,tax_subset):
         write_errors(errors_fpath,symbol,sde)
         raise sde
     except ValueError as e:
+        from IPython.display import display
         print("=====")
         print(symbol)
         display(unfiltered_tsv)
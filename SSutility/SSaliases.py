@@ -0,0 +1,194 @@
+#SSaliases.py - Indexed SQLite store of gene symbol aliases (GeneCards queries and bulk HGNC imports)
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import csv
+import time
+import sqlite3
+from SSutility.SScompress import open_text
+
+#Alias lists keep the alias_data/<symbol>_aliases.txt convention: the primary symbol (GeneCards/ HGNC approved
+#symbol) is the first alias, followed by the remaining aliases in source order.
+
+ALIAS_SCHEMA = ["CREATE TABLE IF NOT EXISTS symbols (symbol TEXT PRIMARY KEY, primary_symbol TEXT, source TEXT, "
+                "updated REAL)",
+                "CREATE TABLE IF NOT EXISTS aliases (symbol TEXT, rank INTEGER, alias TEXT, alias_key TEXT, "
+                "PRIMARY KEY (symbol, rank))",
+                "CREATE INDEX IF NOT EXISTS aliases_alias_key ON aliases (alias_key)",
+                "CREATE TABLE IF NOT EXISTS imports (fpath TEXT PRIMARY KEY, size INTEGER, mtime REAL)"]
+#HGNC complete set columns used as aliases, in the order they are stored after the approved symbol
+HGNC_ALIAS_COLUMNS = ['name', 'alias_symbol', 'alias_name', 'prev_symbol', 'prev_name']
+#SQLite default limit on bound parameters per statement is 999
+QUERY_CHUNK_SIZE = 900
+
+
+def alias_key(alias):
+    #Case-insensitive lookup key for an alias
+    return alias.strip().upper()
+
+
+class AliasStore:
+    """SQLite alias database replacing per gene alias_data/<symbol>_aliases.txt files. Stores one ranked alias list
+    per query symbol with symbol -> aliases and (indexed) alias -> symbols lookups, filled per gene from GeneCards
+    queries or in bulk from a local HGNC complete set download (import_HGNC). Not safe for concurrent writes from
+    multiple threads; callers collect results and write from one thread.
+
+    :param db_fpath: Alias database path (ie alias_data/aliases.sqlite), created if it does not exist
+    """
+
+    def __init__(self, db_fpath):
+        db_dir = os.path.dirname(db_fpath)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.db_fpath = db_fpath
+        self.conn = sqlite3.connect(db_fpath)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        for statement in ALIAS_SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def _put(self, symbol, aliases, source, updated):
+        self.conn.execute("DELETE FROM aliases WHERE symbol = ?", (symbol,))
+        self.conn.execute("INSERT OR REPLACE INTO symbols VALUES (?,?,?,?)", (symbol, aliases[0], source, updated))
+        self.conn.executemany("INSERT INTO aliases VALUES (?,?,?,?)",
+                              [(symbol, rank, alias, alias_key(alias)) for rank, alias in enumerate(aliases)])
+
+    def put_aliases(self, symbol, aliases, source="GeneCards"):
+        """Replaces the alias list for symbol. aliases[0] is the primary symbol for symbol."""
+        self.put_many([(symbol, aliases)], source=source)
+
+    def put_many(self, symbol_aliases, source):
+        """Replaces alias lists for every (symbol, aliases) pair in iterable symbol_aliases in a single transaction."""
+        updated = time.time()
+        with self.conn:
+            for symbol, aliases in symbol_aliases:
+                aliases = [alias.strip() for alias in aliases if alias.strip()]
+                if aliases:
+                    self._put(symbol, aliases, source, updated)
+
+    def _chunks(self, symbols):
+        symbols = list(dict.fromkeys(symbols))
+        for start in range(0, len(symbols), QUERY_CHUNK_SIZE):
+            yield symbols[start:start+QUERY_CHUNK_SIZE]
+
+    def stored_symbols(self, symbols):
+        """Set of symbols which have a stored alias list."""
+        stored = set()
+        for chunk in self._chunks(symbols):
+            sql = "SELECT symbol FROM symbols WHERE symbol IN ({0})".format(",".join("?" * len(chunk)))
+            stored.update(row[0] for row in self.conn.execute(sql, chunk))
+        return stored
+
+    def batch_aliases(self, symbols, resolve=True):
+        """Returns dict of symbol to alias list (primary symbol first) for all symbols in one query per
+        QUERY_CHUNK_SIZE symbols. If resolve, symbols without their own alias list which are an alias of exactly one
+        stored symbol (ie previous HGNC symbols such as ISPD for CRPPA) get that symbol's alias list. Symbols without
+        alias data are not included.
+
+        :param symbols: iterable of gene symbols
+        :param (bool) resolve: Resolve unstored symbols through the alias index
+        """
+        symbols = list(symbols)
+        alias_dict = {}
+        for chunk in self._chunks(symbols):
+            sql = "SELECT symbol, alias FROM aliases WHERE symbol IN ({0}) ORDER BY symbol, rank".format(
+                ",".join("?" * len(chunk)))
+            for symbol, alias in self.conn.execute(sql, chunk):
+                alias_dict.setdefault(symbol, []).append(alias)
+        if resolve:
+            unresolved = [symbol for symbol in dict.fromkeys(symbols) if symbol not in alias_dict]
+            resolved = {}
+            for chunk in self._chunks(unresolved):
+                keys = dict((alias_key(symbol), symbol) for symbol in chunk)
+                sql = "SELECT DISTINCT alias_key, symbol FROM aliases WHERE alias_key IN ({0})".format(
+                    ",".join("?" * len(keys)))
+                for key, stored_symbol in self.conn.execute(sql, list(keys)):
+                    resolved.setdefault(keys[key], set()).add(stored_symbol)
+            matches = dict((symbol, stored.pop()) for symbol, stored in resolved.items() if len(stored) == 1)
+            stored_aliases = self.batch_aliases(set(matches.values()), resolve=False)
+            for symbol, stored_symbol in matches.items():
+                alias_dict[symbol] = stored_aliases[stored_symbol]
+        return alias_dict
+
+    def aliases(self, symbol):
+        """Alias list for symbol (primary symbol first) or None if there is no alias data for symbol."""
+        return self.batch_aliases([symbol]).get(symbol)
+
+    def symbols_for_alias(self, alias):
+        """Sorted list of stored symbols listing alias (case-insensitive) as one of their aliases."""
+        sql = "SELECT DISTINCT symbol FROM aliases WHERE alias_key = ? ORDER BY symbol"
+        return [row[0] for row in self.conn.execute(sql, (alias_key(alias),))]
+
+    def import_alias_files(self, aliases_dir, symbols=None):
+        """Imports legacy <symbol>_aliases.txt files from aliases_dir (limited to symbols if provided) not already in
+        the store. Returns the number of imported symbols."""
+        if not os.path.exists(aliases_dir):
+            return 0
+        symbols = set(symbols) if symbols is not None else None
+        file_aliases = []
+        for f_name in os.listdir(aliases_dir):
+            f_symbol_match = re.match(r"(.+)_aliases\.txt$", f_name)
+            if not f_symbol_match or (symbols is not None and f_symbol_match.groups()[0] not in symbols):
+                continue
+            with open(os.path.join(aliases_dir, f_name), 'rt') as aliases_f:
+                file_aliases.append((f_symbol_match.groups()[0], aliases_f.read().splitlines()))
+        stored = self.stored_symbols([symbol for symbol, aliases in file_aliases])
+        new_aliases = [(symbol, aliases) for symbol, aliases in file_aliases if symbol not in stored]
+        self.put_many(new_aliases, source="GeneCards")
+        return len(new_aliases)
+
+    def import_HGNC(self, hgnc_fpath, force=False):
+        """Bulk imports approved symbols from a local HGNC complete set download (hgnc_complete_set.txt, tab separated,
+        multiple values separated by '|'; optionally gzip compressed). Each approved symbol is stored with aliases
+        [symbol, name, alias_symbol(s), alias_name(s), prev_symbol(s), prev_name(s)]. Imports are skipped if the same
+        file (size and modification time) was already imported unless force. Returns the number of imported symbols.
+        """
+        stat = os.stat(hgnc_fpath)
+        fpath = os.path.abspath(hgnc_fpath)
+        imported = self.conn.execute("SELECT size, mtime FROM imports WHERE fpath = ?", (fpath,)).fetchone()
+        if not force and imported == (stat.st_size, stat.st_mtime):
+            return 0
+
+        def hgnc_rows():
+            with open_text(hgnc_fpath) as hgnc_f:
+                for row in csv.DictReader(hgnc_f, delimiter='\t'):
+                    if row.get('status', 'Approved') != 'Approved' or not row.get('symbol'):
+                        continue
+                    aliases = [row['symbol']]
+                    for column in HGNC_ALIAS_COLUMNS:
+                        aliases.extend(value for value in (row.get(column) or "").strip('"').split('|')
+                                       if value and value not in aliases)
+                    yield row['symbol'], aliases
+        symbol_aliases = list(hgnc_rows())
+        self.put_many(symbol_aliases, source="HGNC")
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO imports VALUES (?,?,?)", (fpath, stat.st_size, stat.st_mtime))
+        return len(symbol_aliases)
+
+    def close(self):
+        self.conn.close()
+
+
+def alias_store(config):
+    """Returns the AliasStore for the [ALIASES] AliasDBPath config setting (default alias_data/aliases.sqlite), after
+    importing HGNCFilePath if set and not yet imported."""
+    alias_config = config['ALIASES'] if config.has_section('ALIASES') else {}
+    store = AliasStore(alias_config.get('AliasDBPath', "alias_data/aliases.sqlite"))
+    hgnc_fpath = alias_config.get('HGNCFilePath', "").strip()
+    if hgnc_fpath:
+        store.import_HGNC(hgnc_fpath)
+    return store
@@ -0,0 +1,112 @@
+#SSaligner.py - Multiple sequence aligner backends (kalign by default) with an on-disk alignment cache
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import threading
+import subprocess
+from Bio import SeqIO
+from SSutility.SScache import ContentCache, content_key
+from SSutility.SSalignment import Alignment
+
+#Aligners read the unaligned fasta from stdin and write the aligned fasta to stdout (no temporary files). MSAs are
+#cached by aligner command line and exact input fasta, so realigning an identical record set reads the cached MSA.
+
+#Command lines reading fasta from stdin and writing an aligned fasta to stdout. [ALIGNMENT] AlignerArgs are appended.
+ALIGNER_COMMANDS = {'kalign': ['kalign'],
+                    'mafft': ['mafft', '--quiet', '-'],
+                    'clustalo': ['clustalo', '-i', '-'],
+                    'muscle': ['muscle', '-quiet']}
+#Increment when the cached entry format changes
+CACHE_VERSION = 1
+_default_aligner = None
+_default_lock = threading.Lock()
+
+
+class Aligner:
+    """Runs one of ALIGNER_COMMANDS over pipes, storing/ reading aligned fasta bytes in cache if provided.
+
+    :param name: ALIGNER_COMMANDS key
+    :param args: additional command line arguments
+    :param cache: Optional SSutility.SScache.ContentCache for aligned fasta content
+    """
+
+    def __init__(self, name='kalign', args=(), cache=None):
+        if name not in ALIGNER_COMMANDS:
+            raise ValueError("Unknown aligner {0}; available aligners: {1}".format(name, ", ".join(ALIGNER_COMMANDS)))
+        self.name = name
+        self.command = ALIGNER_COMMANDS[name] + list(args)
+        self.cache = cache
+
+    def cache_key(self, fasta_bytes):
+        return content_key("msa", str(CACHE_VERSION), *self.command, fasta_bytes)
+
+    def run(self, fasta_bytes, silent=True):
+        """Aligned fasta bytes output by the aligner for unaligned fasta_bytes."""
+        stderr = subprocess.DEVNULL if silent else None
+        aligner_proc = subprocess.run(self.command, input=fasta_bytes, stdout=subprocess.PIPE, stderr=stderr)
+        if aligner_proc.returncode != 0:
+            raise subprocess.CalledProcessError(aligner_proc.returncode, self.command)
+        return aligner_proc.stdout
+
+    def align_bytes(self, fasta_bytes, silent=True):
+        """Aligned fasta bytes for fasta_bytes, from the cache if an identical alignment was stored before."""
+        if self.cache is None:
+            return self.run(fasta_bytes, silent=silent)
+        key = self.cache_key(fasta_bytes)
+        aligned = self.cache.get(key)
+        if aligned is None:
+            aligned = self.run(fasta_bytes, silent=silent)
+            self.cache.put(key, aligned)
+        return aligned
+
+    def align(self, records, align_outpath=None, silent=True):
+        """Aligns records (iterable of Bio.SeqRecord objects).
+
+        :param align_outpath: Optional filepath. If provided, the aligned fasta will also be stored there.
+        :param silent: If False, the aligner's stderr output is shown
+        :return: SSutility.SSalignment.Alignment of aligned records in aligner output order
+        """
+        #Input is formatted up front since the cache key covers the complete input
+        fasta_text = io.StringIO()
+        SeqIO.write(records, fasta_text, 'fasta')
+        aligned = self.align_bytes(fasta_text.getvalue().encode('utf-8'), silent=silent)
+        if align_outpath:
+            with open(align_outpath, 'wb') as align_f:
+                align_f.write(aligned)
+        return Alignment.from_buffer(aligned, source="{0} output".format(self.name))
+
+
+def configured_aligner(config):
+    """Aligner from the [ALIGNMENT] config section (kalign without a cache if the section is missing)."""
+    align_config = config['ALIGNMENT'] if config.has_section('ALIGNMENT') else {}
+    name = align_config.get('Aligner', "") or 'kalign'
+    args = (align_config.get('AlignerArgs', "") or "").split()
+    cache = None
+    if config.getboolean('ALIGNMENT', 'UseAlignmentCache', fallback=False):
+        cache_dir = align_config.get('AlignmentCacheDir', "") or 'msa_cache'
+        max_mb = float(align_config.get('AlignmentCacheMaxMB', "") or 0)
+        cache = ContentCache(cache_dir, max_bytes=int(max_mb * 2**20) if max_mb > 0 else None)
+    return Aligner(name, args, cache=cache)
+
+
+def default_aligner():
+    """Aligner configured by the run config (SSutility.config), built once per process."""
+    global _default_aligner
+    with _default_lock:
+        if _default_aligner is None:
+            from SSutility import config
+            _default_aligner = configured_aligner(config)
+        return _default_aligner
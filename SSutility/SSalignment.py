@@ -0,0 +1,152 @@
+#SSalignment.py - Compact multiple sequence alignment matrix (uint8 residue codes)
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pandas as pd
+from SSutility.SSfastareader import fasta_records, read_fasta
+
+#Residue codes are the ASCII values of alignment characters (ie ord('A') == 65, GAP == ord('-')), so a row is the
+#aligned sequence's bytes and conversion to and from characters needs no lookup table.
+
+GAP = ord('-')
+
+
+def codes(chars):
+    """uint8 residue codes for a str/ iterable of single characters (ie codes('-X') for skip characters)."""
+    return np.frombuffer("".join(chars).encode('ascii'), dtype=np.uint8)
+
+
+class Alignment:
+    """Multiple sequence alignment as a contiguous (records x positions) uint8 array of residue codes, with record ids
+    as index and 1-indexed alignment positions as columns (the same labels as SSfasta.align_srs_to_df DataFrames).
+    Row/ position selections return new Alignment objects; to_df converts to the object DataFrame format.
+
+    :param data: 2D uint8 np.ndarray of residue codes
+    :param index: record ids (pd.Index or array-like), one per row of data
+    :param columns: alignment positions, default 1 to data.shape[1]
+    """
+
+    def __init__(self, data, index, columns=None):
+        self.data = data
+        self.index = pd.Index(index)
+        self.columns = pd.RangeIndex(1, data.shape[1] + 1) if columns is None else pd.Index(columns)
+
+    @classmethod
+    def from_srs(cls, align_srs):
+        """Alignment from Series of aligned sequence strings indexed on record ids."""
+        seqs = [seq.encode('ascii') for seq in align_srs.values]
+        if len(set(len(seq) for seq in seqs)) > 1:
+            raise ValueError("Aligned sequences have unequal lengths")
+        data = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), -1 if seqs else 0)
+        return cls(data.copy(), align_srs.index)
+
+    @classmethod
+    def from_fasta(cls, fasta_fpath):
+        """Alignment from an aligned fasta (ie [run]/output/<symbol>/<symbol>_msa.fasta). Sequences are copied from
+        the mapped (or streamed, if compressed) file straight into the alignment array."""
+        return cls.from_records(fasta_records(fasta_fpath), source=fasta_fpath)
+
+    @classmethod
+    def from_buffer(cls, fasta_buffer, source="buffer"):
+        """Alignment from aligned fasta content (bytes or a mapped file, see SSfastareader), ie kalign output read
+        from a pipe."""
+        return cls.from_records(read_fasta(fasta_buffer), source=source)
+
+    @classmethod
+    def from_records(cls, records, source="records"):
+        """Alignment from (record id, description, sequence bytes) tuples, see SSfastareader.read_fasta."""
+        record_ids, rows = [], []
+        for record_id, description, seq in records:
+            record_ids.append(record_id)
+            rows.append(np.frombuffer(seq, dtype=np.uint8))
+        if len(set(len(row) for row in rows)) > 1:
+            raise ValueError("Aligned sequences in {0} have unequal lengths".format(source))
+        data = np.stack(rows) if rows else np.zeros((0, 0), dtype=np.uint8)
+        del rows
+        return cls(data, record_ids)
+
+    @classmethod
+    def from_df(cls, align_df):
+        """Alignment from an object DataFrame of single characters (see SSfasta.align_srs_to_df)."""
+        data = align_df.values.astype('S1').view(np.uint8).reshape(align_df.shape)
+        return cls(data, align_df.index, align_df.columns)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return len(self.index)
+
+    def row_positions(self, record_ids):
+        """Row numbers of record_ids (raises KeyError for ids not in the alignment)."""
+        row_positions = self.index.get_indexer(pd.Index(record_ids))
+        if (row_positions == -1).any():
+            raise KeyError("Record ids not in alignment: {0}".format(
+                list(pd.Index(record_ids)[row_positions == -1])))
+        return row_positions
+
+    def column_positions(self, positions):
+        column_positions = self.columns.get_indexer(pd.Index(positions))
+        if (column_positions == -1).any():
+            raise KeyError("Positions not in alignment: {0}".format(
+                list(pd.Index(positions)[column_positions == -1])))
+        return column_positions
+
+    def rows(self, record_ids):
+        """Alignment of record_ids (in the given order)."""
+        row_positions = self.row_positions(record_ids)
+        return Alignment(self.data[row_positions], self.index[row_positions], self.columns)
+
+    def drop(self, record_ids):
+        """Alignment without record_ids."""
+        keep = np.ones(len(self.index), dtype=bool)
+        keep[self.row_positions(record_ids)] = False
+        return Alignment(self.data[keep], self.index[keep], self.columns)
+
+    def positions(self, positions):
+        """Alignment limited to alignment positions (column labels) in positions."""
+        column_positions = self.column_positions(positions)
+        return Alignment(self.data[:, column_positions], self.index, self.columns[column_positions])
+
+    def window(self, start, stop):
+        """Alignment of positions start to stop (inclusive), as a view of this alignment's data."""
+        start_i, stop_i = self.columns.get_loc(start), self.columns.get_loc(stop)
+        return Alignment(self.data[:, start_i:stop_i+1], self.index, self.columns[start_i:stop_i+1])
+
+    def row(self, record_id):
+        """uint8 residue codes of record_id (view)."""
+        return self.data[self.index.get_loc(record_id)]
+
+    def column(self, position):
+        """uint8 residue codes at alignment position (view)."""
+        return self.data[:, self.columns.get_loc(position)]
+
+    def gap_mask(self):
+        """Boolean array (same shape as data), True at gap characters."""
+        return self.data == GAP
+
+    def chars(self):
+        """Alignment characters as a '<U1' np.ndarray (same shape as data)."""
+        return self.data.view('S1').astype('U1')
+
+    def to_df(self):
+        """Object DataFrame of alignment characters, matching SSfasta.align_srs_to_df."""
+        return pd.DataFrame(self.chars().astype(object), index=self.index, columns=self.columns)
+
+    def to_srs(self):
+        """Series of aligned sequence strings indexed on record ids."""
+        return pd.Series(data=[row.tobytes().decode('ascii') for row in self.data], index=self.index)
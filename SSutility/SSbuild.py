@@ -0,0 +1,181 @@
+#SSbuild.py - Incremental rebuilds: per gene/ stage stamps of stable input digests, stored in an append-only ledger
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import csv
+import json
+import time
+import hashlib
+import threading
+from SSutility.SScache import content_key
+from SSutility.SScompress import open_text, open_binary
+from SSutility.SSjournal import AppendOnlyLog, file_sha256
+
+#A stage output is stamped with a digest of everything the stage reads (decompressed input contents, STAGE_CONFIG_KEYS
+#values, STAGE_VERSIONS entry) and rebuilt only if that stamp or its ledgered outputs changed.
+
+LEDGER_COLUMNS = ['time', 'stage', 'gene_symbol', 'stamp', 'outputs', 'inputs']
+#Increment a stage's version when its code changes in a way that changes its outputs
+STAGE_VERSIONS = {'filter': 1, 'analysis': 1, 'plot': 1}
+#(section, key) config values read by each stage; key None covers the whole section. Run bookkeeping keys (RunName,
+#file names, Overwrite flags) are not included since they don't change stage outputs.
+STAGE_CONFIG_KEYS = {'filter': [('ODB', 'ODBTestTaxID'), ('NCBI', 'NCBITaxID'), ('NCBI', 'NCBITaxName'),
+                                ('NCBI', 'NCBIGeneIDField'), ('NCBI', 'NCBIProteinIDField'), ('NCBISpecies', None),
+                                ('ALIGNMENT', 'Aligner'), ('ALIGNMENT', 'AlignerArgs')],
+                     'analysis': [('ODB', 'ODBTestTaxID'), ('NCBI', 'NCBITaxID')],
+                     'plot': [('ODB', 'ODBTestTaxID'), ('NCBI', 'NCBITaxID')]}
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def content_digest(fpath, chunk_size=2**20):
+    """sha256 hex digest of the decompressed content of fpath (see SScompress.open_binary), or "" if fpath is
+    missing."""
+    if not os.path.exists(fpath):
+        return ""
+    digest = hashlib.sha256()
+    with open_binary(fpath) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def config_digest(config, stage):
+    """Stable digest of the STAGE_CONFIG_KEYS values for stage in config (missing sections/ keys digest as empty)."""
+    parts = []
+    for section, key in STAGE_CONFIG_KEYS[stage]:
+        if not config.has_section(section):
+            parts.append("{0}/{1}=".format(section, key or ""))
+        elif key is None:
+            parts.extend("{0}/{1}={2}".format(section, k, v.strip()) for k, v in sorted(config[section].items()))
+        else:
+            parts.append("{0}/{1}={2}".format(section, key, config[section].get(key, "").strip()))
+    return content_key(*parts)
+
+
+def organism_taxids(tsv_fpath):
+    """Set of organism_taxid values in OrthoDB tsv file tsv_fpath (empty if missing)."""
+    if not os.path.exists(tsv_fpath):
+        return set()
+    with open_text(tsv_fpath) as tsv_f:
+        return set(row['organism_taxid'] for row in csv.DictReader(tsv_f, delimiter='\t'))
+
+
+def manual_selection_lines(manual_selections_fpath, symbol):
+    """Lines of the manual record selections table (see ODBfilter) for symbol."""
+    if not os.path.exists(manual_selections_fpath):
+        return []
+    with open(manual_selections_fpath, 'rt') as ms_f:
+        return [line.rstrip('\n') for line in ms_f if line.split('\t', 1)[0] == symbol]
+
+
+def filter_inputs(config, symbol, tax_subset, aliases=None):
+    """dict of input name to digest for the filter (and final alignment) stage of symbol, see
+    NCBIfilter.final_combined_input."""
+    from SSfilter.NCBIfilter import NCBI_fasta_paths
+    run_name = config['RUN']['RunName']
+    odb_tsv_fpath = "{0}/input/ODB/{1}.tsv".format(run_name, symbol)
+    inputs = {'config': config_digest(config, 'filter'),
+              'odb_fasta': content_digest("{0}/input/ODB/{1}.fasta".format(run_name, symbol)),
+              'odb_tsv': content_digest(odb_tsv_fpath),
+              'tax_subset': content_key(*sorted(organism_taxids(odb_tsv_fpath).intersection(tax_subset))),
+              'aliases': content_key(*(aliases or [])),
+              'manual_selections': content_key(*manual_selection_lines(
+                  "{0}/manual_record_selections.tsv".format(run_name), symbol))}
+    for tax_dict, ncbi_fpath in NCBI_fasta_paths(config, symbol):
+        inputs["ncbi_fasta_{0}".format(tax_dict['taxid'])] = content_digest(ncbi_fpath)
+    return inputs
+
+
+def filter_outputs(config, symbol):
+    run_name = config['RUN']['RunName']
+    return ["{0}/output/{1}/{1}{2}".format(run_name, symbol, suffix)
+            for suffix in ["_records.tsv", ".fasta", "_msa.fasta"]]
+
+
+def analysis_inputs(config, symbol, use_jsd_gap_penalty=True):
+    """dict of input name to digest for the analysis stage of symbol, see SSanalysiscalc.overall_summary_table."""
+    run_name = config['RUN']['RunName']
+    return {'config': config_digest(config, 'analysis'), 'use_jsd_gap_penalty': str(bool(use_jsd_gap_penalty)),
+            'msa': content_digest("{0}/output/{1}/{1}_msa.fasta".format(run_name, symbol)),
+            'records': content_digest("{0}/output/{1}/{1}_records.tsv".format(run_name, symbol))}
+
+
+def analysis_outputs(config, symbol):
+    return ["{0}/output/{1}/{1}_summary.tsv".format(config['RUN']['RunName'], symbol)]
+
+
+class BuildLedger(AppendOnlyLog):
+    """SSjournal.AppendOnlyLog of completed stage builds, one line per (stage, gene_symbol) build with its stamp, the
+    sizes and sha256 checksums of its output files and its input digests (so staleness can be explained).
+
+    :param ledger_fpath: Ledger file path (ie [run_dir]/build_ledger.tsv)
+    """
+
+    def __init__(self, ledger_fpath):
+        super().__init__(ledger_fpath, LEDGER_COLUMNS, ['stage', 'gene_symbol'])
+
+    @staticmethod
+    def stamp(stage, inputs):
+        """Stamp for stage built from inputs (dict of input name to digest)."""
+        return content_key(stage, str(STAGE_VERSIONS[stage]),
+                           *["{0}={1}".format(name, inputs[name]) for name in sorted(inputs)])
+
+    def entry(self, stage, gene_symbol):
+        return self.entries.get((stage, gene_symbol))
+
+    def record(self, stage, gene_symbol, inputs, output_fpaths):
+        """Ledgers a completed build of stage for gene_symbol from inputs, with the current size and checksum of each
+        of output_fpaths."""
+        outputs = dict((fpath, "{0}:{1}".format(os.path.getsize(fpath), file_sha256(fpath))) for fpath in output_fpaths)
+        self.append({'time': "{0:.3f}".format(time.time()), 'stage': stage, 'gene_symbol': gene_symbol,
+                     'stamp': self.stamp(stage, inputs), 'outputs': json.dumps(outputs, sort_keys=True),
+                     'inputs': json.dumps(inputs, sort_keys=True)})
+
+    def stale_inputs(self, stage, gene_symbol, inputs):
+        """Sorted names of inputs whose digest differs from the ledgered build (all input names if there is none)."""
+        entry = self.entry(stage, gene_symbol)
+        if entry is None:
+            return sorted(inputs)
+        built_inputs = json.loads(entry['inputs'])
+        return sorted(set(name for name in set(inputs).union(built_inputs)
+                          if inputs.get(name) != built_inputs.get(name)))
+
+    def is_fresh(self, stage, gene_symbol, inputs, output_fpaths, verify_checksum=False):
+        """True if the ledgered build of stage for gene_symbol has the stamp of inputs and all of output_fpaths still
+        exist with their ledgered sizes (and checksums if verify_checksum). Outputs without a ledger entry (ie written
+        before build tracking was enabled for the run) are never trusted, since their inputs are unknown; they are
+        rebuilt once."""
+        entry = self.entry(stage, gene_symbol)
+        if entry is None or entry['stamp'] != self.stamp(stage, inputs):
+            return False
+        outputs = json.loads(entry['outputs'])
+        for fpath in output_fpaths:
+            if fpath not in outputs or not os.path.exists(fpath):
+                return False
+            size, checksum = outputs[fpath].split(':')
+            if os.path.getsize(fpath) != int(size) or (verify_checksum and file_sha256(fpath) != checksum):
+                return False
+        return True
+
+
+def run_build_ledger(run_name):
+    """BuildLedger for run directory run_name, shared by all stages of the process."""
+    ledger_fpath = os.path.abspath("{0}/build_ledger.tsv".format(run_name))
+    with _ledgers_lock:
+        if ledger_fpath not in _ledgers:
+            _ledgers[ledger_fpath] = BuildLedger(ledger_fpath)
+        return _ledgers[ledger_fpath]
@@ -0,0 +1,146 @@
+#SScache.py - Content-addressed, compressed on-disk cache with TTL and size-bounded LRU eviction
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import gzip
+import time
+import hashlib
+import threading
+import tempfile
+
+
+def content_key(*parts):
+    """Stable sha256 hex digest of parts (str or bytes), used as a cache key. Parts are length-prefixed so that
+    different splits of the same text produce different keys."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(str(len(part)).encode('ascii') + b':')
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class ContentCache:
+    """Directory of gzip compressed entries named by key (see content_key). Entries are shared by every run (and
+    process) using the same cache_dir; writes go through a temporary file and os.replace so concurrent readers never
+    see partial entries.
+
+    Entry mtime records when an entry was stored (used for ttl), atime records its last use (used for LRU eviction).
+
+    :param cache_dir: Directory for cache entries, created if missing
+    :param (float) ttl: Maximum entry age in seconds; older entries are treated as misses. None for no expiry.
+    :param (int) max_bytes: Maximum total compressed size of entries; least recently used entries are evicted after
+    puts which exceed it. None for no limit.
+    :param (int) compresslevel: gzip compression level for stored entries
+    """
+
+    def __init__(self, cache_dir, ttl=None, max_bytes=None, compresslevel=6):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], "{0}.gz".format(key))
+
+    def _entries(self):
+        for subdir in os.listdir(self.cache_dir):
+            subdir_path = os.path.join(self.cache_dir, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for fname in os.listdir(subdir_path):
+                if fname.endswith(".gz"):
+                    yield os.path.join(subdir_path, fname)
+
+    def total_bytes(self):
+        """Total compressed size of cache entries (computed once, then tracked across puts/ evictions)."""
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(os.path.getsize(fpath) for fpath in self._entries())
+            return self._total_bytes
+
+    def get(self, key):
+        """Returns the stored bytes for key, or None if missing or expired. Marks the entry as recently used."""
+        fpath = self.entry_path(key)
+        try:
+            stat = os.stat(fpath)
+            if self.ttl is not None and time.time() - stat.st_mtime > self.ttl:
+                return None
+            with gzip.open(fpath, 'rb') as entry_f:
+                data = entry_f.read()
+            os.utime(fpath, (time.time(), stat.st_mtime))
+        except (FileNotFoundError, EOFError, OSError):
+            return None
+        return data
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def put(self, key, data):
+        """Stores data (bytes) under key, then evicts least recently used entries if over max_bytes."""
+        fpath = self.entry_path(key)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        self.total_bytes()
+        fd, tmp_fpath = tempfile.mkstemp(dir=os.path.dirname(fpath), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as raw_f, gzip.GzipFile(fileobj=raw_f, mode='wb',
+                                                              compresslevel=self.compresslevel, mtime=0) as entry_f:
+                entry_f.write(data)
+            old_size = os.path.getsize(fpath) if os.path.exists(fpath) else 0
+            os.replace(tmp_fpath, fpath)
+        except BaseException:
+            if os.path.exists(tmp_fpath):
+                os.remove(tmp_fpath)
+            raise
+        new_size = os.path.getsize(fpath)
+        with self._lock:
+            self._total_bytes += new_size - old_size
+        if self.max_bytes is not None and self._total_bytes > self.max_bytes:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        """Removes least recently used (oldest atime) entries until the total size is at most max_bytes.
+
+        :return: (int) number of entries removed
+        """
+        with self._lock:
+            entries = []
+            for fpath in self._entries():
+                try:
+                    stat = os.stat(fpath)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, fpath))
+            total = sum(entry[1] for entry in entries)
+            removed = 0
+            for atime, size, fpath in sorted(entries):
+                if total <= max_bytes:
+                    break
+                try:
+                    os.remove(fpath)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            self._total_bytes = total
+            return removed
+
+    def clear(self):
+        return self.evict(0)
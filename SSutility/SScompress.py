@@ -0,0 +1,93 @@
+#SScompress.py - Transparent gzip/ zstd compression for raw input files (written by acquisition, read by SSfasta)
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import gzip
+
+#Compressed input files keep their usual names (ie [run]/input/ODB/<symbol>.fasta); compression is detected from
+#the file's magic bytes, so runs can mix compressed and uncompressed inputs and path handling is unchanged.
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSION_TYPES = ['gzip', 'zstd']
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compressed inputs require the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def detect_compression(fpath):
+    """Returns 'gzip', 'zstd' or None for fpath based on its first bytes."""
+    with open(fpath, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+def open_text(fpath):
+    """Opens fpath for streaming text reads, decompressing gzip/ zstd content transparently. Use in place of
+    open(fpath) for raw input files."""
+    compression = detect_compression(fpath)
+    if compression == 'gzip':
+        return gzip.open(fpath, 'rt')
+    if compression == 'zstd':
+        raw_f = open(fpath, 'rb')
+        reader = _zstd().ZstdDecompressor().stream_reader(raw_f, closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(fpath, 'rt')
+
+
+def open_binary(fpath):
+    """Opens fpath for streaming binary reads of its decompressed content (see open_text)."""
+    compression = detect_compression(fpath)
+    if compression == 'gzip':
+        return gzip.open(fpath, 'rb')
+    if compression == 'zstd':
+        return _zstd().ZstdDecompressor().stream_reader(open(fpath, 'rb'), closefd=True)
+    return open(fpath, 'rb')
+
+
+def compressed_writer(raw_f, compression, compresslevel=None):
+    """Wraps binary file object raw_f in a compressing writer. Closing the writer finishes the compressed stream
+    without closing raw_f. Returns raw_f itself if compression is None."""
+    if compression is None:
+        return raw_f
+    if compression == 'gzip':
+        compresslevel = compresslevel if compresslevel is not None else 6
+        return gzip.GzipFile(fileobj=raw_f, mode='wb', compresslevel=compresslevel, mtime=0)
+    if compression == 'zstd':
+        cctx = _zstd().ZstdCompressor(level=compresslevel if compresslevel is not None else 3)
+        return cctx.stream_writer(raw_f, closefd=False)
+    raise ValueError("Unsupported compression {0}; use one of {1}".format(compression, COMPRESSION_TYPES))
+
+
+def input_compression(config):
+    """Returns (compression, compresslevel) for raw input files from [RUN] InputCompression/ InputCompressionLevel.
+    compression is None if InputCompression is none or absent."""
+    compression = config['RUN'].get('InputCompression', fallback='none').strip().lower()
+    if compression in ('', 'none', 'no'):
+        return None, None
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError("InputCompression must be none, gzip or zstd, got {0}".format(compression))
+    level = config['RUN'].get('InputCompressionLevel', fallback='').strip()
+    return compression, int(level) if level else None
@@ -14,10 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import threading
 from SSutility import SSdirectory
 import numpy as np
 import pandas as pd
-from IPython.display import display
 
 def parse_config(config_file="config/config.txt"):
     """Parse config text file (INI format) to establish paramters for the run
@@ -44,15 +44,14 @@ def parse_genes(genes_path="config/genes.txt"):
 
 
 def parse_species(species_path="config/v10_0_species.txt"):
-    # Reads species list from file in config directory. Also returns a hashcode for the list of species used
+    # Reads species list from file in config directory. Also returns a hashcode for the list of species used (sha256
+    # hex digest, stable across processes unlike hash())
+    from SSutility.SScache import content_key
     with open(species_path,'r') as spec_f:
         spec_lines = spec_f.readlines()
         spec_f.close()
     species = [spec.strip() for spec in spec_lines]
-    concat = ""
-    for spec in species:
-        concat = concat + spec
-    hc = np.abs(hash(concat))
+    hc = content_key(*species)
     return species, hc
 
 def read_geneID_file(csv_fpath):
@@ -72,6 +71,36 @@ def read_geneID_file(csv_fpath):
     return gene_id_df
 
 
+def NCBI_tax_dicts(config):
+    """Returns the list of NCBI species used to supplement OrthoDB data as tax_dicts (see NCBIquery): the [NCBI]
+    NCBITaxID/ NCBITaxName species first (columns NCBIGeneIDField/ NCBIProteinIDField), followed by each
+    taxid = species name entry of the optional [NCBISpecies] section (columns ncbi_gene_id_<taxid>/
+    ncbi_protein_ids_<taxid>; names left empty are looked up in the OrthoDB taxonomy catalog). Records for each species
+    are stored in [run_dir]/input/NCBI/<taxid>.
+
+    :param config: configparser object from config/config.txt
+    :return: list of dicts with keys taxid, spec_name, gid_column, pid_column, gid_source and records_source (acquisition
+    journal sources) and primary (True only for the [NCBI] species)
+    """
+    ncbi_config = config['NCBI']
+    tax_dicts = [{'taxid':ncbi_config['NCBITaxID'], 'spec_name':ncbi_config['NCBITaxName'],
+                  'gid_column':ncbi_config['NCBIGeneIDField'], 'pid_column':ncbi_config['NCBIProteinIDField'],
+                  'gid_source':"NCBI_gid", 'records_source':"NCBI_records", 'primary':True}]
+    if config.has_section('NCBISpecies'):
+        for taxid, spec_name in config['NCBISpecies'].items():
+            if taxid == tax_dicts[0]['taxid']:
+                continue
+            spec_name = spec_name.strip()
+            if not spec_name:
+                from SSutility.SStaxonomy import taxonomy_catalog
+                spec_name = taxonomy_catalog().spec_name(taxid)
+            tax_dicts.append({'taxid':taxid, 'spec_name':spec_name,
+                              'gid_column':"ncbi_gene_id_{0}".format(taxid),
+                              'pid_column':"ncbi_protein_ids_{0}".format(taxid),
+                              'gid_source':"NCBI_gid_{0}".format(taxid),
+                              'records_source':"NCBI_records_{0}".format(taxid), 'primary':False})
+    return tax_dicts
+
 
 def odb_tablev9(species_list, table_path="odb9v1_raw/odb9v1_species.tab"):
     """Reads orthodb v9 tsv file into a DataFrame of species names/ tax_ids and other ODB information.
@@ -96,41 +125,76 @@ def odb_tablev10(species_list, table_path="config/odb10v0_species.tab"):
     5.	total count of clustered genes in this species
     6.	total count of the OGs it participates
     7.	mapping type, clustered(C) or mapped(M)
-    Reads above file into a DataFrame used for tax_id/ species name information, limited to species in species_list
+    Reads above file into a DataFrame used for tax_id/ species name information, limited to species in species_list.
+    The file is parsed once into an indexed catalog cached next to it (see SSutility.SStaxonomy).
+    """
+    from SSutility.SStaxonomy import taxonomy_catalog
+    return taxonomy_catalog(table_path).table(species_list)
+
+class RunContext:
+    """Run configuration (config/config.txt) and the input tables derived from it, each loaded on first access.
+    Loading has no file system side effects; prepare_run_directory creates the run directory tree.
+
+    :param config_fpath: path to the run config file
     """
-    odb = pd.read_csv(table_path, delimiter="\t", header=None,
-                      names=['tax_id', 'odb_id', 'spec_name', 'assembly_id', 'clustered_genes', 'ortho_groups',
-                             'mapping_type'])
-    filtered = pd.DataFrame(columns=odb.columns)
-    for spec in species_list:
-        row = odb[odb['spec_name'] == spec]
-        filtered = filtered.append(row)
-    filtered.drop(columns=['clustered_genes', 'ortho_groups', 'mapping_type'], inplace=True)
-    filtered = filtered.sort_values(by='tax_id')
-    return filtered
+
+    def __init__(self, config_fpath="config/config.txt"):
+        self.config_fpath = config_fpath
+        self._loaded = {}
+        self._lock = threading.RLock()
+
+    def _load(self, name, loader):
+        with self._lock:
+            if name not in self._loaded:
+                self._loaded[name] = loader()
+            return self._loaded[name]
+
+    @property
+    def config(self):
+        return self._load('config', lambda: parse_config(self.config_fpath))
+
+    @property
+    def run_name(self):
+        return self.config['RUN']['RunName']
+
+    @property
+    def tax_subset(self):
+        """[AnalysisODBTaxSubset] keys as OrthoDB organism ids (see SStaxonomy.TaxonomyCatalog.resolve_tax_subset)."""
+        from SSutility.SStaxonomy import taxonomy_catalog
+        return self._load('tax_subset', lambda: taxonomy_catalog().resolve_tax_subset(
+            self.config['AnalysisODBTaxSubset'].keys()))
+
+    @property
+    def gene_id_df(self):
+        return self._load('gene_id_df', lambda: read_geneID_file(self.config['RUN']['IDFilePath']))
+
+    @property
+    def tax_table(self):
+        def load_tax_table():
+            spec_list, hc = parse_species(self.config['RUN']['SpeciesFilePath'])
+            return odb_tablev10(spec_list)
+        return self._load('tax_table', load_tax_table)
+
+    def prepare_run_directory(self):
+        """Creates the run directory tree (see SSdirectory.create_run_directory) and copies the config file to
+        [run_name]/summary."""
+        import shutil
+        SSdirectory.create_run_directory(self.run_name)
+        shutil.copy(self.config_fpath, "{0}/summary/config.txt".format(self.run_name))
 
 def config_initialization():
-# Read config files
-    config = parse_config()
-    run_config = config['RUN']
-    tax_subset = list(config['AnalysisODBTaxSubset'].keys())
-    gene_id_fpath = run_config['IDFilePath']
-    species_path = run_config['SpeciesFilePath']
-    spec_list, hc = parse_species(species_path)
-    gene_id_df = read_geneID_file(gene_id_fpath)
-    tax_table = odb_tablev10(spec_list)
-    run_name = run_config['RunName']
-    SSdirectory.create_run_directory(run_name)
-    #Copy config file to summary_directory
-    src_config = "config/config.txt"
-    dest_config = "{0}/summary/config.txt".format(run_name)
-    import shutil
-    shutil.copy(src_config,dest_config)
-    return config, tax_subset, gene_id_df, tax_table
+    """Loads the run config and input tables and prepares the run directory (see RunContext).
+
+    :return: config, tax_subset, gene_id_df, tax_table
+    """
+    context = RunContext()
+    context.prepare_run_directory()
+    return context.config, context.tax_subset, context.gene_id_df, context.tax_table
 
 def main():
     DISPLAY_PARAMS = False
     if DISPLAY_PARAMS:
+        from IPython.display import display
         config, spec_list, tax_subset, gene_id_df, tax_table = config_initialization()
         run_config, odb_config = config['RUN'], config['ODB']
         run_name = run_config['RunName']
@@ -38,13 +38,14 @@ def empty_directory(path):
 
 
 def create_run_directory(run_name):
-    """Make diretory tree for a run. Also creates tmp directory for storage of temporary alignment files"""
+    """Make diretory tree for a run. Also creates tmp directory (alignments are run through aligner pipes, see
+    SSutility.SSaligner.Aligner; tmp is no longer emptied so that concurrently started processes don't remove each
+    other's files)"""
     dirpaths = ["{0}", "{0}/input", "{0}/input/ODB", "{0}/input/NCBI", "{0}/output", "{0}/summary"]
     for dirpath in dirpaths:
         formatted = dirpath.format(run_name)
         create_directory(formatted)
     create_directory("tmp")
-    empty_directory("tmp")
     create_directory("alias_data")
 
 
@@ -0,0 +1,57 @@
+#SSdistance.py - Vectorized pairwise identity distances for SSalignment.Alignment objects
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+#Distances match Bio.Phylo.TreeConstruction.DistanceCalculator('identity'): 1 - identical positions/ alignment length,
+#gaps included. Identical position counts come from one matrix product per residue code instead of a per-pair loop.
+
+
+def identity_counts(data):
+    """(n x n) int array of identical position counts between all pairs of rows of uint8 residue code array data."""
+    n = data.shape[0]
+    counts = np.zeros((n, n))
+    for code in np.unique(data):
+        one_hot = (data == code).astype(np.float64)
+        counts += one_hot @ one_hot.T
+    return np.rint(counts).astype(np.int64)
+
+
+def identity_distance_matrix(alignment):
+    """(n x n) np.ndarray of identity distances between records of alignment (SSalignment.Alignment), rows/ columns
+    in alignment.index order."""
+    n, length = alignment.shape
+    if length == 0:
+        distances = np.ones((n, n))
+    else:
+        distances = 1 - identity_counts(alignment.data) / length
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def condensed(distmat):
+    """Upper triangle (i < j, row-major order) of square distance matrix distmat as a 1D array, ie the condensed
+    form used by scipy.spatial.distance."""
+    return distmat[np.triu_indices(len(distmat), k=1)]
+
+
+def sub_distance_matrix(distmat, index, record_ids):
+    """Rows/ columns of distmat (labelled by index, ie Alignment.index) for record_ids, in record_ids order."""
+    positions = index.get_indexer(record_ids)
+    if (positions == -1).any():
+        raise KeyError("Record ids not in distance matrix: {0}".format(
+            [record_id for record_id, position in zip(record_ids, positions) if position == -1]))
+    return distmat[np.ix_(positions, positions)]
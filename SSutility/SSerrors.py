@@ -16,7 +16,16 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import io
+import csv
+import atexit
+import threading
+from contextlib import contextmanager
 import pandas as pd
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 class Error(Exception):
     #Base class
     pass
@@ -72,25 +81,222 @@ class SequenceAnalysisError(Error):
         self.message = message
 
 
+ERROR_COLUMNS = ['gene_symbol','error_type','error_code','error_message']
+QC_COLUMNS = ['gene_symbol','message']
+#ErrorRegistry objects used by this process, by absolute log path
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+class ErrorRegistry:
+    """Append-only tsv log of errors (or QC messages) for a run, with an in-memory index by gene symbol and error type.
+
+    The file layout matches the DataFrame.to_csv output written by earlier versions (index column plus columns), so
+    existing errors.tsv/ QC files are read as is and stay readable by pd.read_csv. Rows are only ever appended: new
+    rows are written under an exclusive fcntl lock on the log, and rows appended by other processes are picked up by
+    reading the file from the last read offset (refresh). Rows are deduplicated on key_columns (gene symbol and
+    message by default). Added rows are buffered and written batch_size at a time, or when a batch() block exits.
+
+    :param fpath: log file path
+    :param columns: column labels used if fpath doesn't exist yet (otherwise read from its header)
+    :param key_columns: columns identifying duplicate rows, defaults to the first and last column
+    :param batch_size: number of pending rows which triggers a write
+    """
+
+    def __init__(self, fpath, columns=ERROR_COLUMNS, key_columns=None, batch_size=1):
+        self.fpath = fpath
+        self.columns = list(columns)
+        self.key_columns = key_columns
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self._defer = 0
+        self.pending = []
+        self._reset()
+
+    def _reset(self):
+        self.rows, self._offset, self._inode = [], 0, None
+        self._disk_keys = set()
+        self._reindex()
+
+    def _key_positions(self):
+        key_columns = self.key_columns or [self.columns[0], self.columns[-1]]
+        return [self.columns.index(column) for column in key_columns]
+
+    def _key(self, row):
+        return tuple(row[i] for i in self._key_positions())
+
+    def _reindex(self):
+        self._by_gene = {}
+        self._keys = set(self._disk_keys)
+        for row in self.rows + self.pending:
+            self._index_row(row)
+
+    def _index_row(self, row):
+        self._by_gene.setdefault(row[0], []).append(row)
+        self._keys.add(self._key(row))
+
+    def _read_new(self, log_f):
+        """Reads rows appended to the open log since the last read."""
+        stat = os.fstat(log_f.fileno())
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            #Log replaced or truncated: read from the start
+            self._reset()
+            self._inode = stat.st_ino
+        log_f.seek(self._offset)
+        chunk = log_f.read()
+        complete = chunk[:chunk.rfind(b"\n") + 1]
+        if not complete:
+            return
+        lines = csv.reader(io.StringIO(complete.decode('utf-8'), newline=''), delimiter='\t')
+        if self._offset == 0:
+            header = next(lines, [])
+            if len(header) > 1:
+                self.columns = header[1:]
+                self._reindex()
+        for fields in lines:
+            row = tuple((fields[1:] + [''] * len(self.columns))[:len(self.columns)])
+            self.rows.append(row)
+            self._disk_keys.add(self._key(row))
+            self._index_row(row)
+        self._offset += len(complete)
+
+    def refresh(self):
+        """Picks up rows appended to the log (by any process) since the last refresh."""
+        with self.lock:
+            try:
+                stat = os.stat(self.fpath)
+            except FileNotFoundError:
+                if self._inode is not None:
+                    self._reset()
+                return
+            if stat.st_ino == self._inode and stat.st_size == self._offset:
+                return
+            with open(self.fpath, 'rb') as log_f:
+                _lock_file(log_f, exclusive=False)
+                self._read_new(log_f)
+
+    def add(self, values):
+        """Adds a row (sequence of values in column order). Returns False without adding if a row with the same key
+        is already logged or pending."""
+        row = tuple(str(value) for value in values)
+        with self.lock:
+            self.refresh()
+            if self._key(row) in self._keys:
+                return False
+            self.pending.append(row)
+            self._index_row(row)
+            if not self._defer and len(self.pending) >= self.batch_size:
+                self.flush()
+            return True
+
+    def flush(self):
+        """Appends pending rows to the log, dropping any that another process logged in the meantime."""
+        with self.lock:
+            if not self.pending:
+                return
+            with open(self.fpath, 'a+b') as log_f:
+                _lock_file(log_f, exclusive=True)
+                self._read_new(log_f)
+                new_rows = [row for row in self.pending if self._key(row) not in self._disk_keys]
+                buffer = io.StringIO(newline='')
+                writer = csv.writer(buffer, delimiter='\t', lineterminator='\n')
+                if self._offset == 0:
+                    writer.writerow([''] + self.columns)
+                for i, row in enumerate(new_rows):
+                    writer.writerow([len(self.rows) + i] + list(row))
+                data = buffer.getvalue().encode('utf-8')
+                log_f.write(data)
+                log_f.flush()
+                self.pending = []
+                self.rows.extend(new_rows)
+                self._disk_keys.update(self._key(row) for row in new_rows)
+                self._offset = log_f.tell()
+                self._inode = os.fstat(log_f.fileno()).st_ino
+                self._reindex()
+
+    @contextmanager
+    def batch(self):
+        """Defers writes of rows added inside the block until it exits."""
+        with self.lock:
+            self._defer += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self._defer -= 1
+                if not self._defer:
+                    self.flush()
+
+    def gene_rows(self, gene_symbol, error_type=None, message=None):
+        """Logged and pending rows for gene_symbol, optionally limited to error_type and/ or exact message."""
+        rows = self._by_gene.get(gene_symbol, [])
+        if error_type is not None:
+            type_i = self.columns.index('error_type')
+            rows = [row for row in rows if row[type_i] == error_type]
+        if message is not None:
+            rows = [row for row in rows if row[-1] == message]
+        return rows
+
+    def has(self, gene_symbol, error_type=None, message=None):
+        return len(self.gene_rows(gene_symbol, error_type, message)) > 0
+
+    def print_gene(self, gene_symbol, message=None, error_type=None):
+        """Prints rows for gene_symbol like print_errors: only rows matching message or error_type if any do."""
+        rows = self.gene_rows(gene_symbol)
+        if message and self.has(gene_symbol, message=message):
+            rows = self.gene_rows(gene_symbol, message=message)
+        elif error_type and self.has(gene_symbol, error_type=error_type):
+            rows = self.gene_rows(gene_symbol, error_type=error_type)
+        for row in rows:
+            print("\t".join(row))
+
+    def frame(self, error_type=None):
+        """DataFrame of logged and pending rows (same content as pd.read_csv of the log), optionally limited to
+        error_type."""
+        with self.lock:
+            frame = pd.DataFrame(self.rows + self.pending, columns=self.columns)
+        if 'error_code' in frame.columns:
+            frame['error_code'] = pd.to_numeric(frame['error_code'], errors='ignore')
+        if error_type:
+            frame = frame.loc[frame['error_type'] == error_type, :]
+        return frame
+
+
+def _lock_file(log_f, exclusive):
+    #Advisory lock released when log_f is closed. Without fcntl, only threads of this process are serialized.
+    if fcntl is not None:
+        fcntl.flock(log_f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def error_registry(fpath, columns=ERROR_COLUMNS):
+    """Returns this process's ErrorRegistry for fpath, refreshed with rows appended since it was last read."""
+    key = os.path.abspath(fpath)
+    with _registries_lock:
+        registry = _registries.get(key)
+        if registry is None:
+            registry = _registries[key] = ErrorRegistry(fpath, columns)
+    registry.refresh()
+    return registry
+
+
+@atexit.register
+def _flush_registries():
+    for registry in list(_registries.values()):
+        registry.flush()
+
+
 def write_errors(errors_fpath,gene_symbol,error):
-    """Maintains a tsv/ DataFrame of gene symbols and errors generated during a run.
+    """Logs error for gene_symbol to errors_fpath (see ErrorRegistry) unless the same message or, for
+    SequenceDataErrors, any SequenceDataError is already logged for gene_symbol, and prints the matching log rows.
+    Updates are serialized across threads and processes, so concurrently running acquisition stages (see
+    SSacquisition.SSorchestrator) share errors_fpath as one error sink.
     """
     etype,ecode,emsg = error.error_type,error.code,error.message
-    if os.path.exists(errors_fpath):
-        check_ef,errors_df = load_errors(errors_fpath)
-        if gene_symbol in errors_df['gene_symbol'].unique():
-            gene_error_df = errors_df.loc[errors_df['gene_symbol']==gene_symbol,:]
-            if gene_error_df['error_message'].str.contains(emsg).any() or \
-                (etype == 'SequenceDataError' and gene_error_df['error_type'].str.contains(etype).any()):
-                print_errors(errors_df,gene_symbol,message=emsg)
-                return
-    else:
-        error_columns = ['gene_symbol','error_type','error_code','error_message']
-        errors_df = pd.DataFrame(columns=error_columns)
-    error_row = pd.Series({'gene_symbol':gene_symbol,'error_type':etype,'error_code':ecode,'error_message':emsg})
-    errors_df = errors_df.append(error_row,ignore_index=True)
-    print_errors(errors_df,gene_symbol,emsg)
-    errors_df.to_csv(errors_fpath,sep='\t')
+    registry = error_registry(errors_fpath)
+    with registry.lock:
+        if not (etype == 'SequenceDataError' and registry.has(gene_symbol,error_type=etype)):
+            registry.add([gene_symbol,etype,ecode,emsg])
+        registry.print_gene(gene_symbol,message=emsg)
 
 def print_errors(errors_df,gene_symbol,message=None,error_type=None):
     """
@@ -122,12 +328,8 @@ def load_errors(errors_fpath,error_type=""):
     :return: errors_df: if check_error, returns file loaded from
     """
     if os.path.exists(errors_fpath):
-        errors_df = pd.read_csv(errors_fpath, delimiter='\t',index_col=0)
-        if error_type:
-            errors_df = errors_df.loc[errors_df['error_type'] == error_type, :]
         check_error_file = True
-        return check_error_file, errors_df
+        return check_error_file, error_registry(errors_fpath).frame(error_type)
     else:
         check_error_file = False
-        return check_error_file, pd.DataFrame(columns=['gene_symbol','error_type','error_code','error_message'])
-
+        return check_error_file, pd.DataFrame(columns=ERROR_COLUMNS)
@@ -27,25 +27,25 @@ import subprocess
 import warnings
 import os
 from SSutility import SSerrors
+from SSutility.SScompress import open_text
+from SSutility.SSfastaindex import fasta_index
+from SSutility.SSfastareader import fasta_records, seq_str
+from SSutility.SSalignment import Alignment
+from SSutility.SSdistance import identity_distance_matrix
+from SSutility.SSaligner import default_aligner
 
 ###Record filtering functions###
 
 def ordered_record_generator(fpath,ordered_ids):
     """Generates Seq records from fpath, limited to ordered_ids if provided. Generator order is order in ordered_ids.
-    Internally tracks yielded record ids to eliminate duplicates.
+    Internally tracks yielded record ids to eliminate duplicates. Records are read by byte offset from the fasta's
+    index (see SSutility.SSfastaindex), so each record is parsed once regardless of its position in ordered_ids.
     :param fpath: Fasta file path
     :param ordered_ids: array-like containing ordered record ids
     :return:
     """
-    yielded = set()
-    for id in ordered_ids:
-        with open(fpath) as fasta_f:
-            fastas = SeqIO.parse(fasta_f,'fasta')
-            for fasta in fastas:
-                if fasta.id == id and fasta.id not in yielded:
-                    yielded.add(fasta.id)
-                    yield fasta
-                    break
+    for fasta in fasta_index(fpath).records(ordered_ids):
+        yield fasta
 
 def record_generator(fpath,ids=[]):
     """Generates Seq records from fpath, limited to ids if provided. Ordered as in fpath
@@ -54,14 +54,14 @@ def record_generator(fpath,ids=[]):
     to be present in generator
     :return: generator object
     """
-    yielded = set()
-    with open(fpath) as fasta_f:
-        fastas = SeqIO.parse(fasta_f, 'fasta')
-        for fasta in fastas:
-            if ((len(ids)>0 and fasta.id in ids) or \
-                    (len(ids)==0)) and fasta.id not in yielded:
-                yielded.add(fasta.id)
-                yield fasta
+    index = fasta_index(fpath)
+    if len(ids) > 0:
+        id_set = set(ids)
+        record_ids = [record_id for record_id in index.ids if record_id in id_set]
+    else:
+        record_ids = None
+    for fasta in index.records(record_ids):
+        yield fasta
 
 def ODB_NCBI_generator(ODB_fpath,NCBI_fpath,odb_subset=[],ncbi_subset=[],ordered=False):
     """Generator object that yields all Bio.Seq objects in ODB_fpath and then NCBI_fpath, filtered down with optional
@@ -105,12 +105,11 @@ def filtered_generator_wrapper(filtered_ids, infile_path, ordered, missing_warni
     :return:
     """
     if missing_warning:
-        with open(infile_path) as infile_f:
-            infile_ids = [fasta.id for fasta in SeqIO.parse(infile_f, 'fasta')]
-            for record_id in filtered_ids:
-                if record_id not in infile_ids:
-                    msg = "Infile {0} is missing record id {1} from filtered_ids".format(infile_path, record_id)
-                    warnings.warn(msg)
+        infile_index = fasta_index(infile_path)
+        for record_id in filtered_ids:
+            if record_id not in infile_index:
+                msg = "Infile {0} is missing record id {1} from filtered_ids".format(infile_path, record_id)
+                warnings.warn(msg)
     if ordered:
         # filtered = _ordered_filtered_generator(filtered_ids, infile_path)
         filtered = ordered_record_generator(infile_path,filtered_ids)
@@ -132,11 +131,9 @@ def filter_fasta_infile(filtered_ids, infile_path, outfile_path=None, ordered=Fa
     if outfile_path:
         filtered = filtered_generator_wrapper(filtered_ids,infile_path,ordered)
         SeqIO.write(filtered, outfile_path, "fasta")
-    with warnings.catch_warnings(record=True) as w:
-        filtered = filtered_generator_wrapper(filtered_ids, infile_path, ordered, True)
     filtered_srs = pd.Series(index=filtered_ids)
-    for fasta in filtered:
-        filtered_srs[fasta.id] = str(fasta.seq)
+    for record_id, seq in fasta_index(infile_path).sequences(filtered_ids):
+        filtered_srs[record_id] = seq
     return filtered_srs
 
 ###Series, fasta, align_df functions###
@@ -154,36 +151,26 @@ def srs_to_fasta(seq_srs, outfile_path):
 
 def fasta_to_srs(fasta_path):
     #Creates series mapping record id to sequence from fasta_path
-    with open(fasta_path) as fasta_f:
-        fasta_seqs = SeqIO.parse(fasta_f, 'fasta')
-        id_seq_map = OrderedDict()
-        for fasta in fasta_seqs:
-            record_id = fasta.id
-            seq = str(fasta.seq)
-            id_seq_map[record_id] = seq
-        return pd.Series(name="seq", data=id_seq_map)
+    id_seq_map = OrderedDict()
+    for record_id, description, seq in fasta_records(fasta_path):
+        id_seq_map[record_id] = seq_str(seq)
+    return pd.Series(name="seq", data=id_seq_map)
 
 def align_srs_to_df(align_srs):
     """Returns DataFrame object from series of aligned sequences; columns are 1-indexed positions
-    Values are characters in alignment, indexed on record_ids"""
-    seq_len = len(align_srs.iloc[0])
-    align_df = pd.DataFrame(index=align_srs.index, columns=range(seq_len))
-    for idx, seq in align_srs.iteritems():
-        align_df.loc[idx, :] = list(seq)
-    align_df.columns += 1
-    return align_df
+    Values are characters in alignment, indexed on record_ids. See SSutility.SSalignment for the compact
+    (uint8) alignment type used by analysis functions."""
+    return Alignment.from_srs(align_srs).to_df()
 
 def align_fasta_to_df(fasta_path):
-    align_srs = fasta_to_srs(fasta_path)
-    align_df = align_srs_to_df(align_srs)
-    return align_df
+    return Alignment.from_fasta(fasta_path).to_df()
 
 def seq_srs_to_align_df(seq_srs, align_in_fpath, align_out_fpath):
     """Transform seq_srs (pandas Series containing sequence texts) to a DataFrame for which each column
     is an alignment position and column. Writes input fasta and output fastas for alignment to align_in_fpath
     and align_out_fpath respectively. Also returns average (non-diagonal) identity distances"""
     srs_to_fasta(seq_srs, align_in_fpath)
-    n, ordered_ids, id_dm, align_srs = construct_id_dm(seq_srs, align_in_fpath, align_out_fpath)
+    id_dm, align_srs = construct_id_dm(seq_srs, align_in_fpath, align_out_fpath)
     align_df = align_srs_to_df(align_srs)
     return align_df
 
@@ -220,7 +207,8 @@ def load_tsv_table(input_tsv_fpath,tax_subset=[],ODB_ID_index=True):
     """
     if not os.path.exists(input_tsv_fpath):
         raise SSerrors.RecordDataError(0,"Missing File at path: {0}".format(input_tsv_fpath))
-    tsv_df = pd.read_csv(input_tsv_fpath, delimiter='\t')
+    with open_text(input_tsv_fpath) as tsv_f:
+        tsv_df = pd.read_csv(tsv_f, delimiter='\t')
     if ODB_ID_index:
         tsv_df = tsv_df.set_index(keys="int_prot_id", drop=True)  # drop=False)
     if len(tax_subset) > 0:
@@ -230,49 +218,37 @@ def load_tsv_table(input_tsv_fpath,tax_subset=[],ODB_ID_index=True):
 
 
 ### Distance Matrix Functions ###
-def construct_id_dm(seq_df, seq_fpath, align_outpath="tmp/iddm_align.fasta",
-                    ordered=False,aligned=False,kalign_silent=True):
+def records_id_dm(records, align_outpath=None, aligned=False, kalign_silent=True, aligner=None):
+    """Identity distance matrix and aligned sequences for records (iterable of Bio.SeqRecord objects), see
+    construct_id_dm. If aligned is True, records are treated as an existing alignment and not realigned."""
+    if aligned:
+        alignment = Alignment.from_srs(pd.Series(OrderedDict((record.id, str(record.seq)) for record in records)))
+    else:
+        aligner = aligner if aligner is not None else default_aligner()
+        alignment = aligner.align(records, align_outpath=align_outpath, silent=kalign_silent)
+    id_dm = identity_distance_matrix(alignment)
+    align_srs = alignment.to_srs().rename("seq")
+    return id_dm, align_srs
+
+def construct_id_dm(seq_df, seq_fpath, align_outpath=None,
+                    ordered=False,aligned=False,kalign_silent=True,aligner=None):
     """Constructs an np.ndarray corresponding to the identity distance matrix of records in seq_df
 
     :param seq_df: DataFrame of OrthoDB/ NCBI sequence records; should only contain records for which identity
     distance matrix will be computed
     :param seq_fpath:  Path of fasta file containing at least all of the records in seq_df. Can contain more records
-    than are in seq_df - a temporary file containing only the records in seq_df.index will be generated (filtered_fpath)
-    :param align_outpath: Optional filepath. If provided, the resulting alignment will be stored there. Otherwise,
-    written to a temporary file (tmp/iddm_align.fasta)
+    than are in seq_df - only records in seq_df.index are passed to the aligner
+    :param align_outpath: Optional filepath. If provided, the resulting alignment will be stored there. Otherwise, the
+    alignment is only kept in memory
     :param ordered: boolean. True: distance matrix rows will be ordered by the order of records in seq_df.index;
     False: distance matrix rows will be ordered by the order of records in seq_fpath
-    :return: id_dm: np.ndarray of identity distance matrix calculated by AlignIO
+    :param aligner: Optional SSutility.SSaligner.Aligner; defaults to the [ALIGNMENT] configured aligner (kalign)
+    :return: id_dm: np.ndarray of identity distance matrix (see SSutility.SSdistance), rows in alignment order
     :return: align_srs: pandas Series object containing aligned sequences
     """
-    from Bio.Phylo.TreeConstruction import DistanceCalculator
-    from Bio import AlignIO
-    # Filter records in seq_fpath to new fasta only containing records in seq_df.index
-    # filtered_outpath = "tmp/iddm.fasta"
-    filtered_fpath = "tmp/alias_matches.fasta"
-    filter_fasta_infile(seq_df.index, seq_fpath, outfile_path=filtered_fpath, ordered=ordered)
-    if not aligned:
-        # KAlign sequences in filtered_outpath, write to align_outpath
-        with open(filtered_fpath,'r') as filtered_f, open(align_outpath,'wt',encoding='utf-8') as align_f:
-            args = ['kalign']
-            if kalign_silent:
-                subprocess.run(args=args, stdin=filtered_f, stdout=align_f, stderr=subprocess.PIPE, text=True)
-            else:
-                subprocess.run(args=args, stdin=filtered_f, stdout=align_f, text=True)
-    else:
-        align_outpath = filtered_fpath
-    align_srs = fasta_to_srs(align_outpath)
-    with open(align_outpath) as aligned_f:
-        aln = AlignIO.read(aligned_f, 'fasta')
-    calculator = DistanceCalculator('identity')
-    id_dm_obj = calculator.get_distance(aln)
-    # Convert AlignIO object to np.ndarray
-    for i, r in enumerate(id_dm_obj):
-        if i == 0:
-            id_dm = np.array(r)
-        else:
-            id_dm = np.vstack((id_dm, r))
-    return id_dm, align_srs
+    records = filtered_generator_wrapper(seq_df.index, seq_fpath, ordered)
+    return records_id_dm(records, align_outpath=align_outpath, aligned=aligned, kalign_silent=kalign_silent,
+                         aligner=aligner)
 
 def avg_dist_srs(index,distmat):
     #index is a pandas Index object with entries corresponding to the distmat (i.e. lengths and order should be equal)
@@ -284,23 +260,19 @@ def avg_dist_srs(index,distmat):
     return dist_srs
 
 def length_srs(fasta_fpath,id_subset=[]):
-    """Load sequence and length series corresponding to sequences in fasta_fpath, limited to id_subset if provided
+    """Load sequence and length series corresponding to sequences in fasta_fpath, limited to id_subset if provided.
+    Sequences of records outside id_subset are never extracted.
 
     :param fasta_fpath: File path to fasta of sequences to load length information for
     :param id_subset: if provided, returned series will only contain records in id_subset.
     :return: Series indexed on fasta ids where values are length of record sequences
     """
-    fasta_f = open(fasta_fpath)
-    fasta_records = SeqIO.parse(fasta_f,'fasta')
     length_dict = {}
     seq_dict = {}
-    for fasta in fasta_records:
-        fasta_id = fasta.id
-        if (len(id_subset) == 0) or \
-            (len(id_subset) > 0 and fasta_id in id_subset):
-            length_dict[fasta_id] = len(str(fasta.seq))
-            seq_dict[fasta_id] = str(fasta.seq)
+    ids = set(id_subset) if len(id_subset) > 0 else None
+    for fasta_id, description, seq in fasta_records(fasta_fpath, ids):
+        length_dict[fasta_id] = len(seq)
+        seq_dict[fasta_id] = seq_str(seq)
     lengths = pd.Series(data=length_dict,name='length')
     seqs = pd.Series(data=seq_dict,name='seq')
-    fasta_f.close()
     return seqs,lengths
@@ -0,0 +1,185 @@
+#SSfastaindex.py - faidx-like byte offset index for random access to fasta records
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+from collections import OrderedDict
+from Bio.Seq import Seq
+from Bio.Alphabet import single_letter_alphabet
+from Bio.SeqRecord import SeqRecord
+from SSutility.SSjournal import atomic_write
+from SSutility.SScompress import detect_compression, open_binary
+from SSutility.SSfastareader import mapped_fasta, scan_records, stream_records, record_id, sequence, seq_str
+
+#Sidecar index (.<fasta name>.fxi) of record ids, byte offsets and sequence lengths, rebuilt whenever the fasta's size
+#or modification time changes. Offsets of compressed fastas refer to the decompressed content.
+
+INDEX_VERSION = 1
+INDEX_HEADER = "#fasta_index"
+#FastaIndex objects loaded by this process, by absolute fasta path
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def index_path(fasta_fpath):
+    fasta_dir, fasta_fname = os.path.split(fasta_fpath)
+    return os.path.join(fasta_dir, ".{0}.fxi".format(fasta_fname))
+
+
+def _stamp(fasta_fpath):
+    stat = os.stat(fasta_fpath)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class FastaIndex:
+    """Record id -> (header offset, sequence offset, end offset, sequence length) for one fasta file, in file order.
+    Duplicate ids keep their first record (matching the de-duplication in SSfasta's record generators).
+
+    :param fasta_fpath: Indexed fasta file path
+    :param entries: OrderedDict of record id to offsets tuple (see above)
+    :param stamp: (size, mtime_ns) of fasta_fpath when the entries were built
+    """
+
+    def __init__(self, fasta_fpath, entries, stamp):
+        self.fasta_fpath = fasta_fpath
+        self.entries = entries
+        self.stamp = stamp
+
+    @classmethod
+    def build(cls, fasta_fpath):
+        """Indexes fasta_fpath with one pass over its content: a memory map of uncompressed files (see
+        SSfastareader.scan_records), or a decompressing stream of gzip/ zstd files (see SSfastareader.stream_records)."""
+        stamp = _stamp(fasta_fpath)
+        entries = OrderedDict()
+        if detect_compression(fasta_fpath) is None:
+            with mapped_fasta(fasta_fpath) as buffer:
+                for header_offset, seq_offset, end_offset, title in scan_records(buffer):
+                    fasta_id = record_id(title)
+                    if fasta_id not in entries:
+                        seq_length = len(sequence(buffer, seq_offset, end_offset))
+                        entries[fasta_id] = (header_offset, seq_offset, end_offset, seq_length)
+        else:
+            with open_binary(fasta_fpath) as fasta_f:
+                for header_offset, seq_offset, end_offset, title, seq in stream_records(fasta_f):
+                    fasta_id = record_id(title)
+                    if fasta_id not in entries:
+                        entries[fasta_id] = (header_offset, seq_offset, end_offset, len(seq))
+        return cls(fasta_fpath, entries, stamp)
+
+    @classmethod
+    def read(cls, fasta_fpath, idx_fpath=None):
+        """Loads the sidecar index for fasta_fpath. Returns None if it is missing, unreadable or stale."""
+        idx_fpath = idx_fpath if idx_fpath is not None else index_path(fasta_fpath)
+        try:
+            with open(idx_fpath, 'rt') as idx_f:
+                header = idx_f.readline().rstrip('\n').split('\t')
+                if header[:2] != [INDEX_HEADER, str(INDEX_VERSION)] or \
+                        tuple(int(value) for value in header[2:4]) != _stamp(fasta_fpath):
+                    return None
+                entries = OrderedDict()
+                for line in idx_f:
+                    fields = line.rstrip('\n').split('\t')
+                    entries[fields[0]] = tuple(int(value) for value in fields[1:5])
+        except (OSError, ValueError, IndexError):
+            return None
+        return cls(fasta_fpath, entries, _stamp(fasta_fpath))
+
+    def write(self, idx_fpath=None):
+        idx_fpath = idx_fpath if idx_fpath is not None else index_path(self.fasta_fpath)
+        try:
+            with atomic_write(idx_fpath) as idx_f:
+                idx_f.write("\t".join([INDEX_HEADER, str(INDEX_VERSION)] + [str(value) for value in self.stamp]) + "\n")
+                for fasta_id, offsets in self.entries.items():
+                    idx_f.write("\t".join([fasta_id] + [str(value) for value in offsets]) + "\n")
+        except OSError:
+            #Read-only input directory: index is rebuilt by every process
+            pass
+
+    def __contains__(self, record_id):
+        return record_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def ids(self):
+        """Record ids in file order."""
+        return list(self.entries)
+
+    def length(self, record_id):
+        """Sequence length of record_id without reading the fasta. Raises KeyError for unknown ids."""
+        return self.entries[record_id][3]
+
+    def _unique_ids(self, record_ids):
+        if record_ids is None:
+            return list(self.entries)
+        return [fasta_id for fasta_id in OrderedDict.fromkeys(record_ids) if fasta_id in self.entries]
+
+    def read_records(self, record_ids=None):
+        """Yields (record id, description, sequence) for record_ids (all records in file order if None) in the order
+        given, with sequences as zero-copy slices where possible (see SSfastareader.read_fasta). Ids not in the index
+        are skipped, as are repeated ids after their first occurrence."""
+        record_ids = self._unique_ids(record_ids)
+        if not record_ids:
+            return
+        if detect_compression(self.fasta_fpath) is None:
+            with mapped_fasta(self.fasta_fpath) as buffer:
+                for fasta_id in record_ids:
+                    header_offset, seq_offset, end_offset, seq_length = self.entries[fasta_id]
+                    title = bytes(buffer[header_offset+1:seq_offset]).rstrip().decode()
+                    yield fasta_id, title, sequence(buffer, seq_offset, end_offset)
+            return
+        #Compressed streams only seek forward: read the requested records in file order, discarding content between
+        #them and stopping after the last one, then yield them in the requested order
+        raw_records = {}
+        with open_binary(self.fasta_fpath) as fasta_f:
+            for fasta_id in sorted(record_ids, key=lambda fasta_id: self.entries[fasta_id][0]):
+                header_offset, seq_offset, end_offset, seq_length = self.entries[fasta_id]
+                fasta_f.seek(header_offset)
+                raw_records[fasta_id] = fasta_f.read(end_offset - header_offset)
+        for fasta_id in record_ids:
+            header_offset, seq_offset, end_offset, seq_length = self.entries[fasta_id]
+            raw_record = raw_records.pop(fasta_id)
+            title = raw_record[1:seq_offset-header_offset].rstrip().decode()
+            yield fasta_id, title, sequence(raw_record, seq_offset - header_offset, len(raw_record))
+
+    def records(self, record_ids=None):
+        """Yields Bio.SeqRecord objects for record_ids, see read_records."""
+        for fasta_id, title, seq in self.read_records(record_ids):
+            yield SeqRecord(Seq(seq_str(seq), single_letter_alphabet), id=fasta_id, name=fasta_id, description=title)
+
+    def sequences(self, record_ids=None):
+        """Yields (record_id, sequence str) pairs for record_ids, see read_records."""
+        for fasta_id, title, seq in self.read_records(record_ids):
+            yield fasta_id, seq_str(seq)
+
+
+def fasta_index(fasta_fpath):
+    """Returns the FastaIndex for fasta_fpath, reusing this process's copy or the sidecar index while fasta_fpath is
+    unchanged and (re)building and writing the sidecar otherwise."""
+    key = os.path.abspath(fasta_fpath)
+    stamp = _stamp(fasta_fpath)
+    with _indexes_lock:
+        index = _indexes.get(key)
+    if index is not None and index.stamp == stamp:
+        return index
+    index = FastaIndex.read(fasta_fpath)
+    if index is None:
+        index = FastaIndex.build(fasta_fpath)
+        index.write()
+    with _indexes_lock:
+        _indexes[key] = index
+    return index
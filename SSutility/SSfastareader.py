@@ -0,0 +1,141 @@
+#SSfastareader.py - Memory-mapped fasta reader yielding zero-copy record slices
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import mmap
+from contextlib import contextmanager
+from SSutility.SScompress import detect_compression, open_binary
+
+#Lightweight replacement for Bio.SeqIO.parse(handle, 'fasta') where only ids, descriptions and sequences are needed.
+#Single line sequences (ie OrthoDB fastas) are memoryview slices of a memory map; use seq_str to convert to str.
+
+#Bytes removed from the end of sequence lines by str.rstrip()
+_TRAILING_WHITESPACE = frozenset(b" \t\n\r\x0b\x0c")
+
+
+@contextmanager
+def mapped_fasta(fasta_fpath):
+    """Context manager providing a read-only memory map of uncompressed fasta_fpath. Slices of the buffer must not be
+    used after the block. Compressed files can't be mapped without decompressing them into memory; read them with
+    fasta_records (or stream_records) instead."""
+    if detect_compression(fasta_fpath) is not None:
+        raise ValueError("Cannot map compressed fasta {0}; use fasta_records".format(fasta_fpath))
+    with open(fasta_fpath, 'rb') as fasta_f:
+        try:
+            buffer = mmap.mmap(fasta_f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            #Empty files cannot be mapped
+            yield b""
+            return
+        try:
+            yield buffer
+        finally:
+            try:
+                buffer.close()
+            except BufferError:
+                #Slices still referenced by the caller; the map is released once they are
+                pass
+
+
+def scan_records(buffer):
+    """Yields (header_offset, seq_offset, end_offset, title) for each record in fasta buffer. title is the header line
+    without '>' and trailing whitespace; [seq_offset, end_offset) spans the sequence lines."""
+    size = len(buffer)
+    if buffer[:1] == b">":
+        pos = 0
+    else:
+        pos = buffer.find(b"\n>")
+        if pos == -1:
+            return
+        pos += 1
+    while pos != -1:
+        header_end = buffer.find(b"\n", pos)
+        if header_end == -1:
+            header_end = size
+        next_record = buffer.find(b"\n>", header_end)
+        end_offset = size if next_record == -1 else next_record + 1
+        title = bytes(buffer[pos+1:header_end]).rstrip().decode()
+        yield pos, min(header_end + 1, size), end_offset, title
+        pos = next_record if next_record == -1 else next_record + 1
+
+
+def record_id(title):
+    split_title = title.split(None, 1)
+    return split_title[0] if split_title else ""
+
+
+def sequence(buffer, seq_offset, end_offset):
+    """Sequence bytes for lines [seq_offset, end_offset) of buffer: a zero-copy memoryview if the sequence is on one
+    line, otherwise a bytes object with line breaks removed."""
+    end = end_offset
+    while end > seq_offset and buffer[end-1] in _TRAILING_WHITESPACE:
+        end -= 1
+    if all(buffer.find(char, seq_offset, end) == -1 for char in (b"\n", b"\r", b" ")):
+        return memoryview(buffer)[seq_offset:end]
+    lines = bytes(buffer[seq_offset:end]).split(b"\n")
+    return b"".join(line.rstrip() for line in lines).replace(b" ", b"").replace(b"\r", b"")
+
+
+def seq_str(seq):
+    """str of a sequence returned by read_fasta/ sequence."""
+    return str(seq, 'ascii')
+
+
+def read_fasta(buffer, ids=None):
+    """Yields (record id, description, sequence) for records in fasta buffer (see mapped_fasta), limited to ids if
+    provided. Sequences are memoryview/ bytes (see sequence) and are only extracted for yielded records.
+
+    :param buffer: fasta content buffer, ie from mapped_fasta
+    :param ids: optional container of record ids to yield
+    """
+    for header_offset, seq_offset, end_offset, title in scan_records(buffer):
+        fasta_id = record_id(title)
+        if ids is None or fasta_id in ids:
+            yield fasta_id, title, sequence(buffer, seq_offset, end_offset)
+
+
+def stream_records(fasta_f, ids=None):
+    """Yields (header_offset, seq_offset, end_offset, title, sequence) for each record read line by line from binary
+    stream fasta_f (ie a decompressing SScompress.open_binary stream), holding only the current record in memory.
+    Offsets refer to the streamed (decompressed) content. sequence is a bytes object, or None for records whose id is
+    not in ids (if provided)."""
+    offset, title, keep = 0, None, False
+    header_offset, seq_offset, seq_lines = 0, 0, []
+    for line in fasta_f:
+        if line.startswith(b">"):
+            if title is not None:
+                yield header_offset, seq_offset, offset, title, b"".join(seq_lines) if keep else None
+            title = line[1:].rstrip().decode()
+            keep = ids is None or record_id(title) in ids
+            header_offset, seq_offset, seq_lines = offset, offset + len(line), []
+        elif keep:
+            seq_lines.append(line.rstrip().replace(b" ", b"").replace(b"\r", b""))
+        offset += len(line)
+    if title is not None:
+        yield header_offset, seq_offset, offset, title, b"".join(seq_lines) if keep else None
+
+
+def fasta_records(fasta_fpath, ids=None):
+    """Yields (record id, description, sequence) for records in fasta_fpath, limited to ids if provided. Uncompressed
+    files are read from a memory map (see read_fasta); gzip/ zstd compressed files are decompressed as a stream, one
+    record at a time (see stream_records)."""
+    if detect_compression(fasta_fpath) is None:
+        with mapped_fasta(fasta_fpath) as buffer:
+            yield from read_fasta(buffer, ids)
+        return
+    with open_binary(fasta_fpath) as fasta_f:
+        for header_offset, seq_offset, end_offset, title, seq in stream_records(fasta_f, ids):
+            if seq is not None:
+                yield record_id(title), title, seq
@@ -0,0 +1,191 @@
+#SSjournal.py - Append-only acquisition journal and atomic file writes for resumable input downloads
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from SSutility.SScompress import compressed_writer
+
+JOURNAL_COLUMNS = ['time', 'source', 'gene_symbol', 'status', 'size', 'sha256', 'value']
+COMPLETE = "complete"
+#Status for pairs whose last attempt failed with a network error/ unavailable service (retried next run), as opposed to
+#permanent outcomes such as queries without results which are logged to errors.tsv
+TRANSIENT = "transient"
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+@contextmanager
+def atomic_write(fpath, mode='wt', compression=None, compresslevel=None):
+    """Context manager yielding a file object for a temporary file next to fpath, which is moved to fpath (os.replace)
+    only if the block completes. An interrupted write never leaves a partial file at fpath.
+
+    :param fpath: Destination file path
+    :param mode: 'wt' or 'wb'
+    :param compression: Optional 'gzip' or 'zstd'; content is compressed as it is written (see SScompress)
+    :param compresslevel: Optional compression level
+    """
+    fpath_dir = os.path.dirname(fpath) or "."
+    fd, tmp_fpath = tempfile.mkstemp(dir=fpath_dir, prefix=".{0}.".format(os.path.basename(fpath)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as raw_f:
+            stream = compressed_writer(raw_f, compression, compresslevel)
+            out_f = io.TextIOWrapper(stream, encoding='utf-8') if 't' in mode else stream
+            yield out_f
+            if out_f is not stream:
+                out_f.flush()
+                out_f.detach()
+            if stream is not raw_f:
+                stream.close()
+            raw_f.flush()
+            os.fsync(raw_f.fileno())
+        os.replace(tmp_fpath, fpath)
+    except BaseException:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+
+
+def file_sha256(fpath, chunk_size=2**20):
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AppendOnlyLog:
+    """Append-only tab separated log with a header line of columns, where the latest line per key (the values of
+    key_columns) is that key's current state. Progress is saved by appending a single line instead of rewriting a
+    table, lines cut off by an interrupted write are ignored when the log is loaded, and compact rewrites the log with
+    only the current entries.
+
+    :param log_fpath: Log file path, created (with a header line) if missing
+    :param columns: Column names of log lines
+    :param key_columns: Columns identifying an entry
+    """
+
+    def __init__(self, log_fpath, columns, key_columns):
+        self.log_fpath = log_fpath
+        self.columns = columns
+        self.key_columns = key_columns
+        self._lock = threading.Lock()
+        self.entries = {}
+        #True if the log predates this process
+        self.existed = os.path.exists(log_fpath)
+        if self.existed:
+            self._load()
+        else:
+            with open(log_fpath, 'wt') as log_f:
+                log_f.write("\t".join(columns) + "\n")
+
+    def _key(self, entry):
+        return tuple(entry[col] for col in self.key_columns)
+
+    def _load(self):
+        with open(self.log_fpath, 'rt') as log_f:
+            log_f.readline()
+            for line in log_f:
+                fields = line.rstrip('\n').split('\t')
+                if not line.endswith('\n') or len(fields) != len(self.columns):
+                    continue
+                entry = dict(zip(self.columns, fields))
+                self.entries[self._key(entry)] = entry
+
+    def append(self, entry):
+        """Appends entry (dict with a str value for every column; tabs/ newlines are replaced by spaces) as the current
+        state of its key."""
+        entry = dict((col, str(entry[col]).replace('\t', ' ').replace('\n', ' ')) for col in self.columns)
+        line = "\t".join(entry[col] for col in self.columns) + "\n"
+        with self._lock:
+            with open(self.log_fpath, 'at') as log_f:
+                log_f.write(line)
+            self.entries[self._key(entry)] = entry
+
+    def compact(self):
+        """Atomically rewrites the log with only the latest entry per key."""
+        with self._lock:
+            with atomic_write(self.log_fpath) as log_f:
+                log_f.write("\t".join(self.columns) + "\n")
+                for entry in self.entries.values():
+                    log_f.write("\t".join(entry[col] for col in self.columns) + "\n")
+
+
+class AcquisitionJournal(AppendOnlyLog):
+    """AppendOnlyLog of acquisition results, one line per (source, gene_symbol) outcome with the size and sha256
+    checksum of the written file, so a restarted run resumes exactly the pairs without a complete entry whose file is
+    still intact.
+
+    :param journal_fpath: Journal file path (ie [run_dir]/acquisition_journal.tsv)
+    """
+
+    def __init__(self, journal_fpath):
+        #existed is used to adopt input files downloaded before journaling existed
+        super().__init__(journal_fpath, JOURNAL_COLUMNS, ['source', 'gene_symbol'])
+        self.journal_fpath = journal_fpath
+
+    def record(self, source, gene_symbol, status=COMPLETE, fpath=None, value=""):
+        """Appends an entry for (source, gene_symbol). If fpath is provided, its size and sha256 are stored so later
+        runs can verify the file. value can hold a small result (ie mapped gene ID or protein ID list) which is
+        compacted into summary tables (see values)."""
+        size, checksum = "", ""
+        if fpath is not None:
+            size, checksum = str(os.path.getsize(fpath)), file_sha256(fpath)
+        self.append({'time': "{0:.3f}".format(time.time()), 'source': source, 'gene_symbol': gene_symbol,
+                     'status': status, 'size': size, 'sha256': checksum, 'value': value})
+
+    def entry(self, source, gene_symbol):
+        return self.entries.get((source, gene_symbol))
+
+    def is_complete(self, source, gene_symbol, fpath=None, verify_checksum=False):
+        """True if the latest entry for (source, gene_symbol) is complete and, if fpath is provided, fpath still
+        exists with the journaled size (and checksum if verify_checksum). Files present at fpath without a journal
+        entry are only trusted (and journaled) if the journal was created by this process, ie for run directories
+        populated before journaling was introduced. Use run_journal so all stages of a run share that decision."""
+        entry = self.entry(source, gene_symbol)
+        if entry is None:
+            if fpath is not None and not self.existed and os.path.exists(fpath):
+                self.record(source, gene_symbol, fpath=fpath)
+                return True
+            return False
+        if entry['status'] != COMPLETE:
+            return False
+        if fpath is not None:
+            if not os.path.exists(fpath) or (entry['size'] and os.path.getsize(fpath) != int(entry['size'])):
+                return False
+            if verify_checksum and entry['sha256'] and file_sha256(fpath) != entry['sha256']:
+                return False
+        return True
+
+    def values(self, source):
+        """dict of gene_symbol to journaled value for complete entries from source."""
+        return dict((gene_symbol, entry['value']) for (entry_source, gene_symbol), entry in self.entries.items()
+                    if entry_source == source and entry['status'] == COMPLETE)
+
+
+def run_journal(run_name):
+    """AcquisitionJournal for run directory run_name, shared by all acquisition stages of the process so that input
+    files from before journaling are adopted by every stage, not only by the first one to append (see
+    AcquisitionJournal.is_complete). A new journal is loaded if the journal file was removed since."""
+    journal_fpath = os.path.abspath("{0}/acquisition_journal.tsv".format(run_name))
+    with _journals_lock:
+        if journal_fpath not in _journals or not os.path.exists(journal_fpath):
+            _journals[journal_fpath] = AcquisitionJournal(journal_fpath)
+        return _journals[journal_fpath]
@@ -0,0 +1,173 @@
+#SStaxonomy.py - Indexed OrthoDB taxonomy catalog (odb10v0_species.tab) with a binary cache reused across runs
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import csv
+import pickle
+import numpy as np
+import pandas as pd
+from SSutility.SSjournal import atomic_write, file_sha256
+
+#The species table is parsed once into a pickled catalog next to it (.<table name>.catalog.pickle), reused while the
+#table's size and modification time (or, after a fresh checkout, its sha256) are unchanged.
+
+CATALOG_COLUMNS = ['tax_id', 'odb_id', 'spec_name', 'assembly_id', 'clustered_genes', 'ortho_groups', 'mapping_type']
+#Columns returned by TaxonomyCatalog.table (and SSconfig.odb_tablev10)
+TABLE_COLUMNS = ['tax_id', 'odb_id', 'spec_name', 'assembly_id']
+#Increment when the pickled catalog layout changes
+CATALOG_VERSION = 1
+DEFAULT_TABLE_PATH = "config/odb10v0_species.tab"
+#Catalogs loaded by this process, by absolute table path
+_catalogs = {}
+
+
+def _count(value):
+    return int(value) if value else np.nan
+
+
+class TaxonomyCatalog:
+    """OrthoDB species records with dict indexes for O(1) lookups by species name, NCBI tax_id and OrthoDB organism
+    id (odb_id, ie 9606_0). Species names and tax_ids can map to more than one odb_id; lookups by either return
+    records in table order. Records are dicts with CATALOG_COLUMNS keys.
+
+    :param rows: list of record tuples in CATALOG_COLUMNS order (row position is the original table row index)
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.by_name, self.by_tax_id, self.by_odb_id = {}, {}, {}
+        for i, row in enumerate(rows):
+            self.by_tax_id.setdefault(row[0], []).append(i)
+            self.by_odb_id[row[1]] = i
+            self.by_name.setdefault(row[2], []).append(i)
+
+    @classmethod
+    def from_table(cls, table_path=DEFAULT_TABLE_PATH):
+        """Parses an odb10v0_species.tab formatted file (see SSconfig.odb_tablev10 for columns)."""
+        rows = []
+        with open(table_path, 'rt', newline='') as table_f:
+            for fields in csv.reader(table_f, delimiter='\t'):
+                if not fields:
+                    continue
+                fields = (fields + [''] * len(CATALOG_COLUMNS))[:len(CATALOG_COLUMNS)]
+                rows.append((int(fields[0]), fields[1], fields[2], fields[3] or np.nan, _count(fields[4]),
+                             _count(fields[5]), fields[6]))
+        return cls(rows)
+
+    def _record(self, i):
+        return dict(zip(CATALOG_COLUMNS, self.rows[i]))
+
+    def lookup_name(self, spec_name):
+        """List of records for scientific name spec_name (empty if unknown)."""
+        return [self._record(i) for i in self.by_name.get(spec_name, [])]
+
+    def lookup_tax_id(self, tax_id):
+        """List of records for NCBI tax_id (int or str; an odb_id style suffix such as 9606_0 is ignored)."""
+        try:
+            tax_id = int(str(tax_id).split('_')[0])
+        except ValueError:
+            return []
+        return [self._record(i) for i in self.by_tax_id.get(tax_id, [])]
+
+    def lookup_odb_id(self, odb_id):
+        """Record for OrthoDB organism id odb_id (ie 9606_0), or None."""
+        i = self.by_odb_id.get(odb_id)
+        return self._record(i) if i is not None else None
+
+    def tax_id(self, spec_name):
+        """NCBI tax_id (int) for spec_name. Raises KeyError for unknown names."""
+        return self.rows[self.by_name[spec_name][0]][0]
+
+    def spec_name(self, tax_id):
+        """Scientific name for tax_id (int, str or odb_id). Raises KeyError for unknown tax_ids."""
+        records = self.lookup_tax_id(tax_id)
+        if not records:
+            raise KeyError(tax_id)
+        return records[0]['spec_name']
+
+    def table(self, species_list):
+        """DataFrame of TABLE_COLUMNS for the records of every species name in species_list, indexed by table row
+        and sorted by tax_id (same content as the original odb_tablev10 filtering)."""
+        idxs = [i for spec in species_list for i in self.by_name.get(spec, [])]
+        table = pd.DataFrame([self.rows[i][:len(TABLE_COLUMNS)] for i in idxs], index=pd.Index(idxs, dtype='int64'),
+                             columns=TABLE_COLUMNS, dtype=object)
+        return table.sort_values(by='tax_id')
+
+    def resolve_tax_subset(self, subset_keys):
+        """Converts [AnalysisODBTaxSubset] keys to odb_ids. Keys which are odb_ids are kept; NCBI tax_ids are expanded
+        to their odb_ids. Unknown keys are kept unchanged (they match no OrthoDB records)."""
+        odb_ids = []
+        for key in subset_keys:
+            key = key.strip()
+            if key in self.by_odb_id:
+                odb_ids.append(key)
+            elif key.isdigit() and int(key) in self.by_tax_id:
+                odb_ids.extend(self.rows[i][1] for i in self.by_tax_id[int(key)])
+            else:
+                odb_ids.append(key)
+        return list(dict.fromkeys(odb_ids))
+
+
+def catalog_cache_path(table_path):
+    table_dir, table_fname = os.path.split(table_path)
+    return os.path.join(table_dir, ".{0}.catalog.pickle".format(table_fname))
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as cache_f:
+            cached = pickle.load(cache_f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    if not isinstance(cached, dict) or cached.get('version') != CATALOG_VERSION:
+        return None
+    return cached
+
+
+def _write_cache(cache_path, cached):
+    try:
+        with atomic_write(cache_path, 'wb') as cache_f:
+            pickle.dump(cached, cache_f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        #Read-only config directory: catalog is rebuilt by every process
+        pass
+
+
+def load_catalog(table_path=DEFAULT_TABLE_PATH, cache_path=None):
+    """Returns the TaxonomyCatalog for table_path from its binary cache, rebuilding (and rewriting) the cache if it is
+    missing, from an older catalog version or stale."""
+    cache_path = cache_path if cache_path is not None else catalog_cache_path(table_path)
+    stat = os.stat(table_path)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    cached = _read_cache(cache_path)
+    if cached is not None and cached['stamp'] == stamp:
+        return cached['catalog']
+    sha256 = file_sha256(table_path)
+    if cached is not None and cached['stamp'][0] == stat.st_size and cached['sha256'] == sha256:
+        cached['stamp'] = stamp
+        _write_cache(cache_path, cached)
+        return cached['catalog']
+    catalog = TaxonomyCatalog.from_table(table_path)
+    _write_cache(cache_path, {'version':CATALOG_VERSION, 'stamp':stamp, 'sha256':sha256, 'catalog':catalog})
+    return catalog
+
+
+def taxonomy_catalog(table_path=DEFAULT_TABLE_PATH):
+    """TaxonomyCatalog for table_path, loaded once per process (see load_catalog)."""
+    key = os.path.abspath(table_path)
+    if key not in _catalogs:
+        _catalogs[key] = load_catalog(table_path)
+    return _catalogs[key]
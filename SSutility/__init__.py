@@ -1,5 +1,21 @@
 all = ['SSconfig','SSdirectory','SSerrors','SSfasta']
 
-import SSutility.SSconfig
+#Run configuration and input tables (config, tax_subset, gene_id_df, tax_table) are loaded from the RunContext on first
+#access, so importing SSutility (or its modules) reads no config files and creates no directories.
+RUN_CONTEXT_ATTRS = ['config', 'tax_subset', 'gene_id_df', 'tax_table']
+_run_context = None
 
-config, tax_subset, gene_id_df, tax_table = SSutility.SSconfig.config_initialization()
\ No newline at end of file
+
+def run_context():
+    """SSconfig.RunContext for config/config.txt shared by this process."""
+    global _run_context
+    if _run_context is None:
+        from SSutility.SSconfig import RunContext
+        _run_context = RunContext()
+    return _run_context
+
+
+def __getattr__(name):
+    if name in RUN_CONTEXT_ATTRS:
+        return getattr(run_context(), name)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
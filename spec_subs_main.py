@@ -15,12 +15,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from SSutility import SSdirectory, SSerrors
+from SSutility import SSdirectory, SSerrors, SSbuild
 import sys, os
 
 def ss_acquisition(config, gene_id_df, tax_table):
     """Uses gene_symbol column in gene_id_df to query OrthoDB and NCBI for input sequence data. Downloads alias
-    information for all symbols from GeneCards into alias_data.
+    information for all symbols from GeneCards into alias_data. With [RUN] ConcurrentAcquisition, the three sources
+    are acquired concurrently (see SSacquisition.SSorchestrator).
 
     :param config: configparser object with run params. See SSutility.SSconfig
     :param gene_id_df: DataFrame containing Gene ID and symbol information. See SSutility.SSconfig
@@ -30,6 +31,11 @@ def ss_acquisition(config, gene_id_df, tax_table):
     """
     from SSacquisition import ODBquery,NCBIquery,aliasQuery
     print("===Record Data Acquisition====")
+    if config['RUN'].getboolean('ConcurrentAcquisition', fallback=False):
+        from SSacquisition.SSorchestrator import run_acquisition
+        run_acquisition(config, gene_id_df, tax_table,
+                        progress_interval=config['RUN'].getfloat('AcquisitionProgressSeconds', fallback=10))
+        return
     gene_symbols = gene_id_df['gene_symbol']
     valid_queries, failed_queries = ODBquery.download_ODB_input(gene_symbols, tax_table, config)
     ags_mapped_df = NCBIquery.download_AGS_data(gene_id_df, config)
@@ -56,32 +62,40 @@ def ss_filter(config, tax_subset, gene_id_df):
     errors_fpath = "{0}/{1}".format(run_name,errors_fname)
     qc_fpath = "{0}/{1}".format(run_name,qc_fname)
 
-    check_errors,errors_df = SSerrors.load_errors(errors_fpath)
-    check_qc, qc_df = SSerrors.load_errors(qc_fpath)
+    errors = SSerrors.error_registry(errors_fpath)
+    qc_log = SSerrors.error_registry(qc_fpath,SSerrors.QC_COLUMNS)
     qc_symbols = []
+    alias_dict = ODBfilter.load_alias_dict(config, gene_symbols)
+    ledger = build_ledger(config)
 
     for symbol in gene_symbols:
         out_records_fpath = "{0}/output/{1}/{1}_records.tsv".format(run_name, symbol)
-        if not os.path.exists(out_records_fpath) or config['RUN'].getboolean('OverwriteFilter'):
-            if check_errors and symbol in errors_df['gene_symbol'].unique():
-                odb_error = (symbol in errors_df.loc[errors_df['error_type']=="OrthoDBQueryError",'gene_symbol'].unique())
-                ncbi_error = (symbol in errors_df.loc[errors_df['error_type'] == "NCBIQueryError", 'gene_symbol'].unique())
+        if ledger is not None:
+            build_inputs = SSbuild.filter_inputs(config,symbol,tax_subset,aliases=alias_dict[symbol])
+            stale = not ledger.is_fresh('filter',symbol,build_inputs,SSbuild.filter_outputs(config,symbol))
+        else:
+            stale = not os.path.exists(out_records_fpath)
+        if stale or config['RUN'].getboolean('OverwriteFilter'):
+            if errors.has(symbol):
+                odb_error = errors.has(symbol,error_type="OrthoDBQueryError")
+                ncbi_error = errors.has(symbol,error_type="NCBIQueryError")
                 if odb_error or ncbi_error:
                     continue
-                elif symbol in errors_df.loc[errors_df['error_type']=="SequenceDataError",'gene_symbol'].unique():
-                    SSerrors.print_errors(errors_df,symbol,error_type="SequenceDataError")
+                elif errors.has(symbol,error_type="SequenceDataError"):
+                    errors.print_gene(symbol,error_type="SequenceDataError")
                     continue
             try:
-                NCBIfilter.final_combined_input(config,symbol,tax_subset)
+                NCBIfilter.final_combined_input(config,symbol,tax_subset,aliases=alias_dict[symbol])
             except SSerrors.SequenceDataError as e:
                 continue
+            if ledger is not None:
+                ledger.record('filter',symbol,build_inputs,SSbuild.filter_outputs(config,symbol))
         #Write QC output for previously filtered results (ie out_records_fpath exists)
-        elif check_qc and symbol in qc_df['gene_symbol'].unique():
+        elif qc_log.has(symbol):
             qc_symbols.append(symbol)
     print("==Previosuly cached QC==")
     for qc_symbol in qc_symbols:
-        for i,row in qc_df.loc[qc_df['gene_symbol']==qc_symbol,:].iterrows():
-            print("{0}\t{1}".format(row.values[0],row.values[1]))
+        qc_log.print_gene(qc_symbol)
 
 def ss_analysis(config,gene_id_df):
     """Calculates jensen-shannon divergence, BLOSUM62 scores, and various other alignment metrics for the filtered
@@ -95,17 +109,40 @@ def ss_analysis(config,gene_id_df):
     """
     from SSanalysis import SSanalysiscalc as ac
     gene_symbols = gene_id_df['gene_symbol']
-    ac.overall_summary_table(config, gene_symbols, use_jsd_gap_penalty=True, force_recalc=False)
+    ac.overall_summary_table(config, gene_symbols, use_jsd_gap_penalty=True,
+                             force_recalc=config['RUN'].getboolean('OverwriteAnalysis'), ledger=build_ledger(config))
 
 def ss_visualization(config):
-    from SSanalysis import SSvisualization
+    """Summary plots for the overall summary table, skipped if the table and plotted symbols are unchanged since the
+    plots were last made ([RUN] IncrementalBuild)."""
     plot_symbols = ["ATP5MC1", "ATP5MC3", "ATPIF1", "MANF"]
+    run_name = config['RUN']['RunName']
+    ledger = build_ledger(config)
+    if ledger is not None:
+        build_inputs = {'config': SSbuild.config_digest(config,'plot'), 'plot_symbols': ",".join(plot_symbols),
+                        'overall_summary': SSbuild.content_digest("{0}/summary/overall_summary.tsv".format(run_name))}
+        plot_outputs = ["{0}/summary/GS_consensus_uniques.tsv".format(run_name)]
+        if ledger.is_fresh('plot',"",build_inputs,plot_outputs):
+            print("Summary plots are up to date")
+            return
+    from SSanalysis import SSvisualization
     SSvisualization.summary_plots(config,plot_symbols)
+    if ledger is not None:
+        ledger.record('plot',"",build_inputs,plot_outputs)
+
+def build_ledger(config):
+    """SSbuild.BuildLedger for the run if [RUN] IncrementalBuild is set, else None."""
+    if config['RUN'].getboolean('IncrementalBuild', fallback=False):
+        return SSbuild.run_build_ledger(config['RUN']['RunName'])
+    return None
 
 
 def main():
-    import SSutility
-    from SSutility import config, tax_subset, gene_id_df, tax_table
+    from SSutility import run_context
+    context = run_context()
+    context.prepare_run_directory()
+    config, tax_subset, gene_id_df, tax_table = context.config, context.tax_subset, context.gene_id_df, \
+                                                context.tax_table
     ss_acquisition(config, gene_id_df, tax_table)
     ss_filter(config, tax_subset, gene_id_df)
     ss_analysis(config,gene_id_df)
@@ -0,0 +1,157 @@
+#benchAcquisition.py - Offline throughput benchmark for the acquisition layer (download_ODB_input, download_AGS_data,
+#download_alias_data) against the local mock server in tests/mockServer.py.
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#Usage (from the repository root):
+#   python tests/benchAcquisition.py --genes 200 --latency 0.05 --jitter 0.05 --rate-limit 20 --error-rate 0.01
+#Client request rates/ worker counts come from config/config.txt unless overridden (--rps, --workers).
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from SSutility import SSconfig, SSdirectory
+from SSacquisition import SSdownload, ODBquery, NCBIquery, aliasQuery
+from mockServer import MockAcquisitionServer, mock_base_urls, REPLICATE_SEP
+
+ODB_FIXTURE_SYMBOLS = ["APEX1", "ATP5MC1", "ATPIF1", "CALM1", "CD151", "IRF2BP2", "ISPD"]
+NCBI_TAXID = "9999"
+REPO_DIR = os.getcwd()
+
+
+class LatencyRecorder:
+    #Collects client side request latencies from every session created by SSdownload.pooled_session
+    def __init__(self):
+        self.latencies = []
+        self.lock = threading.Lock()
+        self._pooled_session = SSdownload.pooled_session
+
+    def hook(self, response, *args, **kwargs):
+        with self.lock:
+            self.latencies.append(response.elapsed.total_seconds())
+
+    def __enter__(self):
+        def recording_session(max_connections=4):
+            session = self._pooled_session(max_connections)
+            session.hooks['response'].append(self.hook)
+            return session
+        SSdownload.pooled_session = recording_session
+        return self
+
+    def __exit__(self, *args):
+        SSdownload.pooled_session = self._pooled_session
+
+
+def bench_config(run_name, args):
+    config = SSconfig.parse_config(os.path.join(REPO_DIR, "config/config.txt"))
+    config['RUN']['RunName'] = run_name
+    config['RUN']['OverwriteInput'] = 'no'
+    config['CACHE']['UseCache'] = 'no'
+    config['NCBI']['NCBITaxID'] = NCBI_TAXID
+    config['NCBI']['NCBIAPIKey'] = ''
+    config['NCBI']['NCBIOrthologsFilePath'] = 'gene_orthologs_bench.tsv'
+    if args.rps:
+        config['ODB']['ODBRequestsPerSecond'] = str(args.rps)
+        config['GeneCards']['GeneCardsRequestsPerSecond'] = str(args.rps)
+    if args.workers:
+        config['ODB']['ODBMaxWorkers'] = str(args.workers)
+        config['GeneCards']['GeneCardsMaxWorkers'] = str(args.workers)
+    return config
+
+
+def bench_gene_id_df(n_genes):
+    #Replicated fixture symbols with synthetic human Gene IDs; matching gene_orthologs rows map them to NCBI_TAXID
+    symbols = ["{0}{1}{2}".format(ODB_FIXTURE_SYMBOLS[i % len(ODB_FIXTURE_SYMBOLS)], REPLICATE_SEP, i)
+               for i in range(n_genes)]
+    gene_id_df = pd.DataFrame({'gene_symbol': symbols, 'human_gene_id': [str(10**8 + i) for i in range(n_genes)]})
+    gene_id_df.index.name = 'overall_index'
+    with open('gene_orthologs_bench.tsv', 'wt') as orthologs_f:
+        orthologs_f.write("#tax_id\tGeneID\trelationship\tOther_tax_id\tOther_GeneID\n")
+        for i in range(n_genes):
+            orthologs_f.write("9606\t{0}\tOrtholog\t{1}\t{2}\n".format(10**8 + i, NCBI_TAXID, 2 * 10**8 + i))
+    return gene_id_df
+
+
+def run_stage(name, func, n_genes, server):
+    requests_before = sum(server.state.requests.values())
+    statuses_before = server.state.statuses.copy()
+    with LatencyRecorder() as recorder:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+    statuses = server.state.statuses - statuses_before
+    latencies = np.array(recorder.latencies) if recorder.latencies else np.zeros(1)
+    return {'stage': name, 'genes': n_genes, 'seconds': round(elapsed, 3),
+            'genes_per_s': round(n_genes / elapsed, 2),
+            'requests': sum(server.state.requests.values()) - requests_before,
+            'errors': sum(count for status, count in statuses.items() if status >= 400),
+            'p50_ms': round(np.percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(np.percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(np.percentile(latencies, 99) * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Acquisition throughput benchmark against a local mock server")
+    parser.add_argument("--genes", type=int, default=50, help="Number of genes to acquire")
+    parser.add_argument("--stages", default="odb,ncbi,alias", help="Comma separated stages to run")
+    parser.add_argument("--latency", type=float, default=0.02, help="Server latency per response (seconds)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Additional random latency (seconds)")
+    parser.add_argument("--rate-limit", type=float, default=None, help="Server requests/second before 429s")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered 503")
+    parser.add_argument("--rps", type=float, default=None, help="Client ODB/ GeneCards requests per second")
+    parser.add_argument("--workers", type=int, default=None, help="Client ODB/ GeneCards max workers")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark working directory")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_acquisition_")
+    os.chdir(work_dir)
+    run_name = "bench_run"
+    for dirpath in ["{0}/input/ODB", "{0}/input/NCBI", "{0}/summary", "alias_data"]:
+        SSdirectory.create_directory(dirpath.format(run_name))
+    config = bench_config(run_name, args)
+    gene_id_df = bench_gene_id_df(args.genes)
+    gene_symbols = gene_id_df['gene_symbol']
+    tax_table = pd.DataFrame({'tax_id': [9606, 10090, 43179]})
+    stages = {'odb': lambda: ODBquery.download_ODB_input(gene_symbols, tax_table, config),
+              'ncbi': lambda: NCBIquery.download_AGS_data(gene_id_df, config),
+              'alias': lambda: aliasQuery.download_alias_data(gene_symbols, config)}
+    server_kwargs = dict(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                         error_rate=args.error_rate)
+    results = []
+    try:
+        with MockAcquisitionServer(**server_kwargs) as server, mock_base_urls(server):
+            for stage in args.stages.split(','):
+                results.append(run_stage(stage, stages[stage], args.genes, server))
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.keep:
+            shutil.rmtree(work_dir)
+    print("Server: {0}".format(", ".join("{0}={1}".format(k, v) for k, v in server_kwargs.items())))
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(pd.DataFrame(results).set_index('stage'))
+
+
+if __name__ == '__main__':
+    main()
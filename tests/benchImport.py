@@ -0,0 +1,84 @@
+#benchImport.py - Start-up benchmark: import time and peak RSS of each package/ module, measured in fresh interpreters
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#Usage (from the repository root):
+#   python tests/benchImport.py --repeat 5
+#   python tests/benchImport.py --modules SSutility.SSfasta SSanalysis.SSanalysiscalc
+#Each module is imported in a new interpreter (so no import is served from sys.modules). Reported RSS is the peak
+#resident size of that interpreter minus the peak of an interpreter that only imports the standard library modules
+#used for measuring. Heavy optional dependencies pulled in by the import and files created in the working directory
+#are listed (as is 'run context' if the import loaded the run config), since importing a module should neither load
+#them nor touch the file system.
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+DEFAULT_MODULES = ["SSutility", "SSutility.SSfasta", "SSutility.SSerrors", "SSacquisition.ODBquery",
+                   "SSacquisition.NCBIquery", "SSacquisition.aliasQuery", "SSacquisition.SSorchestrator",
+                   "SSfilter.ODBfilter", "SSfilter.NCBIfilter", "SSanalysis", "SSanalysis.SSanalysiscalc",
+                   "SSanalysis.SSvisualization", "spec_subs_main"]
+HEAVY_MODULES = ["IPython", "matplotlib", "selenium", "Bio.Phylo"]
+
+IMPORT_SNIPPET = """
+import os, sys, json, time, resource, importlib
+sys.path.insert(0, os.getcwd())
+before = set(os.listdir('.'))
+start = time.perf_counter()
+if {module!r}:
+    importlib.import_module({module!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'heavy': [name for name in {heavy!r} if name in sys.modules] +
+                           (['run context'] if getattr(sys.modules.get('SSutility'), '_run_context', None) else []),
+                  'created': sorted(set(os.listdir('.')) - before)}}))
+"""
+
+
+def measure(module):
+    """Imports module in a new interpreter; returns the measurement dict printed by IMPORT_SNIPPET."""
+    snippet = IMPORT_SNIPPET.format(module=module, heavy=HEAVY_MODULES)
+    proc = subprocess.run([sys.executable, "-c", snippet], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                          check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modules", nargs="+", default=DEFAULT_MODULES)
+    parser.add_argument("--repeat", type=int, default=3, help="interpreters per module (median time is reported)")
+    args = parser.parse_args()
+
+    baseline_kb = max(measure("")['max_rss_kb'] for i in range(args.repeat))
+    print("{0:<32}{1:>12}{2:>14}  {3}".format("module", "import (ms)", "peak RSS (MB)", "heavy imports/ created files"))
+    for module in args.modules:
+        try:
+            runs = [measure(module) for i in range(args.repeat)]
+        except subprocess.CalledProcessError as e:
+            print("{0:<32}{1:>12}  {2}".format(module, "failed", e.stderr.strip().splitlines()[-1]))
+            continue
+        import_ms = np.median([run['seconds'] for run in runs]) * 1000
+        rss_mb = (max(run['max_rss_kb'] for run in runs) - baseline_kb) / 1024
+        notes = sorted(set(name for run in runs for name in run['heavy'])) + \
+                ["created " + fname for fname in sorted(set(fname for run in runs for fname in run['created']))]
+        print("{0:<32}{1:>12.1f}{2:>14.1f}  {3}".format(module, import_ms, rss_mb, ", ".join(notes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#mockServer.py - Local stand-in for the OrthoDB, NCBI Entrez and GeneCards web services, replaying test_data fixtures
+#with configurable latency, rate limiting and error injection. Used by acquisition tests and benchAcquisition.py.
+# Copyright (C) 2020  Evan Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import random
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import xml.etree.ElementTree as ET
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+#Query symbols/ IDs may carry a replicate suffix (ie ATP5MC1__12) so benchmarks can request many distinct genes
+#which are all answered from the same fixture
+REPLICATE_SEP = "__"
+
+
+def fixture_name(query):
+    return query.split(REPLICATE_SEP)[0]
+
+
+class MockServerState:
+    """Configuration and counters shared by all request handler threads.
+
+    :param (float) latency: Seconds added before every response
+    :param (float) jitter: Additional uniformly distributed latency in [0, jitter] seconds
+    :param (float) rate_limit: If set, requests per second allowed (per path prefix service); excess requests are
+    answered 429 with a Retry-After header, as Entrez and OrthoDB do
+    :param (float) error_rate: Fraction of requests answered with error_status
+    :param (int) error_status: HTTP status used for injected errors
+    :param seed: Random seed for jitter/ error injection
+    :param too_many_clusters: OrthoDB query symbols answered with the HTML page OrthoDB returns for searches yielding
+    too many clusters
+    """
+
+    def __init__(self, latency=0, jitter=0, rate_limit=None, error_rate=0, error_status=503, seed=0,
+                 too_many_clusters=()):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.too_many_clusters = set(too_many_clusters)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.service_times = []
+        self._windows = {}
+        self._webenvs = {}
+        self._load_entrez_fixtures()
+
+    def _load_entrez_fixtures(self):
+        entrez_dir = os.path.join(TEST_DATA_DIR, "NCBI", "entrez")
+        root = ET.parse(os.path.join(entrez_dir, "elink_gene_protein.xml")).getroot()
+        self.linksets = {}
+        for linkset in root.findall("LinkSet"):
+            gid = linkset.find("IdList/Id").text
+            self.linksets[gid] = linkset
+        root = ET.parse(os.path.join(entrez_dir, "efetch_protein_tseq.xml")).getroot()
+        self.tseqs = dict((tseq.findtext("TSeq_gi"), tseq) for tseq in root.findall("TSeq"))
+
+    def rate_limited(self, service):
+        #Fixed one second windows per service
+        if self.rate_limit is None:
+            return False
+        now = int(time.monotonic())
+        with self.lock:
+            window, count = self._windows.get(service, (now, 0))
+            if window != now:
+                window, count = now, 0
+            self._windows[service] = (window, count + 1)
+            return count + 1 > self.rate_limit
+
+    def inject_error(self):
+        with self.lock:
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def delay(self):
+        with self.lock:
+            extra = self.random.uniform(0, self.jitter) if self.jitter else 0
+        return self.latency + extra
+
+    def record(self, path, status, service_time):
+        with self.lock:
+            self.requests[path] += 1
+            self.statuses[status] += 1
+            self.service_times.append(service_time)
+
+    def new_webenv(self, ids):
+        with self.lock:
+            web_env = "MCID_mock_{0}".format(len(self._webenvs))
+            self._webenvs[web_env] = ids
+        return web_env
+
+    def webenv_ids(self, web_env):
+        with self.lock:
+            return self._webenvs.get(web_env, [])
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        split = urlsplit(self.path)
+        self.handle_request(split.path, parse_qs(split.query, keep_blank_values=True))
+
+    def do_POST(self):
+        split = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        params = parse_qs(split.query, keep_blank_values=True)
+        for key, values in parse_qs(body, keep_blank_values=True).items():
+            params.setdefault(key, []).extend(values)
+        self.handle_request(split.path, params)
+
+    def handle_request(self, path, params):
+        state = self.server.state
+        start = time.monotonic()
+        service = path.strip("/").split("/")[0]
+        delay = state.delay()
+        if delay:
+            time.sleep(delay)
+        if state.rate_limited(service):
+            status, content_type, body = 429, "text/plain", b"Too Many Requests"
+        elif state.inject_error():
+            status, content_type, body = state.error_status, "text/plain", b"Injected error"
+        else:
+            status, content_type, body = self.route(path, params)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+        state.record(path, status, time.monotonic() - start)
+
+    def route(self, path, params):
+        if path in ("/fasta", "/tab"):
+            return self.orthodb(path, params)
+        if path.startswith("/entrez/eutils/"):
+            return self.entrez(path.split("/")[-1], params)
+        if path == "/cgi-bin/carddisp.pl":
+            return self.genecards_file("{0}_card.html".format(fixture_name(params.get('gene', [''])[0])))
+        if path == "/Search/Keyword":
+            return self.genecards_file("{0}_search.html".format(fixture_name(params.get('queryString', [''])[0])))
+        return 404, "text/plain", b"Not Found"
+
+    def orthodb(self, path, params):
+        symbol = fixture_name(params.get('query', [''])[0])
+        ext = ".fasta" if path == "/fasta" else ".tsv"
+        fpath = os.path.join(TEST_DATA_DIR, "ODB", symbol + ext)
+        if symbol in self.server.state.too_many_clusters:
+            return 200, "text/html", b"<html><body>Too many clusters</body></html>"
+        if not symbol or not os.path.exists(fpath):
+            #OrthoDB answers queries without results with a JSON body
+            return 200, "application/json", b'{"count":0,"data":[]}'
+        with open(fpath, 'rb') as f:
+            body = f.read()
+        species = [tax_id for value in params.get('species', []) for tax_id in value.split(',') if tax_id]
+        if species:
+            body = self.filter_species(body, ext, set(species))
+            if not body:
+                return 200, "application/json", b'{"count":0,"data":[]}'
+        return 200, "text/plain", body
+
+    def filter_species(self, body, ext, species):
+        #Restricts fixture records to species tax ids, as the species= API parameter does
+        lines = body.decode('utf-8').splitlines(keepends=True)
+        if ext == ".tsv":
+            organism_col = lines[0].rstrip('\n').split('\t').index('organism_taxid')
+            rows = [line for line in lines[1:] if line.split('\t')[organism_col].split('_')[0] in species]
+            return (lines[0] + "".join(rows)).encode('utf-8') if rows else b""
+        kept, keep = [], False
+        for line in lines:
+            if line.startswith('>'):
+                keep = line[1:].split('_')[0] in species
+            if keep:
+                kept.append(line)
+        return "".join(kept).encode('utf-8')
+
+    def entrez(self, endpoint, params):
+        state = self.server.state
+        if endpoint == "elink.fcgi":
+            result = ET.Element("eLinkResult")
+            gids = [gid for value in params.get('id', []) for gid in value.split(',')]
+            fixture_gids = sorted(state.linksets.keys())
+            for gid in gids:
+                fixture_gid = fixture_name(gid)
+                if fixture_gid not in state.linksets:
+                    #Unknown gene IDs link to the fixture proteins of one of the fixture genes
+                    fixture_gid = fixture_gids[sum(map(ord, gid)) % len(fixture_gids)]
+                linkset = ET.fromstring(ET.tostring(state.linksets[fixture_gid]))
+                linkset.find("IdList/Id").text = gid
+                result.append(linkset)
+            return 200, "text/xml", ET.tostring(result, encoding="UTF-8")
+        if endpoint == "epost.fcgi":
+            ids = [uid for value in params.get('id', []) for uid in value.split(',')]
+            result = ET.Element("ePostResult")
+            ET.SubElement(result, "QueryKey").text = "1"
+            ET.SubElement(result, "WebEnv").text = state.new_webenv(ids)
+            return 200, "text/xml", ET.tostring(result, encoding="UTF-8")
+        if endpoint == "efetch.fcgi":
+            if 'WebEnv' in params:
+                ids = state.webenv_ids(params['WebEnv'][0])
+                retstart = int(params.get('retstart', ['0'])[0])
+                retmax = int(params.get('retmax', [str(len(ids))])[0])
+                ids = ids[retstart:retstart+retmax]
+            else:
+                ids = [uid for value in params.get('id', []) for uid in value.split(',')]
+            result = ET.Element("TSeqSet")
+            for uid in ids:
+                if uid in state.tseqs:
+                    result.append(state.tseqs[uid])
+            return 200, "text/xml", ET.tostring(result, encoding="UTF-8")
+        return 400, "text/plain", b"Unknown Entrez endpoint"
+
+    def genecards_file(self, fname):
+        fpath = os.path.join(TEST_DATA_DIR, "GeneCards", fname)
+        if not os.path.exists(fpath):
+            fpath = os.path.join(TEST_DATA_DIR, "GeneCards", "empty_card.html")
+        with open(fpath, 'rb') as f:
+            return 200, "text/html", f.read()
+
+
+class MockAcquisitionServer:
+    """Threaded HTTP server on localhost serving OrthoDB (/fasta, /tab), Entrez (/entrez/eutils/*.fcgi) and GeneCards
+    (/cgi-bin/carddisp.pl, /Search/Keyword) requests from tests/test_data fixtures. Use as a context manager together
+    with mock_base_urls to point the acquisition modules at it. Keyword arguments configure MockServerState."""
+
+    def __init__(self, **state_kwargs):
+        self.state = MockServerState(**state_kwargs)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), MockRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self.url = "http://127.0.0.1:{0}".format(self.httpd.server_address[1])
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+@contextmanager
+def mock_base_urls(server):
+    """Temporarily points ODBquery, NCBIquery and aliasQuery base URL constants at server."""
+    from SSacquisition import ODBquery, NCBIquery, aliasQuery
+    saved = (ODBquery.ODB_BASE_URL, NCBIquery.ENTREZ_BASE_URL, aliasQuery.GC_CARD_URL, aliasQuery.GC_SEARCH_URL)
+    ODBquery.ODB_BASE_URL = server.url
+    NCBIquery.ENTREZ_BASE_URL = server.url + "/entrez/eutils/"
+    aliasQuery.GC_CARD_URL = server.url + "/cgi-bin/carddisp.pl"
+    aliasQuery.GC_SEARCH_URL = server.url + "/Search/Keyword"
+    try:
+        yield server
+    finally:
+        ODBquery.ODB_BASE_URL, NCBIquery.ENTREZ_BASE_URL, aliasQuery.GC_CARD_URL, aliasQuery.GC_SEARCH_URL = saved
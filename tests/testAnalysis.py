@@ -181,6 +181,8 @@ class testCalculations(unittest.TestCase):
 
     def test_gene_summary_df(self):
         from SSanalysis import SSanalysiscalc as ac
+        from SSutility import SSdirectory
+        SSdirectory.create_directory("tests/tmp")
         test_outpath = "tests/tmp/ATP5MC1_summary.tsv"
         summary_table = ac.gene_summary_table(align_df,ncbi_idx,test_idx,blos_df,
                                               summary_table_outpath=test_outpath)
@@ -204,6 +206,29 @@ class testCalculations(unittest.TestCase):
         self.assertAlmostEqual(0,gp_43_jsd)
         self.assertNotAlmostEqual(gp_43_jsd,non_gp_43_jsd)
 
+    def test_alignment(self):
+        from SSutility.SSalignment import Alignment
+        from SSanalysis import SSanalysiscalc as ac
+        alignment = Alignment.from_fasta(test_msa)
+        self.assertEqual(alignment.data.dtype, np.uint8)
+        self.assertEqual(alignment.shape, align_df.shape)
+        pd.testing.assert_frame_equal(alignment.to_df(), align_df)
+        pd.testing.assert_frame_equal(Alignment.from_df(align_df).to_df(), align_df)
+        pd.testing.assert_series_equal(alignment.to_srs(), SSfasta.fasta_to_srs(test_msa), check_names=False)
+        self.assertEqual(alignment.gap_mask().sum(), (align_df == '-').values.sum())
+        odb_aln = alignment.drop(ncbi_idx)
+        self.assertEqual(list(odb_aln.index), list(ODB_df.index))
+        self.assertEqual(chr(alignment.rows(test_idx).column(33)[0]), 'L')
+        window = alignment.window(31, 33)
+        self.assertEqual(list(window.columns), [31, 32, 33])
+        self.assertTrue(np.shares_memory(window.data, alignment.data))
+        #Analysis functions give the same results for Alignment and DataFrame inputs
+        pd.testing.assert_frame_equal(ac.find_uniques(odb_aln, 1, test_idx), ac.find_uniques(ODB_df, 1, test_idx))
+        blos_srs, blos_z = ac.test_outgroup_blosum_series(odb_aln, test_idx, blos_df)
+        for pos in [31, 33, 40, 75]:
+            self.assertAlmostEqual(blos_srs[pos], ac.test_outgroup_blosum(ODB_df.loc[:, pos], test_idx, blos_df))
+        self.assertTrue(np.isnan(blos_srs[43]))
+
     def test_overall_summary(self):
         from SSanalysis import SSanalysiscalc as ac
         from SSutility import config
@@ -254,5 +279,22 @@ class testCalculations(unittest.TestCase):
             if os.path.exists(path):
                 os.rename(path, test_outpaths[i])
 
+    def test_lazy_imports(self):
+        import json
+        import subprocess
+        #Fresh interpreter: importing the pipeline modules reads no config and loads neither IPython nor BLOSUM data
+        check = "import sys, json; import SSutility, SSanalysis.SSanalysiscalc as ac, SSfilter.NCBIfilter; " \
+                "print(json.dumps([SSutility._run_context is None, 'IPython' in sys.modules, " \
+                "ac.blosum_data.cache_info().currsize]))"
+        proc = subprocess.run([sys.executable, "-c", check], stdout=subprocess.PIPE, text=True, check=True,
+                              env=dict(os.environ, PYTHONPATH=os.getcwd()))
+        self.assertEqual(json.loads(proc.stdout), [True, False, 0])
+        #BLOSUM globals are loaded on access and shared with SSanalysiscalc; other names are not lazy attributes
+        import SSutility
+        from SSanalysis import SSanalysiscalc as ac
+        self.assertTrue(blos_df is ac.blosum_data()[2])
+        with self.assertRaises(AttributeError):
+            SSutility.not_a_run_attr
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -29,9 +29,18 @@ from SSfilter import ODBfilter
 
 test_temp_dir = "tests/tmp"
 
+
+def _write_test_errors(args):
+    #Writes errors from a separate process (see test_concurrent_writers)
+    errors_fpath, worker = args
+    for i in range(25):
+        SSerrors.write_errors(errors_fpath, "GENE{0}".format(i), SSerrors.NCBIQueryError(worker, "worker {0}".format(worker)))
+    SSerrors.write_errors(errors_fpath, "SHARED", SSerrors.NCBIQueryError(0, "shared message"))
+
 class SSErrorsTest(unittest.TestCase):
 
     def setUp(self):
+        SSdirectory.create_directory(test_temp_dir)
         SSdirectory.empty_directory(test_temp_dir)
 
     def test_write_errors(self):
@@ -106,6 +115,42 @@ class SSErrorsTest(unittest.TestCase):
         self.assertTrue(len(test_qc) == 2)
 
 
+    def test_error_registry(self):
+        test_efpath = "{0}/test_registry.tsv".format(test_temp_dir)
+        first = SSerrors.ErrorRegistry(test_efpath)
+        second = SSerrors.ErrorRegistry(test_efpath)
+        self.assertTrue(first.add(["CD151", "NCBIQueryError", 0, "test_message"]))
+        #Rows appended by another writer are picked up by tail reads; exact messages are deduplicated
+        self.assertFalse(second.add(["CD151", "NCBIQueryError", 0, "test_message"]))
+        self.assertTrue(second.add(["CD151", "GeneCardsError", 1, "test_message2"]))
+        first.refresh()
+        self.assertTrue(first.has("CD151", error_type="GeneCardsError"))
+        self.assertFalse(first.has("CD151", error_type="SequenceDataError"))
+        self.assertFalse(first.has("CALM1"))
+        #Pending rows of a batch are indexed but only written when the batch exits
+        with first.batch():
+            first.add(["CALM1", "NCBIQueryError", 0, "batched message"])
+            self.assertTrue(first.has("CALM1"))
+            self.assertEqual(len(pd.read_csv(test_efpath, sep='\t', index_col=0)), 2)
+        errors_df = pd.read_csv(test_efpath, sep='\t', index_col=0)
+        self.assertEqual(list(errors_df.index), [0, 1, 2])
+        self.assertEqual(list(errors_df.columns), SSerrors.ERROR_COLUMNS)
+        self.assertTrue(first.frame().equals(errors_df.reset_index(drop=True)))
+        #Replaced log is re-read from the start
+        errors_df.iloc[:1].to_csv(test_efpath, sep='\t')
+        second.refresh()
+        self.assertEqual(len(second.frame()), 1)
+
+    def test_concurrent_writers(self):
+        import multiprocessing
+        test_efpath = "{0}/test_concurrent_errors.tsv".format(test_temp_dir)
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            pool.map(_write_test_errors, [(test_efpath, worker) for worker in range(4)])
+        errors_df = pd.read_csv(test_efpath, sep='\t', index_col=0)
+        self.assertEqual(len(errors_df), 101)
+        self.assertEqual(list(errors_df.index), list(range(101)))
+        self.assertEqual(len(errors_df.loc[errors_df['gene_symbol'] == "SHARED", :]), 1)
+
     def test_load_errors(self):
         #Checks file path for
         from SSutility import config
@@ -21,8 +21,9 @@ import sys
 sys.path.append(os.getcwd())
 
 import pandas as pd
+import numpy as np
 import unittest
-from SSutility import SSfasta, SSconfig
+from SSutility import SSfasta, SSconfig, SSdirectory
 from IPython.display import display
 import warnings
 import subprocess
@@ -31,6 +32,11 @@ from SSfilter import ODBfilter, NCBIfilter
 test_data_dir = "tests/test_data"
 test_tmp_dir = "tests/tmp"
 
+
+def setUpModule():
+    #tests/tmp is not tracked; test outputs are written there
+    SSdirectory.create_directory(test_tmp_dir)
+
  
 
 class SSfastaTest(unittest.TestCase):
@@ -70,6 +76,97 @@ class SSfastaTest(unittest.TestCase):
         for i,fasta in enumerate(ordered):
             self.assertTrue(fasta.id == ordered_test_ids[i])
 
+    def test_mapped_reader(self):
+        from Bio import SeqIO
+        from SSutility.SSfastareader import mapped_fasta, read_fasta, seq_str
+        reader_fpath = "{0}/reader_test.fasta".format(test_tmp_dir)
+        with open(reader_fpath, 'wb') as reader_f:
+            reader_f.write(b"preamble line\n>single first record\nMKVLA\n>wrapped\r\nMKV\r\nLA \r\n\n>empty\n>last x\nMM")
+        with mapped_fasta(reader_fpath) as buffer:
+            records = [(record_id, description, seq) for record_id, description, seq in read_fasta(buffer)]
+            #Single line sequences are slices of the map, wrapped sequences joined
+            self.assertIsInstance(records[0][2], memoryview)
+            self.assertIsInstance(records[1][2], bytes)
+            parsed = [(record_id, description, seq_str(seq)) for record_id, description, seq in records]
+            del records
+        expected = [(record.id, record.description, str(record.seq))
+                    for record in SeqIO.parse(reader_fpath, 'fasta')]
+        self.assertEqual(parsed, expected)
+        #Compressed fastas are streamed record by record rather than mapped
+        import gzip
+        from SSutility.SSfastareader import fasta_records
+        gz_fpath = "{0}/reader_test_gz.fasta".format(test_tmp_dir)
+        with open(reader_fpath, 'rb') as reader_f, gzip.open(gz_fpath, 'wb') as gz_f:
+            gz_f.write(reader_f.read())
+        with self.assertRaises(ValueError):
+            with mapped_fasta(gz_fpath) as buffer:
+                pass
+        self.assertEqual([(record_id, description, seq_str(seq)) for record_id, description, seq in
+                          fasta_records(gz_fpath)], expected)
+        self.assertEqual([record[0] for record in fasta_records(gz_fpath, ids={"wrapped", "last"})],
+                         ["wrapped", "last"])
+        ncbi_fpath = "{0}/NCBI/9999/ATP5MC1.fasta".format(test_data_dir)
+        seqs, lengths = SSfasta.length_srs(ncbi_fpath)
+        for record in SeqIO.parse(ncbi_fpath, 'fasta'):
+            self.assertEqual((seqs[record.id], lengths[record.id]), (str(record.seq), len(record.seq)))
+
+    def test_fasta_index(self):
+        import gzip
+        import shutil
+        from Bio import SeqIO
+        from SSutility import SSfastaindex
+        index_dir = "{0}/fasta_index".format(test_tmp_dir)
+        SSdirectory.create_directory(index_dir)
+        fasta_fpath = "{0}/ATP5MC1.fasta".format(index_dir)
+        shutil.copyfile("{0}/ODB/ATP5MC1.fasta".format(test_data_dir), fasta_fpath)
+        expected = list(SeqIO.parse(fasta_fpath, 'fasta'))
+        index = SSfastaindex.fasta_index(fasta_fpath)
+        self.assertTrue(os.path.exists(SSfastaindex.index_path(fasta_fpath)))
+        self.assertEqual(index.ids, [record.id for record in expected])
+        for record, expected_record in zip(index.records(), expected):
+            self.assertEqual((record.id, record.description, str(record.seq)),
+                             (expected_record.id, expected_record.description, str(expected_record.seq)))
+            self.assertEqual(index.length(record.id), len(expected_record.seq))
+        #Random access in any order; sidecar reused by a fresh load
+        reversed_ids = [record.id for record in expected[::-1]]
+        reloaded = SSfastaindex.FastaIndex.read(fasta_fpath)
+        self.assertEqual([record.id for record in reloaded.records(reversed_ids + ["missing"])], reversed_ids)
+        #Changed fasta: stale sidecar is rebuilt
+        with open(fasta_fpath, 'at') as fasta_f:
+            fasta_f.write(">added_record extra\nMKV\nLL\n")
+        self.assertIsNone(SSfastaindex.FastaIndex.read(fasta_fpath))
+        added = list(SSfastaindex.fasta_index(fasta_fpath).records(["added_record"]))
+        self.assertEqual(str(added[0].seq), "MKVLL")
+        self.assertEqual(SSfastaindex.fasta_index(fasta_fpath).length("added_record"), 5)
+        #Compressed fasta offsets refer to decompressed content
+        gz_fpath = "{0}/ATP5MC1_gz.fasta".format(index_dir)
+        with open(fasta_fpath, 'rb') as fasta_f, gzip.open(gz_fpath, 'wb') as gz_f:
+            gz_f.write(fasta_f.read())
+        gz_records = list(SSfasta.ordered_record_generator(gz_fpath, reversed_ids[:3]))
+        self.assertEqual([str(record.seq) for record in gz_records],
+                         [str(record.seq) for record in expected[::-1][:3]])
+
+    def test_identity_distances(self):
+        from Bio import AlignIO
+        from Bio.Phylo.TreeConstruction import DistanceCalculator
+        from SSutility.SSalignment import Alignment
+        from SSutility import SSdistance
+        msa_fpath = "{0}/output/ATP5MC1/ATP5MC1_msa.fasta".format(test_data_dir)
+        alignment = Alignment.from_fasta(msa_fpath)
+        id_dm = SSdistance.identity_distance_matrix(alignment)
+        bio_dm = DistanceCalculator('identity').get_distance(AlignIO.read(msa_fpath, 'fasta'))
+        self.assertEqual(list(alignment.index), bio_dm.names)
+        self.assertTrue(np.allclose(id_dm, np.array([row for row in bio_dm])))
+        #Gap-gap positions count as identical, as in Bio's identity model
+        small = Alignment.from_srs(pd.Series(data=["AC-D", "AC-E", "A--E"], index=["a", "b", "c"]))
+        small_dm = SSdistance.identity_distance_matrix(small)
+        self.assertTrue(np.allclose(small_dm, [[0, 0.25, 0.5], [0.25, 0, 0.25], [0.5, 0.25, 0]]))
+        self.assertTrue(np.allclose(SSdistance.condensed(small_dm), [0.25, 0.5, 0.25]))
+        self.assertTrue(np.allclose(SSdistance.sub_distance_matrix(small_dm, small.index, ["c", "a"]),
+                                    [[0, 0.5], [0.5, 0]]))
+        with self.assertRaises(KeyError):
+            SSdistance.sub_distance_matrix(small_dm, small.index, ["missing"])
+
 
 class ODBFilterFunctionTest(unittest.TestCase):
     def test_alias_loading(self):
@@ -161,6 +258,49 @@ class ODBFilterFunctionTest(unittest.TestCase):
         with open(test_outpath,'r') as test_out_read:
             self.assertTrue(len(test_out_read.readlines()) > 0)
 
+    def test_kalign_pipe(self):
+        from SSutility.SSalignment import Alignment
+        from SSutility.SSaligner import Aligner
+        test_inpath = "{0}/ODB/ATP5MC1.fasta".format(test_data_dir)
+        file_outpath = "{0}/test_file_aln.fasta".format(test_tmp_dir)
+        with open(test_inpath,'r') as test_in, open(file_outpath,'wt',encoding='utf-8') as test_out:
+            subprocess.run(args=["kalign"],stdin=test_in,stdout=test_out,stderr=subprocess.DEVNULL,text=True)
+        #Records streamed through kalign's stdin/ stdout align the same as the file based invocation
+        records = SSfasta.filtered_generator_wrapper(SSfasta.fasta_to_srs(test_inpath).index,test_inpath,ordered=False)
+        alignment = Aligner('kalign').align(records)
+        self.assertTrue(alignment.to_df().equals(Alignment.from_fasta(file_outpath).to_df()))
+        #MSA only written if an output path is requested
+        record_df = pd.DataFrame(index=["10090_0:0034c4","43179_0:00103c","9606_0:00415a"])
+        pipe_outpath = "{0}/test_pipe_aln.fasta".format(test_tmp_dir)
+        id_dm, align_srs = SSfasta.construct_id_dm(record_df,test_inpath,align_outpath=pipe_outpath,ordered=True)
+        self.assertEqual(id_dm.shape,(3,3))
+        self.assertTrue(align_srs.equals(SSfasta.fasta_to_srs(pipe_outpath)))
+
+    def test_alignment_cache(self):
+        from SSutility.SScache import ContentCache
+        from SSutility.SSaligner import Aligner
+        test_inpath = "{0}/ODB/ATP5MC1.fasta".format(test_data_dir)
+        cache = ContentCache("{0}/msa_cache".format(test_tmp_dir))
+        cache.clear()
+        record_df = pd.DataFrame(index=["10090_0:0034c4","43179_0:00103c","9606_0:00415a"])
+        aligner = Aligner('kalign', cache=cache)
+        run_inputs = []
+        run = aligner.run
+        aligner.run = lambda fasta_bytes, silent=True: run_inputs.append(fasta_bytes) or run(fasta_bytes, silent)
+        id_dm, align_srs = SSfasta.construct_id_dm(record_df,test_inpath,ordered=True,aligner=aligner)
+        self.assertTrue(cache.total_bytes() > 0)
+        #Identical record sets are served from the cache without running the aligner, also by a new Aligner object
+        cached_aligner = Aligner('kalign', cache=cache)
+        cached_aligner.run = aligner.run
+        cached_dm, cached_srs = SSfasta.construct_id_dm(record_df,test_inpath,ordered=True,aligner=cached_aligner)
+        self.assertEqual(len(run_inputs),1)
+        self.assertTrue(np.array_equal(id_dm,cached_dm) and align_srs.equals(cached_srs))
+        #Different record order or aligner settings are separate entries
+        SSfasta.construct_id_dm(record_df.iloc[::-1],test_inpath,ordered=True,aligner=aligner)
+        self.assertEqual(len(run_inputs),2)
+        self.assertNotEqual(aligner.cache_key(run_inputs[0]),Aligner('kalign',args=['-gpo','10']).cache_key(run_inputs[0]))
+        with self.assertRaises(ValueError):
+            Aligner('not_an_aligner')
 
     def test_exact_match_df(self):
         from SSfilter.ODBfilter import exact_match_df
@@ -332,6 +472,176 @@ class NCBIFilterFunctionTest(unittest.TestCase):
         self.assertTrue(comb_proc.loc['9601_0:003546', 'selection_type'] == "symbol match single record")
 
 
+class AliasStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        from SSutility.SSaliases import AliasStore
+        self.db_fpath = "{0}/aliases_test.sqlite".format(test_tmp_dir)
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.db_fpath + suffix):
+                os.remove(self.db_fpath + suffix)
+        self.hgnc_fpath = "{0}/HGNC/hgnc_complete_set.txt".format(test_data_dir)
+        self.store = AliasStore(self.db_fpath)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_HGNC_import(self):
+        self.assertEqual(self.store.import_HGNC(self.hgnc_fpath), 5)
+        #Unchanged file is not re-imported
+        self.assertEqual(self.store.import_HGNC(self.hgnc_fpath), 0)
+        aliases = self.store.aliases("ATP5MC1")
+        self.assertEqual(aliases[0], "ATP5MC1")
+        self.assertTrue("ATP5G1" in aliases)
+        self.assertEqual(self.store.symbols_for_alias("atp5g1"), ["ATP5MC1"])
+        #Previous symbols resolve to the approved symbol's aliases
+        alias_dict = self.store.batch_aliases(["ISPD", "ATPIF1", "CALM1", "NOTAGENE"])
+        self.assertEqual(alias_dict["ISPD"][0], "CRPPA")
+        self.assertEqual(alias_dict["ATPIF1"][0], "ATP5IF1")
+        self.assertFalse("NOTAGENE" in alias_dict)
+        self.assertIsNone(self.store.aliases("A12M1~withdrawn"))
+
+    def test_alias_files(self):
+        aliases_dir = "{0}/alias_files".format(test_tmp_dir)
+        SSdirectory.create_directory(aliases_dir)
+        with open("{0}/ISPD_aliases.txt".format(aliases_dir), 'wt') as aliases_f:
+            aliases_f.write("CRPPA\nISPD\nNip\n")
+        self.assertEqual(self.store.import_alias_files(aliases_dir, ["ISPD"]), 1)
+        self.assertEqual(self.store.import_alias_files(aliases_dir, ["ISPD"]), 0)
+        self.assertEqual(self.store.aliases("ISPD"), ["CRPPA", "ISPD", "Nip"])
+        self.store.put_aliases("ISPD", ["CRPPA", "ISPD"])
+        self.assertEqual(self.store.aliases("ISPD"), ["CRPPA", "ISPD"])
+        self.assertEqual(self.store.stored_symbols(["ISPD", "CALM1"]), {"ISPD"})
+
+    def test_batch_alias_matches(self):
+        config = SSconfig.parse_config("config/config.txt")
+        config['ALIASES']['AliasDBPath'] = self.db_fpath
+        config['ALIASES']['HGNCFilePath'] = self.hgnc_fpath
+        alias_dict = ODBfilter.load_alias_dict(config, ["ATP5MC1", "ISPD", "NOTAGENE"])
+        self.assertEqual(alias_dict["NOTAGENE"], [])
+        errors_fpath = "{0}/errors.tsv".format(test_tmp_dir)
+        test_tsv = pd.read_csv("{0}/ODB/ISPD.tsv".format(test_data_dir),sep='\t',index_col='int_prot_id')
+        am_ids, exact_matches = ODBfilter.find_alias_matches("ISPD",test_tsv,errors_fpath,aliases=alias_dict["ISPD"])
+        self.assertEqual(exact_matches, ["ISPD", "CRPPA"])
+        self.assertTrue(len(am_ids) > 0)
+        symbol_ids, symbol_matches = ODBfilter.find_alias_matches("ISPD",test_tsv,errors_fpath,aliases=[])
+        self.assertEqual(symbol_matches, ["ISPD"])
+        self.assertTrue(set(symbol_ids) <= set(am_ids))
+
+class TaxonomyCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        from SSutility.SStaxonomy import catalog_cache_path
+        self.table_fpath = "{0}/odb_species_test.tab".format(test_tmp_dir)
+        with open("config/odb10v0_species.tab") as src_f, open(self.table_fpath, 'wt') as table_f:
+            table_f.writelines(line for line in src_f if line.split('\t')[0] in ("9606", "10090", "43179", "210"))
+        self.cache_fpath = catalog_cache_path(self.table_fpath)
+        if os.path.exists(self.cache_fpath):
+            os.remove(self.cache_fpath)
+
+    def test_lookups(self):
+        from SSutility.SStaxonomy import TaxonomyCatalog
+        catalog = TaxonomyCatalog.from_table(self.table_fpath)
+        self.assertEqual(catalog.tax_id("Mus musculus"), 10090)
+        self.assertEqual(catalog.spec_name("43179_0"), "Ictidomys tridecemlineatus")
+        self.assertEqual(catalog.lookup_odb_id("9606_0")['assembly_id'], "GCF_000001405.x")
+        self.assertTrue(len(catalog.lookup_tax_id(210)) > 1)
+        self.assertEqual(catalog.lookup_name("Not a species"), [])
+        self.assertEqual(catalog.resolve_tax_subset(["9606_0", "10090", "unknown_0"]),
+                         ["9606_0", "10090_0", "unknown_0"])
+        #Same records, index and order as the original odb_tablev10 filtering
+        table = SSconfig.odb_tablev10(["Mus musculus", "Homo sapiens"])
+        self.assertEqual(list(table['odb_id']), ["9606_0", "10090_0"])
+        self.assertEqual(list(table.columns), ['tax_id', 'odb_id', 'spec_name', 'assembly_id'])
+        raw_table = pd.read_csv("config/odb10v0_species.tab", sep='\t', header=None)
+        self.assertEqual(raw_table.loc[table.index, 1].tolist(), ["9606_0", "10090_0"])
+
+    def test_catalog_cache(self):
+        import time
+        from SSutility import SStaxonomy
+        catalog = SStaxonomy.load_catalog(self.table_fpath)
+        self.assertTrue(os.path.exists(self.cache_fpath))
+        #Touched but unchanged table: cache reused after a checksum comparison
+        cache_mtime = os.path.getmtime(self.cache_fpath)
+        os.utime(self.table_fpath, (time.time(), time.time() + 10))
+        self.assertEqual(len(SStaxonomy.load_catalog(self.table_fpath).rows), len(catalog.rows))
+        self.assertEqual(SStaxonomy.load_catalog(self.table_fpath).rows, catalog.rows)
+        self.assertGreaterEqual(os.path.getmtime(self.cache_fpath), cache_mtime)
+        #Changed table: catalog rebuilt
+        with open(self.table_fpath, 'at') as table_f:
+            table_f.write("99999\t99999_0\tTestus speciesus\t\t10\t10\tC\n")
+        self.assertEqual(SStaxonomy.load_catalog(self.table_fpath).tax_id("Testus speciesus"), 99999)
+
+
+class BuildLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        self.run_name = "{0}/build_run".format(test_tmp_dir)
+        SSdirectory.create_directory(self.run_name)
+        SSdirectory.empty_directory(self.run_name)
+        SSdirectory.create_directory("{0}/input/ODB".format(self.run_name))
+        SSdirectory.create_directory("{0}/output/ATP5MC1".format(self.run_name))
+        for ext in ["fasta", "tsv"]:
+            shutil.copy("{0}/ODB/ATP5MC1.{1}".format(test_data_dir, ext), "{0}/input/ODB".format(self.run_name))
+        self.config = SSconfig.parse_config("config/config.txt")
+        self.config['RUN']['RunName'] = self.run_name
+        self.tax_subset = ["10090_0", "43179_0", "9606_0"]
+
+    def test_filter_stamps(self):
+        import gzip
+        import shutil
+        from SSutility import SSbuild
+        from SSutility.SSbuild import BuildLedger
+        inputs = SSbuild.filter_inputs(self.config, "ATP5MC1", self.tax_subset, aliases=["ATP5MC1"])
+        #Subset species without ATP5MC1 records don't change its stamp; species with records do
+        unrelated = SSbuild.filter_inputs(self.config, "ATP5MC1", self.tax_subset + ["99999_0"], aliases=["ATP5MC1"])
+        self.assertEqual(BuildLedger.stamp('filter', inputs), BuildLedger.stamp('filter', unrelated))
+        related = SSbuild.filter_inputs(self.config, "ATP5MC1", self.tax_subset + ["9913_0"], aliases=["ATP5MC1"])
+        self.assertNotEqual(BuildLedger.stamp('filter', inputs), BuildLedger.stamp('filter', related))
+        #Compressed inputs digest as their content; aligner settings are filter inputs
+        odb_fasta = "{0}/input/ODB/ATP5MC1.fasta".format(self.run_name)
+        with open("{0}/ODB/ATP5MC1.fasta".format(test_data_dir), 'rb') as src_f, gzip.open(odb_fasta, 'wb') as gz_f:
+            shutil.copyfileobj(src_f, gz_f)
+        self.assertEqual(SSbuild.filter_inputs(self.config, "ATP5MC1", self.tax_subset, aliases=["ATP5MC1"]), inputs)
+        self.config['ALIGNMENT']['Aligner'] = "mafft"
+        mafft_inputs = SSbuild.filter_inputs(self.config, "ATP5MC1", self.tax_subset, aliases=["ATP5MC1"])
+        self.assertNotEqual(mafft_inputs['config'], inputs['config'])
+
+        ledger_fpath = "{0}/build_ledger.tsv".format(self.run_name)
+        outputs = SSbuild.filter_outputs(self.config, "ATP5MC1")
+        for fpath in outputs:
+            with open(fpath, 'wt') as f:
+                f.write("output\n")
+        #Outputs written before the ledger existed are never trusted (rebuilt once)
+        ledger = BuildLedger(ledger_fpath)
+        self.assertFalse(ledger.is_fresh('filter', "ATP5MC1", inputs, outputs))
+        ledger.record('filter', "ATP5MC1", inputs, outputs)
+        ledger = BuildLedger(ledger_fpath)
+        self.assertTrue(ledger.is_fresh('filter', "ATP5MC1", inputs, outputs))
+        self.assertFalse(ledger.is_fresh('filter', "ATP5MC1", related, outputs))
+        self.assertEqual(ledger.stale_inputs('filter', "ATP5MC1", related), ['tax_subset'])
+        self.assertFalse(ledger.is_fresh('analysis', "ATP5MC1", {}, ["{0}/missing.tsv".format(self.run_name)]))
+        #Rebuilt stage is fresh for its new inputs; modified outputs are stale
+        ledger.record('filter', "ATP5MC1", related, outputs)
+        self.assertTrue(BuildLedger(ledger_fpath).is_fresh('filter', "ATP5MC1", related, outputs))
+        with open(outputs[0], 'at') as f:
+            f.write("edited\n")
+        self.assertFalse(ledger.is_fresh('filter', "ATP5MC1", related, outputs))
+        ledger.compact()
+        with open(ledger_fpath) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_species_hash(self):
+        import subprocess
+        #Species list hash is stable across interpreters (hash() of str is randomized per process)
+        check = "from SSutility.SSconfig import parse_species; print(parse_species()[1])"
+        hashes = [subprocess.run([sys.executable, "-c", check], stdout=subprocess.PIPE, text=True, check=True,
+                                 env=dict(os.environ, PYTHONPATH=os.getcwd())).stdout for i in range(2)]
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertEqual(hashes[0].strip(), SSconfig.parse_species()[1])
+
+
 if __name__ == '__main__':
 
     from SSutility.SSdirectory import create_directory,empty_directory
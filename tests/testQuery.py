@@ -22,6 +22,7 @@ import warnings
 # os.chdir("..")
 import sys
 sys.path.append(os.getcwd())
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from SSutility import SSdirectory, SSconfig, SSfasta, SSerrors
 from SSacquisition import ODBquery,NCBIquery
@@ -29,6 +30,11 @@ from SSacquisition import ODBquery,NCBIquery
 test_tmp_dir = "tests/tmp"
 
 
+def setUpModule():
+    #tests/tmp is not tracked; test outputs are written there
+    SSdirectory.create_directory(test_tmp_dir)
+
+
 class testODBQuery(unittest.TestCase):
 
     def setUp(self):
@@ -60,6 +66,374 @@ class testODBQuery(unittest.TestCase):
         test_tsv = SSfasta.load_tsv_table(atp5mc1_tsv_path)
         self.assertTrue("43179_0" in test_tsv['organism_taxid'].unique())
 
+class testODBMirror(unittest.TestCase):
+
+    def setUp(self):
+        from SSacquisition import ODBmirror
+        SSdirectory.create_directory("{0}/input/ODB".format(test_tmp_dir))
+        dumps_dir = "tests/test_data/ODB/dumps"
+        self.db_fpath = "{0}/odb_mirror.sqlite".format(test_tmp_dir)
+        ODBmirror.build_ODB_mirror(self.db_fpath, "{0}/species.tab".format(dumps_dir),
+                                   "{0}/OGs.tab".format(dumps_dir), "{0}/OG2genes.tab".format(dumps_dir),
+                                   "{0}/genes.tab".format(dumps_dir), "{0}/aa_fasta.gz".format(dumps_dir),
+                                   xrefs_fpath="{0}/gene_xrefs.tab".format(dumps_dir))
+        self.mirror = ODBmirror.ODBMirror(self.db_fpath)
+
+    def tearDown(self):
+        self.mirror.close()
+
+    def test_mirror_query(self):
+        test_level_str = "level=40674"
+        #Mirror output matches API output for the same query
+        ODBquery.ODB_query(test_tmp_dir, "ATP5MC1", test_level_str, "species=", mirror=self.mirror)
+        tsv_fpath = "{0}/input/ODB/ATP5MC1.tsv".format(test_tmp_dir)
+        fasta_fpath = "{0}/input/ODB/ATP5MC1.fasta".format(test_tmp_dir)
+        api_tsv = SSfasta.load_tsv_table("tests/test_data/ODB/ATP5MC1.tsv")
+        mirror_tsv = SSfasta.load_tsv_table(tsv_fpath)
+        pd.testing.assert_frame_equal(api_tsv, mirror_tsv)
+        api_fasta = SSfasta.fasta_to_srs("tests/test_data/ODB/ATP5MC1.fasta")
+        mirror_fasta = SSfasta.fasta_to_srs(fasta_fpath)
+        pd.testing.assert_series_equal(api_fasta, mirror_fasta)
+        with open(fasta_fpath) as fasta_f, open("tests/test_data/ODB/ATP5MC1.fasta") as api_fasta_f:
+            self.assertEqual(fasta_f.readline(), api_fasta_f.readline())
+        #Species filter and case-insensitive/ xref query keys
+        ODBquery.ODB_query(test_tmp_dir, "atp5g1", test_level_str, "species=9606,43179", mirror=self.mirror)
+        mirror_tsv = SSfasta.load_tsv_table("{0}/input/ODB/atp5g1.tsv".format(test_tmp_dir))
+        self.assertEqual(sorted(mirror_tsv['organism_taxid'].unique()), ['43179_0', '9606_0'])
+        #Level filter: human gene also belongs to a primate OG
+        records_df, seqs = self.mirror.query_records("ATP5MC1", 9443)
+        self.assertEqual(list(records_df['pub_og_id']), ['1234at9443'])
+
+    def test_mirror_query_errors(self):
+        from SSacquisition import ODBmirror
+        with self.assertRaises(SSerrors.OrthoDBQueryError) as cm:
+            ODBquery.ODB_query(test_tmp_dir, "jsakdh", "level=40674", "species=9606", mirror=self.mirror)
+        self.assertEqual(cm.exception.code, 0)
+        self.assertFalse(os.path.exists("{0}/input/ODB/jsakdh.tsv".format(test_tmp_dir)))
+        #Matches outside of the species filter
+        with self.assertRaises(SSerrors.OrthoDBQueryError) as cm:
+            self.mirror.query_records("ATP5MC1", 40674, [1])
+        self.assertEqual(cm.exception.code, 0)
+        #ATPSHARED xref matches both OGs
+        records_df, seqs = self.mirror.query_records("ATPSHARED", 40674)
+        self.assertEqual(len(records_df['pub_og_id'].unique()), 2)
+        strict_mirror = ODBmirror.ODBMirror(self.db_fpath, max_clusters=1)
+        with self.assertRaises(SSerrors.OrthoDBQueryError) as cm:
+            strict_mirror.query_records("ATPSHARED", 40674)
+        self.assertEqual(cm.exception.code, 1)
+        strict_mirror.close()
+
+class testMockServer(unittest.TestCase):
+
+    def setUp(self):
+        SSdirectory.create_directory("{0}/input/ODB".format(test_tmp_dir))
+
+    def test_mock_ODB_query(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSacquisition.SSdownload import DownloadEngine
+        engine = DownloadEngine(requests_per_second=100, max_workers=2)
+        test_level_str, test_spec_str = "level=40674", "species=9606,43179,9601,10090,10161"
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            ODBquery.ODB_query(test_tmp_dir, "ATP5MC1__1", test_level_str, test_spec_str, engine=engine)
+            with self.assertRaises(SSerrors.OrthoDBQueryError):
+                ODBquery.ODB_query(test_tmp_dir, "jsakdh", test_level_str, test_spec_str, engine=engine)
+        self.assertEqual(server.state.requests['/fasta'], 2)
+        test_tsv = SSfasta.load_tsv_table("{0}/input/ODB/ATP5MC1__1.tsv".format(test_tmp_dir))
+        self.assertTrue("43179_0" in test_tsv['organism_taxid'].unique())
+        self.assertFalse(os.path.exists("{0}/input/ODB/jsakdh.tsv".format(test_tmp_dir)))
+
+    def test_streamed_response_check(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSacquisition.SSdownload import DownloadEngine
+        self.assertEqual(ODBquery.classify_ODB_response(b'\n  {"count":0,"data":[]}'), 'json')
+        self.assertEqual(ODBquery.classify_ODB_response(b'<!DOCTYPE html>\n<html>'), 'html')
+        self.assertEqual(ODBquery.classify_ODB_response(b'>9606_0:00415a "pub_og_id":"1234at40674"'), 'data')
+        self.assertEqual(ODBquery.classify_ODB_response(b'pub_og_id\tog_name\tlevel_taxid'), 'data')
+        with self.assertRaises(SSerrors.OrthoDBQueryError) as cm:
+            ODBquery.check_ODB_response(b'<html><body>Too many clusters</body></html>')
+        self.assertEqual(cm.exception.code, 1)
+        #No results response: fasta body rejected before anything is written, tab endpoint never requested
+        engine = DownloadEngine(requests_per_second=100, max_workers=2)
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            with self.assertRaises(SSerrors.OrthoDBQueryError) as cm:
+                ODBquery.ODB_query(test_tmp_dir, "NOTAGENE", "level=40674", "species=9606", engine=engine)
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual((server.state.requests['/fasta'], server.state.requests['/tab']), (1, 0))
+        self.assertFalse(any(fname.startswith(".NOTAGENE") or fname.startswith("NOTAGENE")
+                             for fname in os.listdir("{0}/input/ODB".format(test_tmp_dir))))
+
+    def test_mock_fault_injection(self):
+        import requests
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSacquisition.SSdownload import DownloadEngine
+        engine = DownloadEngine(requests_per_second=100, max_workers=2)
+        with MockAcquisitionServer(error_rate=1) as server, mock_base_urls(server):
+            with self.assertRaises(requests.HTTPError):
+                ODBquery.ODB_query(test_tmp_dir, "CALM1", "level=40674", "species=9606", engine=engine)
+        self.assertFalse(os.path.exists("{0}/input/ODB/CALM1.fasta".format(test_tmp_dir)))
+        self.assertEqual(server.state.statuses[503], 1)
+        with MockAcquisitionServer(rate_limit=1, latency=0.01) as server:
+            statuses = [engine.get(server.url + "/tab", params={'query':'CALM1'}).status_code for i in range(3)]
+        self.assertEqual(statuses[0], 200)
+        self.assertIn(429, statuses)
+
+class testODBDeltaSpecies(unittest.TestCase):
+
+    def setUp(self):
+        self.run_dir = "{0}/delta_run".format(test_tmp_dir)
+        SSdirectory.create_directory("{0}/input/ODB".format(self.run_dir))
+        SSdirectory.empty_directory(self.run_dir)
+        SSdirectory.create_directory("{0}/input/ODB".format(self.run_dir))
+        self.config = SSconfig.parse_config("config/config.txt")
+        self.config['RUN']['RunName'] = self.run_dir
+        self.config['RUN']['OverwriteInput'] = 'no'
+        self.config['CACHE']['UseCache'] = 'no'
+        self.config['ODB']['ODBRequestsPerSecond'] = '100'
+
+    def download(self, server, tax_ids, gene_list=["ATP5MC1", "CALM1"]):
+        tax_table = pd.DataFrame({'tax_id':tax_ids})
+        requests_before = server.state.requests['/fasta']
+        valid, failed = ODBquery.download_ODB_input(gene_list, tax_table, self.config)
+        self.assertEqual(failed, [])
+        tsv_df = SSfasta.load_tsv_table("{0}/input/ODB/ATP5MC1.tsv".format(self.run_dir))
+        fasta_srs = SSfasta.fasta_to_srs("{0}/input/ODB/ATP5MC1.fasta".format(self.run_dir))
+        tsv_tax_ids = set(tsv_df['organism_taxid'].str.split('_').str[0].astype(int))
+        self.assertEqual(set(fasta_srs.index), set(tsv_df.index))
+        self.assertFalse(tsv_df.index.duplicated().any())
+        return server.state.requests['/fasta'] - requests_before, tsv_tax_ids
+
+    def test_delta_species(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSutility.SSjournal import run_journal
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            requests, tsv_tax_ids = self.download(server, [9606, 10090])
+            self.assertEqual(requests, 2)
+            self.assertEqual(tsv_tax_ids, {9606, 10090})
+            #Added species: one query per gene limited to the added species
+            requests, tsv_tax_ids = self.download(server, [9606, 10090, 43179])
+            self.assertEqual(requests, 2)
+            self.assertEqual(tsv_tax_ids, {9606, 10090, 43179})
+            self.assertEqual(server.state.requests['/tab'], 4)
+            #Removed species: dropped locally
+            requests, tsv_tax_ids = self.download(server, [9606, 43179])
+            self.assertEqual(requests, 0)
+            self.assertEqual(tsv_tax_ids, {9606, 43179})
+            requests, tsv_tax_ids = self.download(server, [9606, 43179])
+            self.assertEqual(requests, 0)
+        journal = run_journal(self.run_dir)
+        self.assertEqual(journal.entry("ODB", "ATP5MC1")['value'], "level=40674;species=9606,43179")
+
+    def test_delta_species_permanent_error(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSutility.SSjournal import run_journal
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            self.download(server, [9606, 10090], gene_list=["ATP5MC1"])
+            #Too many clusters for the added species: removed species are still dropped and the update is journaled
+            server.state.too_many_clusters.add("ATP5MC1")
+            requests, tsv_tax_ids = self.download(server, [9606, 43179], gene_list=["ATP5MC1"])
+            self.assertEqual(requests, 1)
+            self.assertEqual(tsv_tax_ids, {9606})
+            requests, tsv_tax_ids = self.download(server, [9606, 43179], gene_list=["ATP5MC1"])
+            self.assertEqual(requests, 0)
+        journal = run_journal(self.run_dir)
+        self.assertEqual(journal.entry("ODB", "ATP5MC1")['value'], "level=40674;species=9606,43179")
+
+    def test_delta_species_compressed(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSutility.SScompress import detect_compression
+        self.config['RUN']['InputCompression'] = 'gzip'
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            self.download(server, [9606], gene_list=["ATP5MC1"])
+            requests, tsv_tax_ids = self.download(server, [9606, 10090], gene_list=["ATP5MC1"])
+        self.assertEqual(requests, 1)
+        self.assertEqual(tsv_tax_ids, {9606, 10090})
+        self.assertEqual(detect_compression("{0}/input/ODB/ATP5MC1.fasta".format(self.run_dir)), 'gzip')
+
+class testInputCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.compressed_dir = "{0}/compressed".format(test_tmp_dir)
+        SSdirectory.create_directory("{0}/input/ODB".format(self.compressed_dir))
+        SSdirectory.empty_directory("{0}/input/ODB".format(self.compressed_dir))
+
+    def check_ODB_readers(self, compression):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSacquisition.SSdownload import DownloadEngine
+        from SSutility.SScompress import detect_compression
+        engine = DownloadEngine(requests_per_second=100, max_workers=2)
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            ODBquery.ODB_query(self.compressed_dir, "ATP5MC1", "level=40674", "species=", engine=engine,
+                               compression=compression)
+            with self.assertRaises(SSerrors.OrthoDBQueryError):
+                ODBquery.ODB_query(self.compressed_dir, "jsakdh", "level=40674", "species=9606", engine=engine,
+                                   compression=compression)
+        fasta_fpath = "{0}/input/ODB/ATP5MC1.fasta".format(self.compressed_dir)
+        tsv_fpath = "{0}/input/ODB/ATP5MC1.tsv".format(self.compressed_dir)
+        self.assertEqual(detect_compression(fasta_fpath), compression)
+        self.assertEqual(detect_compression(tsv_fpath), compression)
+        self.assertLess(os.path.getsize(fasta_fpath), os.path.getsize("tests/test_data/ODB/ATP5MC1.fasta"))
+        pd.testing.assert_frame_equal(SSfasta.load_tsv_table(tsv_fpath),
+                                      SSfasta.load_tsv_table("tests/test_data/ODB/ATP5MC1.tsv"))
+        expected = SSfasta.fasta_to_srs("tests/test_data/ODB/ATP5MC1.fasta")
+        pd.testing.assert_series_equal(SSfasta.fasta_to_srs(fasta_fpath), expected)
+        seqs, lengths = SSfasta.length_srs(fasta_fpath, ["9606_0:00415a"])
+        self.assertEqual(seqs["9606_0:00415a"], expected["9606_0:00415a"])
+        ordered = [record.id for record in SSfasta.ordered_record_generator(fasta_fpath, expected.index[::-1])]
+        self.assertEqual(ordered, list(expected.index[::-1]))
+
+    def test_gzip_inputs(self):
+        self.check_ODB_readers('gzip')
+
+    def test_NCBI_compressed_fasta(self):
+        from SSfilter import NCBIfilter
+        from SSutility.SScompress import detect_compression
+        records_dir = "{0}/input/NCBI/9999".format(self.compressed_dir)
+        SSdirectory.create_directory(records_dir)
+        SSdirectory.empty_directory(records_dir)
+        id_df = pd.DataFrame({'gene_symbol':["CALM1"],'ags_gene_id':["113184712"]})
+        tax_dict = {'gid_column':'ags_gene_id','pid_column':'ags_protein_ids'}
+        engine = testNCBIBatchedDownload.FakeEntrezEngine()
+        NCBIquery.download_NCBI_records_batched(id_df,records_dir,tax_dict,"",engine=engine,compression='gzip')
+        fasta_fpath = "{0}/CALM1.fasta".format(records_dir)
+        self.assertEqual(detect_compression(fasta_fpath), 'gzip')
+        ncbi_df = NCBIfilter.load_NCBI_fasta_df(fasta_fpath, {"Urocitellus parryii":"9999"})
+        self.assertEqual(list(ncbi_df.index), ["XP_026249989.1"])
+
+    @unittest.skipUnless(__import__('importlib').util.find_spec('zstandard'), "zstandard not installed")
+    def test_zstd_inputs(self):
+        self.check_ODB_readers('zstd')
+
+class testDownloadEngine(unittest.TestCase):
+
+    def test_token_bucket(self):
+        import time
+        from SSacquisition.SSdownload import TokenBucket
+        #Capacity 1: first token immediate, following tokens spaced by 1/rate seconds of wall-clock time
+        bucket = TokenBucket(20, capacity=1)
+        t0 = time.monotonic()
+        for i in range(5):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic()-t0, 4/20 - 0.01)
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+    def test_shared_host_bucket(self):
+        import time
+        from SSacquisition.SSdownload import DownloadEngine, host_bucket
+        class Session:
+            def get(self, url, params=None, timeout=None, stream=False):
+                return url
+            def close(self):
+                pass
+        url = "https://bucket.test/tab"
+        self.assertIs(host_bucket(url, 20), host_bucket("https://BUCKET.test/fasta", 20))
+        self.assertIsNot(host_bucket(url, 20), host_bucket("https://other.test/tab", 20))
+        #Separately created engines for one host policy share its rate
+        engines = [DownloadEngine(requests_per_second=20, session=Session()) for i in range(2)]
+        t0 = time.monotonic()
+        for i in range(6):
+            engines[i % 2].get(url)
+        self.assertGreaterEqual(time.monotonic()-t0, 5/20 - 0.01)
+
+    def test_engine_map(self):
+        from SSacquisition.SSdownload import DownloadEngine
+        engine = DownloadEngine(requests_per_second=50, max_workers=3)
+        class QueryErrorStub(Exception):
+            pass
+        def square(x):
+            if x == 3:
+                raise QueryErrorStub()
+            return x*x
+        results = {item:(result,error) for item,result,error in engine.map(square,range(5))}
+        engine.close()
+        self.assertEqual(results[4][0],16)
+        self.assertIsInstance(results[3][1],QueryErrorStub)
+        self.assertEqual(len(results),5)
+
+class testRetryScheduler(unittest.TestCase):
+
+    def test_backoff_and_breaker(self):
+        import time
+        from SSacquisition.SSdownload import RetryPolicy, CircuitBreaker, CircuitOpenError
+        policy = RetryPolicy(backoff=0.5, max_backoff=4)
+        self.assertTrue(all(0 <= policy.delay(3) <= 4 for i in range(20)))
+        self.assertTrue(all(policy.delay(0) <= 0.5 for i in range(20)))
+        #Retry-After is a lower bound, capped by max_backoff
+        self.assertGreaterEqual(policy.delay(0, retry_after=2), 2)
+        self.assertEqual(policy.delay(0, retry_after=30), 4)
+        breaker = CircuitBreaker("host", failure_threshold=2, reset_timeout=0.1)
+        breaker.record_failure()
+        breaker.before_request()
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+        time.sleep(0.1)
+        #Half open: one probe is let through, further requests wait for its outcome
+        breaker.before_request()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+
+    def test_map_priority_requeue(self):
+        import time
+        from SSacquisition.SSdownload import DownloadEngine, RetryPolicy, CircuitOpenError
+        engine = DownloadEngine(requests_per_second=100, max_workers=1, retry=RetryPolicy(max_retries=2))
+        attempts = []
+        def query(item):
+            attempts.append(item)
+            if item == "degraded" and attempts.count(item) == 1:
+                raise CircuitOpenError("degraded.host", time.monotonic() + 0.05)
+            return item
+        results = [(item, error) for item, result, error in
+                   engine.map(query, ["low", "degraded", "high"], priority=lambda item: item == "low")]
+        engine.close()
+        #Requeued item doesn't block the queue; items start in priority order
+        self.assertEqual(attempts, ["degraded", "high", "low", "degraded"])
+        self.assertEqual(results[-1], ("degraded", None))
+
+    def test_transient_retries(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSacquisition.SSdownload import DownloadEngine, RetryPolicy
+        SSdirectory.create_directory("{0}/input/ODB".format(test_tmp_dir))
+        retry = RetryPolicy(max_retries=10, backoff=0.001, max_backoff=0.01, breaker_failures=0)
+        engine = DownloadEngine(requests_per_second=1000, max_workers=2, retry=retry)
+        with MockAcquisitionServer(error_rate=0.5, seed=1) as server, mock_base_urls(server):
+            ODBquery.ODB_query(test_tmp_dir, "CALM1", "level=40674", "species=9606,43179", engine=engine)
+        engine.close()
+        self.assertGreater(server.state.statuses[503], 0)
+        self.assertEqual(server.state.statuses[200], 2)
+        self.assertTrue(os.path.exists("{0}/input/ODB/CALM1.fasta".format(test_tmp_dir)))
+
+    def test_transient_failures_not_logged(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSutility.SSjournal import run_journal, TRANSIENT
+        run_dir = "{0}/retry_run".format(test_tmp_dir)
+        SSdirectory.create_directory("{0}/input/ODB".format(run_dir))
+        SSdirectory.empty_directory(run_dir)
+        SSdirectory.create_directory("{0}/input/ODB".format(run_dir))
+        config = SSconfig.parse_config("config/config.txt")
+        config['RUN']['RunName'] = run_dir
+        config['CACHE']['UseCache'] = 'no'
+        config['ODB']['ODBRequestsPerSecond'] = '1000'
+        for key, value in [('MaxRetries', '2'), ('RetryBackoff', '0.001'), ('RetryMaxBackoff', '0.01'),
+                           ('BreakerFailures', '3'), ('BreakerResetSeconds', '0.05')]:
+            config['RETRY'][key] = value
+        tax_table = pd.DataFrame({'tax_id':[9606, 43179]})
+        gene_list = ["CALM1", "NOTAGENE"]
+        with MockAcquisitionServer(error_rate=1) as server, mock_base_urls(server):
+            valid, failed = ODBquery.download_ODB_input(gene_list, tax_table, config)
+        self.assertEqual(sorted(failed), gene_list)
+        self.assertFalse(os.path.exists("{0}/errors.tsv".format(run_dir)))
+        self.assertEqual(run_journal(run_dir).entry("ODB", "CALM1")['status'], TRANSIENT)
+        #Healthy service on the next run: transient failures are retried, permanent outcomes logged
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            valid, failed = ODBquery.download_ODB_input(gene_list, tax_table, config)
+        self.assertEqual(valid, ["CALM1"])
+        check_errors, errors_df = SSerrors.load_errors("{0}/errors.tsv".format(run_dir), "OrthoDBQueryError")
+        self.assertEqual(list(errors_df['gene_symbol']), ["NOTAGENE"])
+        self.assertTrue(run_journal(run_dir).is_complete("ODB", "CALM1"))
+
 class testNCBIQuery(unittest.TestCase):
 
 
@@ -89,6 +463,501 @@ class testNCBIQuery(unittest.TestCase):
 
         driver.quit()
 
+class testHTTPCache(unittest.TestCase):
+
+    class CountingSession:
+        #Stands in for requests.Session; counts requests that reach the "network"
+        class Response:
+            def __init__(self, url):
+                self.url, self.status_code, self.ok = url, 200, True
+                self.content = "body for {0}".format(url).encode()
+            def raise_for_status(self):
+                pass
+            def iter_content(self, chunk_size=65536):
+                return iter([self.content])
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                pass
+        def __init__(self):
+            self.n_requests = 0
+        def get(self, url, params=None, timeout=None, stream=False):
+            self.n_requests += 1
+            return self.Response(url)
+        def close(self):
+            pass
+
+    def cache_dir(self, name):
+        import shutil
+        cache_dir = "{0}/{1}".format(test_tmp_dir, name)
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        return cache_dir
+
+    def test_content_cache(self):
+        import time
+        from SSutility.SScache import ContentCache, content_key
+        cache = ContentCache(self.cache_dir("content_cache"), max_bytes=10**6)
+        keys = [content_key("entry", str(i)) for i in range(3)]
+        for i, key in enumerate(keys):
+            cache.put(key, ("entry {0} ".format(i)*100).encode())
+        self.assertEqual(cache.get(keys[1]), ("entry 1 "*100).encode())
+        self.assertIsNone(cache.get(content_key("missing")))
+        #LRU eviction: mark keys[0] as oldest use, evict down to two entries' worth of bytes
+        os.utime(cache.entry_path(keys[0]), (time.time()-1000, time.time()))
+        cache.evict(cache.total_bytes() - 1)
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertIsNotNone(cache.get(keys[2]))
+        #TTL expiry uses entry store time
+        ttl_cache = ContentCache(cache.cache_dir, ttl=60)
+        os.utime(cache.entry_path(keys[2]), (time.time(), time.time()-120))
+        self.assertIsNone(ttl_cache.get(keys[2]))
+
+    def test_engine_cache(self):
+        from SSutility.SScache import ContentCache
+        from SSacquisition.SSdownload import DownloadEngine, CacheMissError, http_cache_key
+        #Normalized keys: parameter order, host case and api_key don't matter
+        self.assertEqual(http_cache_key("GET", "https://EUTILS.ncbi.nlm.nih.gov/efetch.fcgi?db=protein&id=1"),
+                         http_cache_key("get", "https://eutils.ncbi.nlm.nih.gov/efetch.fcgi",
+                                        {'id':1, 'api_key':'abc', 'db':'protein'}))
+        cache = ContentCache(self.cache_dir("http_cache"))
+        session = self.CountingSession()
+        engine = DownloadEngine(requests_per_second=100, session=session, cache=cache)
+        url = "https://v101.orthodb.org/tab?query=ATP5MC1&level=40674"
+        first, second = engine.get(url), engine.get(url)
+        self.assertEqual(session.n_requests, 1)
+        self.assertEqual(first.content, second.content)
+        self.assertTrue(second.from_cache)
+        download_fpath = "{0}/cached_download.tsv".format(test_tmp_dir)
+        engine.download(url, download_fpath)
+        self.assertEqual(session.n_requests, 1)
+        #Bodies rejected by validate (ie OrthoDB error responses) are not cached
+        from SSutility.SSerrors import OrthoDBQueryError
+        def reject(head):
+            raise OrthoDBQueryError(0, "No OrthoDB results for query")
+        error_url = "https://v101.orthodb.org/tab?query=NORESULTS"
+        for i in range(2):
+            with self.assertRaises(OrthoDBQueryError):
+                engine.download(error_url, download_fpath, validate=reject)
+        self.assertEqual(session.n_requests, 3)
+        #Cache-only mode: cached requests succeed, uncached requests fail without reaching the session
+        offline_engine = DownloadEngine(requests_per_second=100, session=session, cache=cache, cache_only=True)
+        self.assertEqual(offline_engine.get(url).content, first.content)
+        with self.assertRaises(CacheMissError):
+            offline_engine.get("https://v101.orthodb.org/tab?query=CALM1")
+        self.assertEqual(session.n_requests, 3)
+
+class testNCBIBatchedDownload(unittest.TestCase):
+
+    class FakeEntrezEngine:
+        """Stands in for SSdownload.DownloadEngine, answering Entrez requests from tests/test_data/NCBI/entrez"""
+        class Response:
+            def __init__(self, content):
+                self.content = content
+            def raise_for_status(self):
+                pass
+
+        def __init__(self, responses=None):
+            self.requests = []
+            self.cache = None
+            #Optional endpoint -> response content overriding the fixtures
+            self.responses = responses or {}
+
+        def _respond(self, url):
+            self.requests.append(url)
+            endpoint = url.split("/")[-1]
+            if endpoint in self.responses:
+                return self.Response(self.responses[endpoint])
+            fixture = {"elink.fcgi":"elink_gene_protein.xml","epost.fcgi":"epost_protein.xml",
+                       "efetch.fcgi":"efetch_protein_tseq.xml"}[endpoint]
+            with open("tests/test_data/NCBI/entrez/{0}".format(fixture),'rb') as fixture_f:
+                return self.Response(fixture_f.read())
+
+        def get(self, url, params=None, stream=False):
+            return self._respond(url)
+
+        def post(self, url, data=None, cache=True):
+            return self._respond(url)
+
+    def test_parse_entrez(self):
+        with open("tests/test_data/NCBI/entrez/elink_gene_protein.xml",'rb') as elink_f:
+            linked = NCBIquery.parse_elink_linksets(elink_f.read())
+        self.assertEqual(linked['113191869'],['1486853240','1486853242'])
+        self.assertEqual(linked['113184712'],['1486895501'])
+        with open("tests/test_data/NCBI/entrez/efetch_protein_tseq.xml",'rb') as efetch_f:
+            records = NCBIquery.parse_tseq_records(efetch_f.read())
+        self.assertTrue(records['1486895501'].startswith(">XP_026249989.1 calmodulin-1 [Urocitellus parryii]\n"))
+        self.assertEqual(NCBIquery.entrez_batch_params("")['requests_per_second'],3)
+        self.assertEqual(NCBIquery.entrez_batch_params("key")['requests_per_second'],10)
+
+    def test_batched_download(self):
+        records_dir = "{0}/input/NCBI/9999".format(test_tmp_dir)
+        SSdirectory.create_directory(records_dir)
+        for symbol in ["ATP5MC1","CALM1"]:
+            if os.path.exists("{0}/{1}.fasta".format(records_dir,symbol)):
+                os.remove("{0}/{1}.fasta".format(records_dir,symbol))
+        id_df = pd.DataFrame({'gene_symbol':["ATP5MC1","CALM1","NOGID"],
+                              'ags_gene_id':["113191869","113184712",None]})
+        tax_dict = {'gid_column':'ags_gene_id','pid_column':'ags_protein_ids'}
+        engine = self.FakeEntrezEngine()
+        id_df = NCBIquery.download_NCBI_records_batched(id_df,records_dir,tax_dict,"",engine=engine)
+        #One elink, one epost and one efetch request for all genes
+        self.assertEqual(len(engine.requests),3)
+        self.assertEqual(id_df.loc[0,'ags_protein_ids'],'1486853240,1486853242')
+        for symbol in ["ATP5MC1","CALM1"]:
+            downloaded = SSfasta.fasta_to_srs("{0}/{1}.fasta".format(records_dir,symbol))
+            expected = SSfasta.fasta_to_srs("tests/test_data/NCBI/9999/{0}.fasta".format(symbol))
+            self.assertTrue(downloaded.equals(expected))
+
+    def test_batched_download_journal(self):
+        from SSutility.SSjournal import AcquisitionJournal
+        records_dir = "{0}/input/NCBI/journal".format(test_tmp_dir)
+        SSdirectory.create_directory(records_dir)
+        SSdirectory.empty_directory(records_dir)
+        journal_fpath = "{0}/journal.tsv".format(records_dir)
+        tax_dict = {'gid_column':'ags_gene_id','pid_column':'ags_protein_ids'}
+        id_df = pd.DataFrame({'gene_symbol':["ATP5MC1","CALM1"],'ags_gene_id':["113191869","113184712"]})
+        engine = self.FakeEntrezEngine()
+        NCBIquery.download_NCBI_records_batched(id_df.copy(),records_dir,tax_dict,"",engine=engine,
+                                                journal=AcquisitionJournal(journal_fpath))
+        #Resumed run: nothing requested, protein IDs restored from the journal and summary written once
+        engine = self.FakeEntrezEngine()
+        pid_outpath = "{0}/pids.tsv".format(records_dir)
+        resumed_df = NCBIquery.download_NCBI_records_batched(id_df.copy(),records_dir,tax_dict,"",engine=engine,
+                                                             pid_outpath=pid_outpath,
+                                                             journal=AcquisitionJournal(journal_fpath))
+        self.assertEqual(len(engine.requests),0)
+        self.assertEqual(resumed_df.loc[0,'ags_protein_ids'],'1486853240,1486853242')
+        self.assertTrue(os.path.exists(pid_outpath))
+        #Truncated fasta (size differs from journal) is downloaded again
+        calm1_fpath = "{0}/CALM1.fasta".format(records_dir)
+        with open(calm1_fpath,'rt') as calm1_f:
+            calm1_txt = calm1_f.read()
+        with open(calm1_fpath,'wt') as calm1_f:
+            calm1_f.write(calm1_txt[:20])
+        engine = self.FakeEntrezEngine()
+        NCBIquery.download_NCBI_records_batched(id_df.copy(),records_dir,tax_dict,"",engine=engine,
+                                                journal=AcquisitionJournal(journal_fpath))
+        self.assertEqual(len(engine.requests),3)
+        with open(calm1_fpath,'rt') as calm1_f:
+            self.assertEqual(calm1_f.read(), calm1_txt)
+
+    def test_incomplete_efetch(self):
+        import re
+        from SSutility.SSjournal import AcquisitionJournal
+        records_dir = "{0}/input/NCBI/incomplete".format(test_tmp_dir)
+        SSdirectory.create_directory(records_dir)
+        SSdirectory.empty_directory(records_dir)
+        journal = AcquisitionJournal("{0}/journal.tsv".format(records_dir))
+        tax_dict = {'gid_column':'ags_gene_id','pid_column':'ags_protein_ids'}
+        id_df = pd.DataFrame({'gene_symbol':["ATP5MC1","CALM1"],'ags_gene_id':["113191869","113184712"]})
+        #efetch response without one of ATP5MC1's records: ATP5MC1 isn't written or journaled, CALM1 is
+        with open("tests/test_data/NCBI/entrez/efetch_protein_tseq.xml",'rb') as efetch_f:
+            efetch_xml = efetch_f.read()
+        partial_xml = re.sub(rb"<TSeq>(?:(?!</TSeq>).)*<TSeq_gi>1486853242</TSeq_gi>.*?</TSeq>\s*", b"", efetch_xml,
+                             flags=re.DOTALL)
+        self.assertNotEqual(partial_xml, efetch_xml)
+        engine = self.FakeEntrezEngine(responses={"efetch.fcgi":partial_xml})
+        NCBIquery.download_NCBI_records_batched(id_df.copy(),records_dir,tax_dict,"",engine=engine,journal=journal)
+        self.assertFalse(os.path.exists("{0}/ATP5MC1.fasta".format(records_dir)))
+        self.assertIsNone(journal.entry("NCBI_records","ATP5MC1"))
+        self.assertTrue(journal.is_complete("NCBI_records","CALM1","{0}/CALM1.fasta".format(records_dir)))
+        #Entrez error page returned with HTTP 200: batch fails without aborting the pass
+        engine = self.FakeEntrezEngine(responses={"efetch.fcgi":b"<html><body>Error 503</body>"})
+        NCBIquery.download_NCBI_records_batched(id_df.copy(),records_dir,tax_dict,"",engine=engine,journal=journal)
+        self.assertIsNone(journal.entry("NCBI_records","ATP5MC1"))
+
+class testAcquisitionJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.journal_dir = "{0}/journal".format(test_tmp_dir)
+        SSdirectory.create_directory(self.journal_dir)
+        SSdirectory.empty_directory(self.journal_dir)
+
+    def test_atomic_write(self):
+        from SSutility.SSjournal import atomic_write
+        fpath = "{0}/atomic.txt".format(self.journal_dir)
+        with atomic_write(fpath) as f:
+            f.write("complete\n")
+        with self.assertRaises(RuntimeError):
+            with atomic_write(fpath) as f:
+                f.write("partial")
+                raise RuntimeError("interrupted")
+        with open(fpath) as f:
+            self.assertEqual(f.read(), "complete\n")
+        self.assertEqual(os.listdir(self.journal_dir), ["atomic.txt"])
+
+    def test_journal_resume(self):
+        from SSutility.SSjournal import AcquisitionJournal
+        journal_fpath = "{0}/journal.tsv".format(self.journal_dir)
+        fasta_fpath = "{0}/A.fasta".format(self.journal_dir)
+        #Files from runs before journaling are adopted by a new journal
+        with open(fasta_fpath, 'wt') as f:
+            f.write(">a\nMA\n")
+        journal = AcquisitionJournal(journal_fpath)
+        self.assertTrue(journal.is_complete("ODB", "A", fasta_fpath))
+        journal.record("NCBI_gid", "B", value="12345")
+        journal.record("NCBI_gid", "C", status="failed")
+        #Line cut off by an interrupted append is ignored
+        with open(journal_fpath, 'at') as f:
+            f.write("1.0\tODB\tD\tcomplete")
+        journal = AcquisitionJournal(journal_fpath)
+        self.assertEqual(journal.values("NCBI_gid"), {"B":"12345"})
+        self.assertIsNone(journal.entry("ODB", "D"))
+        #Unjournaled files aren't trusted once the journal exists
+        e_fpath = "{0}/E.fasta".format(self.journal_dir)
+        with open(e_fpath, 'wt') as f:
+            f.write(">e\n")
+        self.assertFalse(journal.is_complete("ODB", "E", e_fpath))
+        with open(fasta_fpath, 'at') as f:
+            f.write("MM\n")
+        self.assertFalse(journal.is_complete("ODB", "A", fasta_fpath))
+        journal.record("NCBI_gid", "B", value="67890")
+        journal.compact()
+        with open(journal_fpath) as f:
+            self.assertEqual(len(f.readlines()), 4)
+        self.assertEqual(AcquisitionJournal(journal_fpath).values("NCBI_gid"), {"B":"67890"})
+
+    def test_legacy_run_adoption(self):
+        import shutil
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSutility.SSjournal import run_journal
+        run_dir = "{0}/legacy_run".format(self.journal_dir)
+        for input_dir in ["ODB", "NCBI/9999"]:
+            SSdirectory.create_directory("{0}/input/{1}".format(run_dir, input_dir))
+        #Input files downloaded before journaling was introduced
+        for fname in ["ODB/ATP5MC1.fasta", "ODB/ATP5MC1.tsv", "NCBI/9999/ATP5MC1.fasta"]:
+            shutil.copyfile("tests/test_data/{0}".format(fname), "{0}/input/{1}".format(run_dir, fname))
+        config = SSconfig.parse_config("config/config.txt")
+        config['RUN']['RunName'] = run_dir
+        config['RUN']['OverwriteInput'] = 'no'
+        config['CACHE']['UseCache'] = 'no'
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            valid, failed = ODBquery.download_ODB_input(["ATP5MC1"], pd.DataFrame({'tax_id':[9606]}), config)
+            self.assertEqual(server.state.requests['/fasta'], 0)
+        self.assertEqual(valid, ["ATP5MC1"])
+        #The ODB stage created the journal; later stages of the run still adopt their files
+        ncbi_fpath = "{0}/input/NCBI/9999/ATP5MC1.fasta".format(run_dir)
+        self.assertTrue(run_journal(run_dir).is_complete("NCBI_records", "ATP5MC1", ncbi_fpath))
+        self.assertTrue(run_journal(run_dir).is_complete("ODB", "ATP5MC1"))
+
+class testNCBIOrthologsIndex(unittest.TestCase):
+
+    def test_offline_mapping(self):
+        SSdirectory.create_directory(test_tmp_dir)
+        orthologs_fpath = "{0}/gene_orthologs.tsv".format(test_tmp_dir)
+        import shutil
+        shutil.copy("tests/test_data/NCBI/gene_orthologs_test.tsv",orthologs_fpath)
+        #Two orthologs for one human gene ID whose gene IDs differ in digit count
+        with open(orthologs_fpath,'at') as orthologs_f:
+            orthologs_f.write("9606\t4000\tOrtholog\t9999\t1000\n9606\t4000\tOrtholog\t9999\t999\n")
+        errors_fpath = "{0}/orthologs_errors.tsv".format(test_tmp_dir)
+        results_fpath = "{0}/orthologs_mapped.tsv".format(test_tmp_dir)
+        for fpath in [errors_fpath, results_fpath, NCBIquery.orthologs_index_path(orthologs_fpath)]:
+            if os.path.exists(fpath):
+                os.remove(fpath)
+        id_df = pd.DataFrame({'gene_symbol':["ATP5MC1","CALM1","CALM2","ISPD","NOHGID","MULTI"],
+                              'human_gene_id':["516","801","808","729920",None,"4000"]})
+        id_df.index.name = "overall_index"
+        tax_dict = {'gid_column':'ags_gene_id','taxid':'9999'}
+        mapped = NCBIquery.map_AGS_geneIDs_offline(id_df,results_fpath,errors_fpath,tax_dict,orthologs_fpath)
+        self.assertTrue(os.path.exists(NCBIquery.orthologs_index_path(orthologs_fpath)))
+        self.assertEqual(mapped.loc[0,'ags_gene_id'],"113191869")
+        #Reverse direction pair (9999 listed in tax_id column)
+        self.assertEqual(mapped.loc[2,'ags_gene_id'],"113184712")
+        self.assertTrue(mapped['ags_gene_id'][[1,3,4]].isnull().all())
+        #Lowest gene ID by numeric value, not string order
+        self.assertEqual(mapped.loc[5,'ags_gene_id'],"999")
+        check, errors_df = SSerrors.load_errors(errors_fpath)
+        error_codes = dict(zip(errors_df['gene_symbol'],errors_df['error_code']))
+        self.assertEqual(error_codes["CALM1"],1)
+        self.assertEqual(error_codes["ISPD"],0)
+        self.assertEqual(errors_df.loc[errors_df['gene_symbol']=="NOHGID",'error_type'].iloc[0],"RecordDataError")
+
+class testNCBIMultiSpecies(unittest.TestCase):
+
+    def setUp(self):
+        self.run_dir = "{0}/multi_species_run".format(test_tmp_dir)
+        SSdirectory.create_directory(self.run_dir)
+        SSdirectory.empty_directory(self.run_dir)
+        SSdirectory.create_directory("{0}/summary".format(self.run_dir))
+        orthologs_fpath = "{0}/gene_orthologs.tsv".format(self.run_dir)
+        with open("tests/test_data/NCBI/gene_orthologs_test.tsv") as test_f, open(orthologs_fpath,'wt') as orthologs_f:
+            orthologs_f.write(test_f.read())
+            orthologs_f.write("9606\t516\tOrtholog\t9994\t994516\n9606\t801\tOrtholog\t9994\t994801\n")
+        self.config = SSconfig.parse_config("config/config.txt")
+        self.config['RUN']['RunName'] = self.run_dir
+        self.config['CACHE']['UseCache'] = 'no'
+        self.config['NCBI']['NCBIAPIKey'] = ''
+        self.config['NCBI']['NCBIOrthologsFilePath'] = orthologs_fpath
+        self.config['NCBISpecies']['9994'] = 'Marmota marmota marmota'
+        self.gene_id_df = pd.DataFrame({'gene_symbol':["ATP5MC1","CALM1","CALM2"],
+                                        'human_gene_id':["516","801","808"]})
+        self.gene_id_df.index.name = "overall_index"
+
+    def test_tax_dicts(self):
+        tax_dicts = SSconfig.NCBI_tax_dicts(self.config)
+        self.assertEqual([tax_dict['taxid'] for tax_dict in tax_dicts], ['9999', '9994'])
+        self.assertEqual(tax_dicts[0]['gid_column'], 'ags_gene_id')
+        self.assertEqual(tax_dicts[1]['pid_column'], 'ncbi_protein_ids_9994')
+
+    def test_multi_species_download(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            mapped_df = NCBIquery.download_AGS_data(self.gene_id_df, self.config)
+            #Both species share one elink, epost and efetch request
+            entrez_requests = dict((path.split('/')[-1], count) for path, count in server.state.requests.items())
+            self.assertEqual(entrez_requests, {'elink.fcgi':1, 'epost.fcgi':1, 'efetch.fcgi':1})
+            NCBIquery.download_AGS_data(self.gene_id_df, self.config)
+            self.assertEqual(sum(server.state.requests.values()), 3)
+        self.assertEqual(mapped_df.loc[0, 'ncbi_gene_id_9994'], '994516')
+        #No primary species ortholog for CALM1, but additional species records are still acquired
+        self.assertTrue(pd.isnull(mapped_df.loc[1, 'ags_gene_id']))
+        for taxid, symbol in [('9999','ATP5MC1'), ('9999','CALM2'), ('9994','ATP5MC1'), ('9994','CALM1')]:
+            fasta_fpath = "{0}/input/NCBI/{1}/{2}.fasta".format(self.run_dir, taxid, symbol)
+            self.assertTrue(len(SSfasta.fasta_to_srs(fasta_fpath)) > 0)
+        self.assertFalse(os.path.exists("{0}/input/NCBI/9994/CALM2.fasta".format(self.run_dir)))
+
+class testConcurrentAcquisition(unittest.TestCase):
+
+    def setUp(self):
+        self.run_dir = "{0}/concurrent_run".format(test_tmp_dir)
+        SSdirectory.create_directory(self.run_dir)
+        SSdirectory.empty_directory(self.run_dir)
+        for subdir in ["summary", "input/ODB"]:
+            SSdirectory.create_directory("{0}/{1}".format(self.run_dir, subdir))
+        self.config = SSconfig.parse_config("config/config.txt")
+        self.config['RUN']['RunName'] = self.run_dir
+        self.config['CACHE']['UseCache'] = 'no'
+        self.config['ODB']['ODBRequestsPerSecond'] = '100'
+        self.config['NCBI']['NCBIAPIKey'] = ''
+        self.config['NCBI']['NCBIOrthologsFilePath'] = "tests/test_data/NCBI/gene_orthologs_test.tsv"
+        self.config['ALIASES']['AliasDBPath'] = "{0}/aliases.sqlite".format(self.run_dir)
+        self.config['GeneCards']['GeneCardsRequestsPerSecond'] = '50'
+        self.gene_id_df = pd.DataFrame({'gene_symbol':["ATP5MC1","CALM1"], 'human_gene_id':["516","801"]})
+        self.gene_id_df.index.name = "overall_index"
+
+    def test_progress(self):
+        from SSacquisition.SSorchestrator import AcquisitionProgress
+        progress = AcquisitionProgress()
+        progress.start("OrthoDB", 3)
+        progress.advance("OrthoDB")
+        progress.advance("OrthoDB", failed=True)
+        progress.phase("NCBI", "mapping gene IDs")
+        self.assertEqual(progress.render(), "OrthoDB 2/3 (1 failed) | NCBI mapping gene IDs | GeneCards waiting")
+        progress.finish("OrthoDB")
+        self.assertTrue(progress.render().startswith("OrthoDB done 2/3"))
+
+    def test_run_acquisition(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSacquisition.SSorchestrator import run_acquisition
+        from SSutility.SSaliases import AliasStore
+        from SSutility.SSjournal import run_journal
+        tax_table = pd.DataFrame({'tax_id':[9606, 10090]})
+        with MockAcquisitionServer(latency=0.01) as server, mock_base_urls(server):
+            results = run_acquisition(self.config, self.gene_id_df, tax_table, progress_interval=0.05)
+        self.assertEqual(results['OrthoDB'], (["ATP5MC1", "CALM1"], []))
+        for fpath in ["input/ODB/ATP5MC1.fasta", "input/ODB/CALM1.tsv", "input/NCBI/9999/ATP5MC1.fasta"]:
+            self.assertTrue(os.path.exists("{0}/{1}".format(self.run_dir, fpath)))
+        store = AliasStore(self.config['ALIASES']['AliasDBPath'])
+        self.assertEqual(store.aliases("ATP5MC1")[0], "ATP5MC1")
+        store.close()
+        #Shared journal: compaction by the NCBI stage keeps the concurrently journaled OrthoDB entries
+        journal = run_journal(self.run_dir)
+        self.assertTrue(journal.is_complete("ODB", "ATP5MC1"))
+        self.assertTrue(journal.is_complete("ODB", "CALM1"))
+        self.assertTrue(journal.is_complete("NCBI_records", "ATP5MC1"))
+        #Both stages logged CALM1 errors to the shared errors file
+        check_errors, errors_df = SSerrors.load_errors("{0}/errors.tsv".format(self.run_dir))
+        self.assertEqual(set(errors_df.loc[errors_df['gene_symbol']=="CALM1",'error_type']),
+                         {"NCBIQueryError", "GeneCardsError"})
+
+class testAliasQuery(unittest.TestCase):
+
+    def fixture_engine(self):
+        from SSacquisition.SSdownload import DownloadEngine
+        from SSacquisition import aliasQuery
+        from urllib.parse import urlencode
+        import re
+        class Response:
+            def __init__(self, url, text):
+                self.url, self.text, self.ok = url, text, True
+            def raise_for_status(self):
+                pass
+        class FixtureEngine(DownloadEngine):
+            #Serves GeneCards pages from tests/test_data/GeneCards; unknown card pages are empty pages
+            def get(self, url, params=None, stream=False):
+                if params:
+                    url = "{0}?{1}".format(url, urlencode(params))
+                self.urls.append(url)
+                if url.startswith(aliasQuery.GC_SEARCH_URL):
+                    fixture = "{0}_search.html".format(params['queryString'])
+                else:
+                    fixture = "{0}_card.html".format(re.search("gene=([A-Z0-9]+)",url).groups()[0])
+                fixture_fpath = "tests/test_data/GeneCards/{0}".format(fixture)
+                if not os.path.exists(fixture_fpath):
+                    fixture_fpath = "tests/test_data/GeneCards/empty_card.html"
+                with open(fixture_fpath) as fixture_f:
+                    return Response(url, fixture_f.read())
+        engine = FixtureEngine(requests_per_second=100, max_workers=2)
+        engine.urls = []
+        return engine
+
+    def test_parse_aliases(self):
+        from SSacquisition import aliasQuery
+        with open("tests/test_data/GeneCards/ATP5MC1_card.html") as card_f:
+            aliases = aliasQuery.parse_GC_aliases(card_f.read())
+        self.assertEqual(aliases[1], "ATP5G1")
+        self.assertEqual(len(aliases), 5)
+        with open("tests/test_data/GeneCards/ATPIF1_search.html") as search_f:
+            links = aliasQuery.parse_GC_search_links(search_f.read(), aliasQuery.GC_SEARCH_URL)
+        self.assertEqual(links[1], "https://www.genecards.org/cgi-bin/carddisp.pl?gene=ATP5IF1&keywords=ATPIF1")
+
+    def test_http_query(self):
+        from SSacquisition import aliasQuery
+        aliases_dir = "{0}/alias_data".format(test_tmp_dir)
+        SSdirectory.create_directory(aliases_dir)
+        engine = self.fixture_engine()
+        aliases = aliasQuery.alias_GC_http_query(engine, "ATP5MC1", aliases_dir=aliases_dir)
+        self.assertEqual(aliases[0], "ATP5MC1")
+        self.assertEqual(len(engine.urls), 1)
+        #Search results path: linked cards fetched in results order until one (ATP5IF1) lists ATPIF1 as alias
+        aliases = aliasQuery.alias_GC_http_query(engine, "ATPIF1", aliases_dir=aliases_dir)
+        self.assertEqual(aliases[0], "ATP5IF1")
+        with open("{0}/ATPIF1_aliases.txt".format(aliases_dir)) as aliases_f:
+            self.assertEqual(aliases_f.readline().strip(), "ATP5IF1")
+        with self.assertRaises(SSerrors.GeneCardsError):
+            aliasQuery.alias_GC_http_query(engine, "NOTAGENE", aliases_dir=aliases_dir)
+        engine.close()
+        #Card urls without a gene= parameter (ie redirects) fall back to the default symbol
+        self.assertEqual(aliasQuery.gc_name_from_url("https://www.genecards.org/cgi-bin/carddisp.pl?id=1", "ATPIF1"),
+                         "ATPIF1")
+
+    def test_download_alias_store(self):
+        from mockServer import MockAcquisitionServer, mock_base_urls
+        from SSacquisition import aliasQuery
+        from SSutility.SSaliases import AliasStore
+        run_dir = "{0}/alias_run".format(test_tmp_dir)
+        SSdirectory.create_directory(run_dir)
+        db_fpath = "{0}/aliases.sqlite".format(run_dir)
+        if os.path.exists(db_fpath):
+            os.remove(db_fpath)
+        config = SSconfig.parse_config("config/config.txt")
+        config['RUN']['RunName'] = run_dir
+        config['CACHE']['UseCache'] = 'no'
+        config['ALIASES']['AliasDBPath'] = db_fpath
+        config['GeneCards']['GeneCardsRequestsPerSecond'] = '50'
+        with MockAcquisitionServer() as server, mock_base_urls(server):
+            aliasQuery.download_alias_data(["ATP5MC1", "ATPIF1"], config)
+            requests = sum(server.state.requests.values())
+            #Stored symbols are not queried again
+            aliasQuery.download_alias_data(["ATP5MC1", "ATPIF1"], config)
+            self.assertEqual(sum(server.state.requests.values()), requests)
+        store = AliasStore(db_fpath)
+        self.assertEqual(store.aliases("ATPIF1")[0], "ATP5IF1")
+        self.assertEqual(store.symbols_for_alias("ATP5G1"), ["ATP5MC1"])
+        store.close()
+
 if __name__ == '__main__':
 
     from SSutility.SSdirectory import create_directory,empty_directory